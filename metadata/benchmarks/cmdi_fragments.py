@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+
+# Measures the time per CMDI record with and without the cache of static fragments and language lookups in
+# aggregation_cmdi_creation. Usage: python3 benchmarks/cmdi_fragments.py [records] [issues per record]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'image', 'src'))
+os.environ.setdefault('RECORD_API_KEY', 'benchmark')
+os.environ.setdefault('CMDI_RECORDS_BASE_URL', 'http://localhost/cmdi')
+
+import aggregation_cmdi_creation  # noqa: E402
+
+from aggregation_cmdi_creation import make_cmdi_record, make_collection_record  # noqa: E402
+from aggregation_cmdi_creation import make_cmdi_template, make_collection_record_template  # noqa: E402
+
+COLLECTION_ID = '9200396'
+LANGUAGES = ['pl', 'de', 'fr', 'nl', 'fin', 'lav']
+
+
+def make_records_map(issues):
+    records = {}
+    for i in range(issues):
+        identifier = f"3000118{i:06d}"
+        records[identifier] = {
+            'file': f"BibliographicResource_{identifier}.xml",
+            'facts': {
+                'landing_pages': [f"https://www.europeana.eu/item/{COLLECTION_ID}/BibliographicResource_{identifier}"],
+                'types': ['Newspaper', 'Text'],
+                'publishers': [f"Publisher {i % 3}"],
+                'languages': [LANGUAGES[i % len(LANGUAGES)]],
+                'countries': ['Poland'],
+                'rights': ['http://creativecommons.org/publicdomain/mark/1.0/'],
+                'titles': [f"Dziennik - 1862-01-{i % 28 + 1:02d}"],
+                'identifiers': [f"http://data.theeuropeanlibrary.org/BibliographicResource/{identifier}"],
+                'issued': [f"1862-01-{i % 28 + 1:02d}"]
+            }
+        }
+    return records
+
+
+def run(record_count, records_map, template, collection_template):
+    summary = aggregation_cmdi_creation.make_facet_summary(records_map)
+    year_files = {str(1850 + year): f"Dziennik_{1850 + year}.xml" for year in range(10)}
+    start = time.perf_counter()
+    for i in range(record_count):
+        make_cmdi_record(f"Dziennik_{i}.xml", template, COLLECTION_ID, 'Dziennik', '1862', records_map)
+        make_collection_record(f"Dziennik_collection_{i}.xml", collection_template, COLLECTION_ID, 'Dziennik',
+                               year_files, summary)
+    return (time.perf_counter() - start) / record_count
+
+
+def main():
+    record_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    issues = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    records_map = make_records_map(issues)
+    template = make_cmdi_template()
+    collection_template = make_collection_record_template()
+
+    # without cache: fragments are built and languages looked up for every record
+    cached_get_fragment = aggregation_cmdi_creation.get_fragment
+    cached_look_up_language = aggregation_cmdi_creation.look_up_language
+    aggregation_cmdi_creation.get_fragment = cached_get_fragment.__wrapped__
+    aggregation_cmdi_creation.look_up_language = cached_look_up_language.__wrapped__
+    try:
+        uncached = run(record_count, records_map, template, collection_template)
+    finally:
+        aggregation_cmdi_creation.get_fragment = cached_get_fragment
+        aggregation_cmdi_creation.look_up_language = cached_look_up_language
+
+    cached = run(record_count, records_map, template, collection_template)
+
+    print(f"{record_count} year + collection record pairs, {issues} issues per year record")
+    print(f"without fragment cache: {uncached * 1000:.3f} ms per pair")
+    print(f"with fragment cache:    {cached * 1000:.3f} ms per pair")
+    print(f"saving:                 {(uncached - cached) * 1000:.3f} ms per pair "
+          f"({(uncached - cached) / uncached:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+from lxml import etree
+
+# Checks that two pipeline configurations (for instance another EDM extractor or CMDI writer) give the same output.
+# 'run' runs the metadata aggregation and the full text extraction twice over the same corpus (see synthetic_corpus.py),
+# with the environment variables of each configuration, and compares the outputs; 'compare' compares two output trees
+# (directories or ZIP archives) that are already there.
+#
+# XML is compared in canonical form (C14N), without whitespace-only text (so pretty printing makes no difference) and
+# with the dates of each run (MdCreationDate and the conversion date in MetadataInfo) masked; .txt files are compared
+# line by line, id_file_map.json as a map and any other file byte by byte. The first divergences per file are reported.
+#
+# Usage: python3 benchmarks/equivalence.py run CORPUS_DIR --baseline 'VAR=value ...' --candidate 'VAR=value ...'
+#                                              [--keep DIR] [--max-diffs N]
+#        python3 benchmarks/equivalence.py compare BASELINE CANDIDATE [--max-diffs N]
+#
+# Both exit with status 1 if the outputs differ. With EQUIVALENCE_METADATA_SOURCE=archive in a configuration, the
+# metadata is aggregated from the metadata dump of the corpus instead of the directory.
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+METADATA_SRC_DIR = os.path.join(BENCHMARKS_DIR, '..', 'image', 'src')
+TEXT_SRC_DIR = os.path.join(BENCHMARKS_DIR, '..', '..', 'text', 'image', 'src')
+
+MASK = 'MASKED'
+# different in every run
+MASKED_PATHS = [
+    "/*[local-name()='CMD']/*[local-name()='Header']/*[local-name()='MdCreationDate']",
+    "//*[local-name()='ActivityInfo'][*[local-name()='method']='Conversion']/*[local-name()='When']"
+    "/*[local-name()='date']"
+]
+
+parser = etree.XMLParser(remove_blank_text=True, resolve_entities=False, huge_tree=True)
+
+
+# --------- Output trees ---------
+
+
+def list_output_files(path):
+    # relative path -> function reading the content (bytes), for a directory or a ZIP archive
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+        return {name: lambda name=name: read_archive_member(path, name) for name in names}
+
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            full_path = os.path.join(root, name)
+            files[os.path.relpath(full_path, path)] = lambda full_path=full_path: read_file(full_path)
+    return files
+
+
+def read_archive_member(path, name):
+    with zipfile.ZipFile(path) as archive:
+        return archive.read(name)
+
+
+def read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+# --------- Comparison ---------
+
+
+def compare_trees(baseline, candidate, max_diffs=3):
+    # file -> list of divergences (at most max_diffs per file), for all files that differ or are missing on one side
+    baseline_files = list_output_files(baseline)
+    candidate_files = list_output_files(candidate)
+    divergences = {}
+    for name in sorted(set(baseline_files) | set(candidate_files)):
+        if name not in candidate_files:
+            divergences[name] = ['only in baseline']
+        elif name not in baseline_files:
+            divergences[name] = ['only in candidate']
+        elif diffs := compare_files(name, baseline_files[name](), candidate_files[name](), max_diffs):
+            divergences[name] = diffs
+    return len(set(baseline_files) | set(candidate_files)), divergences
+
+
+def compare_files(name, baseline, candidate, max_diffs):
+    if baseline == candidate:
+        return []
+    if name.endswith('.xml'):
+        return compare_xml(baseline, candidate, max_diffs)
+    if name.endswith('.txt'):
+        return compare_text(baseline, candidate, max_diffs)
+    if os.path.basename(name) == 'id_file_map.json':
+        return compare_maps(json.loads(baseline), json.loads(candidate), max_diffs)
+    return [f"content differs ({len(baseline):,} and {len(candidate):,} bytes)"]
+
+
+def canonicalize(content):
+    tree = etree.fromstring(content, parser).getroottree()
+    for path in MASKED_PATHS:
+        for element in tree.xpath(path):
+            element.text = MASK
+    return tree, etree.tostring(tree, method='c14n')
+
+
+def compare_xml(baseline, candidate, max_diffs):
+    try:
+        baseline_tree, baseline_c14n = canonicalize(baseline)
+        candidate_tree, candidate_c14n = canonicalize(candidate)
+    except etree.XMLSyntaxError as e:
+        return [f"not well-formed: {e}"]
+    if baseline_c14n == candidate_c14n:
+        return []
+    diffs = []
+    compare_elements(baseline_tree.getroot(), candidate_tree.getroot(), diffs, max_diffs)
+    # equal element by element, but not in canonical form (namespace declarations)
+    return diffs or ['canonical forms differ (namespace declarations)']
+
+
+def compare_elements(baseline, candidate, diffs, max_diffs):
+    # depth first, in document order; children are only compared if the elements themselves are the same
+    path = baseline.getroottree().getpath(baseline)
+    if baseline.tag != candidate.tag:
+        diffs += [f"{path}: element {baseline.tag} != {candidate.tag}"]
+        return len(diffs) < max_diffs
+    if dict(baseline.attrib) != dict(candidate.attrib):
+        for key in sorted(set(baseline.attrib) | set(candidate.attrib)):
+            if baseline.get(key) != candidate.get(key):
+                diffs += [f"{path}/@{key}: {baseline.get(key)!r} != {candidate.get(key)!r}"]
+                if len(diffs) >= max_diffs:
+                    return False
+    baseline_text, candidate_text = (baseline.text or '').strip(), (candidate.text or '').strip()
+    if baseline_text != candidate_text:
+        diffs += [f"{path}: text, {show_difference(baseline_text, candidate_text)}"]
+        if len(diffs) >= max_diffs:
+            return False
+    baseline_children, candidate_children = list(baseline), list(candidate)
+    for baseline_child, candidate_child in zip(baseline_children, candidate_children):
+        if not compare_elements(baseline_child, candidate_child, diffs, max_diffs):
+            return False
+    if len(baseline_children) != len(candidate_children):
+        diffs += [f"{path}: {len(baseline_children)} != {len(candidate_children)} child elements"]
+    return len(diffs) < max_diffs
+
+
+def compare_text(baseline, candidate, max_diffs):
+    baseline_lines = baseline.decode('utf-8', errors='replace').splitlines()
+    candidate_lines = candidate.decode('utf-8', errors='replace').splitlines()
+    diffs = []
+    for number, (baseline_line, candidate_line) in enumerate(zip(baseline_lines, candidate_lines), start=1):
+        if baseline_line != candidate_line:
+            diffs += [f"line {number}, {show_difference(baseline_line, candidate_line)}"]
+            if len(diffs) >= max_diffs:
+                return diffs
+    if len(baseline_lines) != len(candidate_lines):
+        diffs += [f"{len(baseline_lines)} != {len(candidate_lines)} lines"]
+    # only line endings, or a final newline
+    return diffs or ['line endings differ']
+
+
+def compare_maps(baseline, candidate, max_diffs):
+    diffs = []
+    for key in sorted(set(baseline) | set(candidate)):
+        if baseline.get(key) != candidate.get(key):
+            diffs += [f"{key}: {baseline.get(key)!r} != {candidate.get(key)!r}"]
+            if len(diffs) >= max_diffs:
+                break
+    return diffs
+
+
+def show_difference(baseline, candidate, context=20, length=60):
+    # from a little before the first character that differs
+    baseline, candidate = baseline or '', candidate or ''
+    column = next((i for i, (a, b) in enumerate(zip(baseline, candidate)) if a != b),
+                  min(len(baseline), len(candidate)))
+    start = max(0, column - context)
+
+    def excerpt(text):
+        return f"{'...' if start else ''}{text[start:start + length]}{'...' if len(text) > start + length else ''}"
+
+    return f"column {column + 1}: {excerpt(baseline)!r} != {excerpt(candidate)!r}"
+
+
+def report(total, divergences):
+    for name, diffs in divergences.items():
+        print(name)
+        for diff in diffs:
+            print(f"  {diff}")
+    if divergences:
+        print(f"{len(divergences)} of {total} files differ")
+    else:
+        print(f"All {total} files are equivalent")
+
+
+# --------- Pipeline runs ---------
+
+
+def parse_configuration(settings):
+    # 'VAR=value VAR=value' -> {VAR: value}
+    configuration = {}
+    for setting in shlex.split(settings or ''):
+        name, separator, value = setting.partition('=')
+        if not separator:
+            raise ValueError(f"Expecting VAR=value, not '{setting}'")
+        configuration[name] = value
+    return configuration
+
+
+def run_pipelines(corpus_dir, configuration, output_dir):
+    # metadata aggregation into <output_dir>/metadata, full text extraction into <output_dir>/text
+    with open(f"{corpus_dir}/corpus.json") as file:
+        collection_id = json.load(file)['collection_id']
+    environment = dict(os.environ)
+    environment.setdefault('RECORD_API_KEY', 'equivalence')
+    environment.setdefault('CMDI_RECORDS_BASE_URL', 'http://localhost/cmdi')
+    # titles from the corpus, no API requests
+    environment['TITLE_CACHE_FILE'] = f"{corpus_dir}/title_cache.db"
+    environment['DUMP_BASE_PATH'] = f"{corpus_dir}/fulltext"
+    environment.update(configuration)
+
+    metadata_source = f"{corpus_dir}/metadata/{collection_id}"
+    if environment.get('EQUIVALENCE_METADATA_SOURCE', 'directory') == 'archive':
+        metadata_source += '.zip'
+    os.makedirs(f"{output_dir}/text/{collection_id}", exist_ok=True)
+    for command in [[sys.executable, METADATA_SRC_DIR, collection_id, metadata_source, f"{output_dir}/metadata"],
+                    [sys.executable, TEXT_SRC_DIR, collection_id, f"{output_dir}/text"]]:
+        with tempfile.TemporaryFile('w+') as log:
+            if subprocess.run(command, env=environment, stdout=log, stderr=log).returncode != 0:
+                log.seek(0)
+                sys.stderr.write(log.read())
+                raise RuntimeError(f"Failed: {' '.join(command)}")
+
+
+def run(arguments):
+    configurations = {'baseline': parse_configuration(arguments.baseline),
+                      'candidate': parse_configuration(arguments.candidate)}
+    with tempfile.TemporaryDirectory(prefix='equivalence-') as temporary_dir:
+        work_dir = arguments.keep or temporary_dir
+        for name, configuration in configurations.items():
+            print(f"Running {name}: {' '.join(f'{key}={value}' for key, value in configuration.items()) or 'defaults'}")
+            run_pipelines(arguments.corpus, configuration, f"{work_dir}/{name}")
+        total, divergences = compare_trees(f"{work_dir}/baseline", f"{work_dir}/candidate", arguments.max_diffs)
+    report(total, divergences)
+    return not divergences
+
+
+def compare(arguments):
+    total, divergences = compare_trees(arguments.baseline, arguments.candidate, arguments.max_diffs)
+    report(total, divergences)
+    return not divergences
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Compare the output of two pipeline configurations")
+    commands = argument_parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run both configurations on a corpus and compare their output")
+    run_parser.add_argument('corpus', help="corpus directory (see synthetic_corpus.py)")
+    run_parser.add_argument('--baseline', default='', help="environment variables of the baseline, 'VAR=value ...'")
+    run_parser.add_argument('--candidate', default='', help="environment variables of the candidate")
+    run_parser.add_argument('--keep', help="write the outputs to this directory instead of a temporary one")
+    run_parser.add_argument('--max-diffs', type=int, default=3, help="divergences reported per file")
+
+    compare_parser = commands.add_parser('compare', help="compare two output directories or archives")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--max-diffs', type=int, default=3, help="divergences reported per file")
+
+    arguments = argument_parser.parse_args()
+    equivalent = run(arguments) if arguments.command == 'run' else compare(arguments)
+    sys.exit(0 if equivalent else 1)
+
+
+if __name__ == "__main__":
+    main()
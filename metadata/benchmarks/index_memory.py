@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import tracemalloc
+
+# Compares the memory used by the collection index as nested dicts (as built before) and as a CompactIndex, for
+# generated records. Usage: python3 benchmarks/index_memory.py [records] [titles]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'image', 'src'))
+
+from compact_index import CompactIndex  # noqa: E402
+
+LANGUAGES = ['pl', 'de', 'fr', 'nl', 'fi', 'lv']
+
+
+def make_items(count, titles):
+    # like the results of the pool workers: separate (unpickled) strings for every record
+    for i in range(count):
+        identifier = f"3000118{i:07d}"
+        year = str(1800 + i % 150)
+        yield {
+            'identifier': identifier,
+            'titles': [f"Newspaper {i % titles}"],
+            'years': [year],
+            'filename': f"BibliographicResource_{identifier}.xml",
+            'facts': {
+                'landing_pages': [f"https://www.europeana.eu/item/9200396/BibliographicResource_{identifier}"],
+                'types': [f"{'Newspaper'}", f"{'Text'}"],
+                'publishers': [f"Publisher {i % titles}"],
+                'languages': [f"{LANGUAGES[i % len(LANGUAGES)]}"],
+                'countries': [f"{'Poland'}"],
+                'rights': [f"{'http://creativecommons.org/publicdomain/mark/1.0/'}"],
+                'titles': [f"Newspaper {i % titles} - {year}-01-{i % 28 + 1:02d}"],
+                'identifiers': [f"http://data.theeuropeanlibrary.org/BibliographicResource/{identifier}"],
+                'issued': [f"{year}-01-{i % 28 + 1:02d}"]
+            }
+        }
+
+
+def build_dict_index(items):
+    index = {}
+    for item in items:
+        for title in item['titles']:
+            for year in item['years']:
+                index.setdefault(title, {}).setdefault(year, {})[item['identifier']] = {
+                    'file': item['filename'],
+                    'facts': item['facts']
+                }
+    return index
+
+
+def build_compact_index(items):
+    index = CompactIndex()
+    for item in items:
+        record = index.add_record(item['identifier'], item['filename'], item['facts'])
+        for title in item['titles']:
+            for year in item['years']:
+                index.add_to_group(title, year, record)
+    return index
+
+
+def measure(build, count, titles):
+    # timed without tracing, which slows down allocations a lot
+    start = time.perf_counter()
+    index = build(make_items(count, titles))
+    build_seconds = time.perf_counter() - start
+    # read back everything, as generating the records does
+    start = time.perf_counter()
+    for title in index:
+        for year in index[title]:
+            for identifier, record in index[title][year].items():
+                record['facts']
+    read_seconds = time.perf_counter() - start
+    del index
+
+    tracemalloc.start()
+    index = build(make_items(count, titles))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del index
+    return size, build_seconds, read_seconds
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    titles = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    print(f"{count} records, {titles} titles")
+    for name, build in [('nested dicts', build_dict_index), ('compact', build_compact_index)]:
+        size, build_seconds, read_seconds = measure(build, count, titles)
+        print(f"{name:>12}: {size / 1024 / 1024:8,.1f} MiB, {size / count:6,.0f} bytes per record, "
+              f"built in {build_seconds:.2f} s, read in {read_seconds:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
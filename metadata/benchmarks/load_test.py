@@ -0,0 +1,295 @@
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timezone
+from itertools import cycle, islice
+from multiprocessing.pool import ThreadPool
+
+# Load test of the network bound stages against the mock services (see mock_services.py) on a synthetic corpus: title
+# lookups in the record API (look_up_title), title resolution with the search resolver (search_titles: a search per
+# batch of titles, and record lookups for the titles the search did not find), a harvest of the full text references
+# of IIIF manifests (retrieve_annotation_refs) and downloading the full text dump by FTP (zipped_chunks_ftp). Each
+# stage runs at each concurrency in a process of its own, configured by the environment (and --env: HTTP client, rate
+# limits, ...). Throughput and latency percentiles are reported per unit of work (a title, a batch of titles, a
+# manifest, a download), with the errors of the stage and the requests and injected faults seen by the services. A
+# unit is an error if its result is not the expected one (for search_titles: a batch not resolved to the titles of the
+# corpus, and 'no title' for a record that is not in it).
+#
+# Usage: python3 benchmarks/load_test.py run [--scale small|medium|large] [--corpus DIR] [--stages STAGE ...]
+#                                            [--concurrency N ...] [--units N] [--env 'VAR=value ...']
+#                                            [--latency S] [--jitter S] [--bandwidth BYTES/S] [--error-rate P]
+#                                            [--throttle-rate P] [--drop-rate P] [--seed N] [--output FILE]
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+METADATA_SRC_DIR = os.path.join(BENCHMARKS_DIR, '..', 'image', 'src')
+TEXT_SRC_DIR = os.path.join(BENCHMARKS_DIR, '..', '..', 'text', 'image', 'src')
+
+# units of work per run (at least the concurrency)
+DEFAULT_UNITS = {
+    'look_up_title': 200,
+    'search_titles': 20,
+    'retrieve_annotation_refs': 50,
+    'zipped_chunks_ftp': 4
+}
+PERCENTILES = [50, 95, 99]
+
+
+def get_collection_id(corpus_dir):
+    with open(f"{corpus_dir}/corpus.json") as file:
+        return json.load(file)['collection_id']
+
+
+def run_units(function, items, concurrency):
+    # function(item) -> (ok, bytes), for all items with concurrency threads
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            ok, size = function(item)
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}", file=sys.stderr)
+            ok, size = False, 0
+        return time.perf_counter() - start, ok, size
+
+    start = time.perf_counter()
+    with ThreadPool(concurrency) as pool:
+        results = pool.map(timed, items, chunksize=1)
+    return {
+        'seconds': time.perf_counter() - start,
+        'latencies': [latency for latency, _, _ in results],
+        'errors': sum(1 for _, ok, _ in results if not ok),
+        'bytes': sum(size for _, _, size in results)
+    }
+
+
+# --------- Stages: run in a process of their own, with the environment pointing to the services ---------
+
+
+def look_up_title_stage(corpus_dir, concurrency, units):
+    sys.path.insert(0, METADATA_SRC_DIR)
+    from title_resolution import look_up_title
+
+    with open(f"{corpus_dir}/titles.json") as file:
+        edm_ids = list(json.load(file))
+
+    def look_up(edm_id):
+        _, title, answered = look_up_title(edm_id)
+        return answered and title is not None, 0
+
+    return run_units(look_up, islice(cycle(edm_ids), units), concurrency)
+
+
+def search_titles_stage(corpus_dir, concurrency, units):
+    # a batch is a search request of known records and one record that is not in the corpus, which is left for a
+    # record lookup
+    os.environ['TITLE_RESOLVER'] = 'search'
+    sys.path.insert(0, METADATA_SRC_DIR)
+    from env import TITLE_SEARCH_BATCH_SIZE
+    from title_resolution import retrieve_titles
+
+    with open(f"{corpus_dir}/titles.json") as file:
+        titles = json.load(file)
+    edm_ids = cycle(titles)
+    batches = [list(dict.fromkeys(islice(edm_ids, max(1, TITLE_SEARCH_BATCH_SIZE - 1)))) + [f"0/missing{unit}"]
+               for unit in range(units)]
+
+    def resolve(batch):
+        retrieved, _ = retrieve_titles(batch)
+        return retrieved == {edm_id: titles.get(edm_id, None) for edm_id in batch}, 0
+
+    return run_units(resolve, batches, concurrency)
+
+
+def retrieve_annotation_refs_stage(corpus_dir, concurrency, units):
+    # one harvest of all manifests, as the pipeline does it (concurrency is that of the harvest); the latency of a
+    # manifest is the time from the start of the harvest until it is complete
+    sys.path.insert(0, METADATA_SRC_DIR)
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from env import IIIF_API_URL
+    from mock_services import list_issues
+    from retrieve_iiif_annotations import harvest_manifests
+
+    with open(f"{corpus_dir}/corpus.json") as file:
+        pages = json.load(file)['pages']
+    collection_id = get_collection_id(corpus_dir)
+    manifest_urls = [f"{IIIF_API_URL}/presentation/{collection_id}/{issue}/manifest"
+                     for issue in list_issues(corpus_dir, collection_id)]
+
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for _, refs, complete in harvest_manifests(islice(cycle(manifest_urls), units), concurrency):
+        latencies += [time.perf_counter() - start]
+        if not complete or len(refs) != pages:
+            errors += 1
+    return {'seconds': time.perf_counter() - start, 'latencies': latencies, 'errors': errors, 'bytes': 0}
+
+
+def zipped_chunks_ftp_stage(corpus_dir, concurrency, units):
+    sys.path.insert(0, TEXT_SRC_DIR)
+    from retrieve_and_extract import zipped_chunks_ftp
+
+    collection_id = get_collection_id(corpus_dir)
+    expected_size = os.path.getsize(f"{corpus_dir}/fulltext/{collection_id}.zip")
+
+    def download(_):
+        size = sum(len(chunk) for chunk in zipped_chunks_ftp(collection_id))
+        return size == expected_size, size
+
+    return run_units(download, range(units), concurrency)
+
+
+STAGES = {
+    'look_up_title': look_up_title_stage,
+    'search_titles': search_titles_stage,
+    'retrieve_annotation_refs': retrieve_annotation_refs_stage,
+    'zipped_chunks_ftp': zipped_chunks_ftp_stage
+}
+
+
+def run_stage(name, corpus_dir, concurrency, units):
+    # in the process of the stage: result as JSON on the last line of the output
+    print(json.dumps(STAGES[name](corpus_dir, concurrency, units)))
+
+
+def measure_stage(name, corpus_dir, concurrency, units, environment, timeout):
+    with tempfile.TemporaryFile('w+') as log:
+        process = subprocess.Popen([sys.executable, os.path.realpath(__file__), 'stage', name, corpus_dir,
+                                    '--concurrency', str(concurrency), '--units', str(units)],
+                                   env=environment, stdout=subprocess.PIPE, stderr=log, text=True)
+        try:
+            output, _ = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise RuntimeError(f"Stage {name} did not finish in {timeout} seconds (concurrency {concurrency})")
+        if process.returncode != 0:
+            log.seek(0)
+            sys.stderr.write(log.read())
+            raise RuntimeError(f"Stage {name} failed with exit status {process.returncode}")
+    run = json.loads(output.strip().splitlines()[-1])
+    latencies = sorted(run['latencies'])
+    result = {
+        'concurrency': concurrency,
+        'units': len(latencies),
+        'seconds': run['seconds'],
+        'units_per_second': len(latencies) / run['seconds'],
+        'mib_per_second': run['bytes'] / 1024 / 1024 / run['seconds'],
+        'errors': run['errors'],
+        'max_seconds': latencies[-1] if latencies else 0.0
+    }
+    for percentile in PERCENTILES:
+        result[f"p{percentile}_seconds"] = get_percentile(latencies, percentile)
+    return result
+
+
+def get_percentile(values, percentile):
+    # nearest rank, of sorted values
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(percentile / 100 * len(values)) - 1)]
+
+
+def run_load_test(arguments):
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from equivalence import parse_configuration
+    from mock_services import MockServices, make_faults
+    from suite import SCALES
+    from synthetic_corpus import generate_corpus, load_corpus_summary
+
+    corpus_dir = arguments.corpus or f"{tempfile.gettempdir()}/europeana-benchmark-{arguments.scale}"
+    corpus = load_corpus_summary(corpus_dir)
+    if corpus is None:
+        print(f"Generating {arguments.scale} corpus in {corpus_dir}")
+        corpus = generate_corpus(corpus_dir, **SCALES[arguments.scale])
+
+    configuration = parse_configuration(arguments.env)
+    faults = make_faults(arguments)
+    results = {}
+    with MockServices(corpus_dir, faults) as services:
+        environment = dict(os.environ)
+        environment.setdefault('RECORD_API_KEY', 'load-test')
+        environment.setdefault('CMDI_RECORDS_BASE_URL', 'http://localhost/cmdi')
+        environment.update(services.environment())
+        environment.update(configuration)
+
+        print(f"{corpus['issues']} issues, services at {services.http_url} and {services.ftp_url}, "
+              f"{' '.join(f'{key}={value}' for key, value in configuration.items()) or 'default configuration'}")
+        print_row('stage', 'concurrency', 'units/s', 'MiB/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'errors',
+                  'requests', 'faults')
+        for name in arguments.stages or STAGES:
+            results[name] = []
+            for concurrency in arguments.concurrency:
+                units = max(concurrency, arguments.units or DEFAULT_UNITS[name])
+                services.reset_stats()
+                result = measure_stage(name, corpus_dir, concurrency, units, environment, arguments.timeout)
+                result['services'] = dict(services.stats)
+                results[name] += [result]
+                print_row(name, concurrency, f"{result['units_per_second']:,.1f}", f"{result['mib_per_second']:,.2f}",
+                          *[f"{result[key] * 1000:,.0f}" for key in ['p50_seconds', 'p95_seconds', 'p99_seconds',
+                                                                     'max_seconds']],
+                          result['errors'], result['services']['requests'],
+                          sum(result['services'][fault] for fault in ['dropped', 'throttled', 'failed']))
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'corpus': corpus,
+        'faults': {key: getattr(faults, key) for key in ['latency', 'jitter', 'bandwidth', 'error_rate',
+                                                         'throttle_rate', 'drop_rate', 'retry_after']},
+        'configuration': configuration,
+        'stages': results
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {arguments.output}")
+
+
+def print_row(*values):
+    print(f"{values[0]:<26}" + ''.join(f"{value:>12}" for value in values[1:]))
+
+
+def main():
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from mock_services import add_fault_arguments
+
+    parser = argparse.ArgumentParser(description="Load test of the network bound stages against mock services")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run the load test")
+    run_parser.add_argument('--scale', choices=['small', 'medium', 'large'], default='small',
+                            help="size of the generated corpus")
+    run_parser.add_argument('--corpus', help="corpus directory (generated if there is no corpus yet)")
+    run_parser.add_argument('--stages', nargs='+', choices=STAGES, help="stages to run (default: all)")
+    run_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help="concurrency settings")
+    run_parser.add_argument('--units', type=int, help="units of work per run (default: depends on the stage)")
+    run_parser.add_argument('--env', default='', help="environment variables of the stages, 'VAR=value ...'")
+    run_parser.add_argument('--timeout', type=int, default=600, help="seconds per stage and concurrency")
+    run_parser.add_argument('--output', help="JSON file for the results")
+    add_fault_arguments(run_parser)
+
+    # run by 'run', in a process of its own
+    stage_parser = commands.add_parser('stage')
+    stage_parser.add_argument('name', choices=STAGES)
+    stage_parser.add_argument('corpus')
+    stage_parser.add_argument('--concurrency', type=int, default=1)
+    stage_parser.add_argument('--units', type=int, default=1)
+
+    arguments = parser.parse_args()
+    if arguments.command == 'run':
+        run_load_test(arguments)
+    else:
+        run_stage(arguments.name, arguments.corpus, arguments.concurrency, arguments.units)
+
+
+if __name__ == "__main__":
+    main()
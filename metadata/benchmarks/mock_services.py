@@ -0,0 +1,426 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-ins for the Europeana services the pipelines depend on, serving a synthetic corpus (see
+# synthetic_corpus.py): the record API (records of the newspapers and search), the IIIF API (a manifest per issue and
+# an annotation list per page, with ETags for conditional requests) and the FTP server with the full text dump. Faults
+# can be injected: latency (plus a random jitter) per response, a bandwidth cap per connection, and a share of
+# requests that fail (5xx, or a FTP error), are throttled (429 with Retry-After, or 421) or have their connection
+# dropped (before the response, or halfway a FTP download).
+#
+# Usage: python3 benchmarks/mock_services.py CORPUS_DIR [--host HOST] [--http-port PORT] [--ftp-port PORT]
+#                                            [--latency S] [--jitter S] [--bandwidth BYTES/S]
+#                                            [--error-rate P] [--throttle-rate P] [--drop-rate P] [--seed N]
+#
+# The environment variables that point the pipelines to the services are printed at startup; see load_test.py for
+# measurements with the services.
+
+FTP_BLOCK_SIZE = 65536
+# pacing of bandwidth limited transfers (seconds)
+BANDWIDTH_INTERVAL = 0.05
+
+
+class Faults:
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=0, error_rate=0.0, throttle_rate=0.0, drop_rate=0.0,
+                 retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        # bytes per second and connection, 0 = no limit
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(0, self.jitter) if self.jitter else 0.0
+        if self.latency + jitter > 0:
+            time.sleep(self.latency + jitter)
+
+    def pick(self):
+        # None, 'drop', 'throttle' or 'error', for a request
+        with self.lock:
+            value = self.random.random()
+        for fault, rate in [('drop', self.drop_rate), ('throttle', self.throttle_rate), ('error', self.error_rate)]:
+            if value < rate:
+                return fault
+            value -= rate
+        return None
+
+    def send(self, write, chunks):
+        # at most bandwidth bytes per second; returns the number of bytes sent
+        sent = 0
+        start = time.monotonic()
+        for chunk in chunks:
+            if not self.bandwidth:
+                write(chunk)
+                sent += len(chunk)
+                continue
+            step = max(1024, int(self.bandwidth * BANDWIDTH_INTERVAL))
+            for offset in range(0, len(chunk), step):
+                part = chunk[offset:offset + step]
+                write(part)
+                sent += len(part)
+                ahead = sent / self.bandwidth - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return sent
+
+
+class MockServices:
+
+    def __init__(self, corpus_dir, faults=None, host='127.0.0.1', http_port=0, ftp_port=0):
+        self.corpus_dir = corpus_dir
+        self.faults = faults or Faults()
+        with open(f"{corpus_dir}/corpus.json") as file:
+            corpus = json.load(file)
+        self.collection_id = corpus['collection_id']
+        self.pages = corpus['pages']
+        # edm id -> title, of the newspapers
+        with open(f"{corpus_dir}/titles.json") as file:
+            self.titles = json.load(file)
+        self.issues = list_issues(corpus_dir, self.collection_id)
+        self.issue_set = set(self.issues)
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+        self.http_server = ThreadingHTTPServer((host, http_port), HttpHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.services = self
+        self.ftp_server = socketserver.ThreadingTCPServer((host, ftp_port), FtpHandler)
+        self.ftp_server.daemon_threads = True
+        self.ftp_server.services = self
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        for server in [self.http_server, self.ftp_server]:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        for server in [self.http_server, self.ftp_server]:
+            server.shutdown()
+            server.server_close()
+
+    @property
+    def http_url(self):
+        host, port = self.http_server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def ftp_url(self):
+        host, port = self.ftp_server.server_address[:2]
+        return f"ftp://{host}:{port}/"
+
+    def environment(self):
+        # for the pipelines
+        return {
+            'RECORD_API_URL': f"{self.http_url}/record/v2",
+            'SEARCH_API_URL': f"{self.http_url}/record/v2/search.json",
+            'IIIF_API_URL': self.http_url,
+            'DUMP_FTP_BASE_URL': self.ftp_url
+        }
+
+    def manifest_urls(self):
+        return [f"{self.http_url}/presentation/{self.collection_id}/{issue}/manifest" for issue in self.issues]
+
+    def count(self, name, value=1):
+        with self.stats_lock:
+            self.stats[name] += value
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {'requests': 0, 'dropped': 0, 'throttled': 0, 'failed': 0, 'bytes': 0}
+
+    # --------- Content ---------
+
+    def get_record(self, edm_id):
+        title = self.titles.get(edm_id, None)
+        if title is None:
+            return None
+        return {'success': True, 'object': {'about': f"/{edm_id}", 'proxies': [{'dcTitle': {'def': [title]}}]}}
+
+    def search(self, query):
+        edm_ids = re.findall(r'europeana_id:"/([^"]+)"', query)
+        items = []
+        for edm_id in edm_ids:
+            title = self.titles.get(edm_id, None)
+            if title:
+                items += [{'id': f"/{edm_id}", 'title': [title], 'dcTitleLangAware': {'def': [title]}}]
+        return {'success': True, 'itemsCount': len(items), 'totalResults': len(items), 'items': items}
+
+    def get_manifest(self, issue):
+        base_url = f"{self.http_url}/presentation/{self.collection_id}/{issue}"
+        canvases = [{'@id': f"{base_url}/canvas/p{page}", 'label': f"{page}",
+                     'otherContent': [f"{base_url}/annopage/{page}"]} for page in range(1, self.pages + 1)]
+        return {'@id': f"{base_url}/manifest", 'sequences': [{'canvases': canvases}]}
+
+    def get_annotation_list(self, issue, page):
+        fulltext_url = f"https://www.europeana.eu/api/fulltext/{self.collection_id}/{issue}/page{page}"
+        return {'resources': [{'dcType': 'Page', 'resource': {'@id': fulltext_url}}]}
+
+    def get_json(self, path, query):
+        # (status, document) for a GET request
+        record_match = re.fullmatch(r'/record/v2/(\d+/\w+)\.json', path)
+        manifest_match = re.fullmatch(rf'/presentation/{self.collection_id}/(\w+)/manifest', path)
+        annotation_match = re.fullmatch(rf'/presentation/{self.collection_id}/(\w+)/annopage/(\d+)', path)
+        document = None
+        if path == '/record/v2/search.json':
+            document = self.search(' '.join(query.get('query', [])))
+        elif record_match:
+            document = self.get_record(record_match[1])
+        elif manifest_match and manifest_match[1] in self.issue_set:
+            document = self.get_manifest(manifest_match[1])
+        elif annotation_match and annotation_match[1] in self.issue_set and int(annotation_match[2]) <= self.pages:
+            document = self.get_annotation_list(annotation_match[1], int(annotation_match[2]))
+        if document is None:
+            return 404, {'success': False, 'error': f"Not found: {path}"}
+        return 200, document
+
+
+class HttpHandler(BaseHTTPRequestHandler):
+    # keep-alive, as the real services
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        services = self.server.services
+        faults = services.faults
+        services.count('requests')
+        faults.delay()
+        fault = faults.pick()
+        if fault == 'drop':
+            services.count('dropped')
+            self.close_connection = True
+            return
+        if fault == 'throttle':
+            services.count('throttled')
+            self.send_body(429, {'error': 'Too many requests'}, {'Retry-After': str(faults.retry_after)})
+            return
+        if fault == 'error':
+            services.count('failed')
+            self.send_body(503, {'error': 'Service unavailable'})
+            return
+
+        parsed_url = urlparse(self.path)
+        status, document = services.get_json(parsed_url.path, parse_qs(parsed_url.query))
+        self.send_body(status, document)
+
+    def send_body(self, status, document, headers=None):
+        body = json.dumps(document).encode('utf-8')
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if status == 200 and self.headers.get('If-None-Match', None) == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status in [200, 304]:
+            self.send_header('ETag', etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.server.services.count('bytes', self.server.services.faults.send(self.wfile.write, [body]))
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Just enough of FTP for ftplib: login, CWD/PWD, TYPE, PASV/EPSV, SIZE and RETR of the files in the full text
+# directory of the corpus
+class FtpHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.services = self.server.services
+        self.root = os.path.realpath(f"{self.services.corpus_dir}/fulltext")
+        self.directory = '/'
+        self.data_listener = None
+        if self.services.faults.pick() == 'throttle':
+            self.services.count('throttled')
+            self.reply(421, 'Too many connections')
+            return
+        self.reply(220, 'Mock Europeana FTP server')
+        try:
+            for line in self.rfile:
+                command, _, argument = line.decode('utf-8', errors='replace').strip().partition(' ')
+                command = command.upper()
+                if command == 'QUIT':
+                    self.reply(221, 'Bye')
+                    break
+                handler = getattr(self, f"ftp_{command.lower()}", None)
+                if handler is None:
+                    self.reply(502, f"{command} not implemented")
+                else:
+                    handler(argument)
+        finally:
+            if self.data_listener:
+                self.data_listener.close()
+
+    def reply(self, code, text):
+        self.services.faults.delay()
+        self.wfile.write(f"{code} {text}\r\n".encode('utf-8'))
+
+    def resolve(self, path):
+        # (path as seen by the client, path on disk)
+        client_path = os.path.normpath(os.path.join(self.directory, path or '.'))
+        return client_path, os.path.join(self.root, client_path.lstrip('/'))
+
+    def ftp_user(self, argument):
+        self.reply(331, 'Password required')
+
+    def ftp_pass(self, argument):
+        self.reply(230, 'Logged in')
+
+    def ftp_type(self, argument):
+        self.reply(200, f"Type set to {argument}")
+
+    def ftp_noop(self, argument):
+        self.reply(200, 'OK')
+
+    def ftp_pwd(self, argument):
+        self.reply(257, f'"{self.directory}"')
+
+    def ftp_cwd(self, argument):
+        client_path, path = self.resolve(argument)
+        if os.path.isdir(path):
+            self.directory = client_path
+            self.reply(250, 'Directory changed')
+        else:
+            self.reply(550, 'No such directory')
+
+    def ftp_size(self, argument):
+        _, path = self.resolve(argument)
+        if os.path.isfile(path):
+            self.reply(213, str(os.path.getsize(path)))
+        else:
+            self.reply(550, 'No such file')
+
+    def open_data_listener(self):
+        if self.data_listener:
+            self.data_listener.close()
+        self.data_listener = socket.create_server((self.connection.getsockname()[0], 0))
+        self.data_listener.settimeout(30)
+        return self.data_listener.getsockname()[:2]
+
+    def ftp_pasv(self, argument):
+        host, port = self.open_data_listener()
+        self.reply(227, f"Entering Passive Mode ({host.replace('.', ',')},{port >> 8},{port & 0xff})")
+
+    def ftp_epsv(self, argument):
+        _, port = self.open_data_listener()
+        self.reply(229, f"Entering Extended Passive Mode (|||{port}|)")
+
+    def ftp_retr(self, argument):
+        _, path = self.resolve(argument)
+        if not os.path.isfile(path):
+            self.reply(550, 'No such file')
+            return
+        if self.data_listener is None:
+            self.reply(425, 'Use PASV first')
+            return
+        self.services.count('requests')
+        fault = self.services.faults.pick()
+        if fault in ['error', 'throttle']:
+            self.services.count('failed')
+            self.reply(451, 'Local error in processing')
+            return
+
+        size = os.path.getsize(path)
+        # a dropped download ends somewhere halfway
+        limit = int(size * self.services.faults.random.random()) if fault == 'drop' else size
+        self.reply(150, f"Opening BINARY mode data connection for {argument} ({size} bytes)")
+        connection, _ = self.data_listener.accept()
+        self.data_listener.close()
+        self.data_listener = None
+        try:
+            self.services.count('bytes', self.services.faults.send(connection.sendall, read_blocks(path, limit)))
+        finally:
+            connection.close()
+        if fault == 'drop':
+            self.services.count('dropped')
+            self.reply(426, 'Connection closed; transfer aborted')
+        else:
+            self.reply(226, 'Transfer complete')
+
+
+def list_issues(corpus_dir, collection_id):
+    # local ids of the issues (BibliographicResource_...), from the metadata dump
+    with zipfile.ZipFile(f"{corpus_dir}/metadata/{collection_id}.zip") as archive:
+        return [os.path.splitext(os.path.basename(name))[0] for name in archive.namelist() if name.endswith('.xml')]
+
+
+def read_blocks(path, limit):
+    # the first limit bytes of a file
+    with open(path, 'rb') as file:
+        while limit > 0:
+            block = file.read(min(FTP_BLOCK_SIZE, limit))
+            if not block:
+                break
+            limit -= len(block)
+            yield block
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Europeana record API, IIIF API and FTP server")
+    parser.add_argument('corpus', help="corpus directory (see synthetic_corpus.py)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--http-port', type=int, default=8080)
+    parser.add_argument('--ftp-port', type=int, default=2121)
+    add_fault_arguments(parser)
+    arguments = parser.parse_args()
+
+    with MockServices(arguments.corpus, make_faults(arguments), arguments.host, arguments.http_port,
+                      arguments.ftp_port) as services:
+        print(f"Serving {len(services.issues)} issues of collection {services.collection_id}, "
+              f"{len(services.titles)} newspaper records")
+        for name, value in services.environment().items():
+            print(f"{name}={value}")
+        try:
+            while True:
+                time.sleep(60)
+                print(f"{services.stats}")
+        except KeyboardInterrupt:
+            pass
+
+
+def add_fault_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra latency, up to these seconds")
+    parser.add_argument('--bandwidth', type=int, default=0, help="bytes per second and connection (0 = no limit)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests failing with 503 (or 451)")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="share of requests throttled with 429")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="share of requests with a dropped connection")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After of throttled requests (seconds)")
+    parser.add_argument('--seed', type=int, default=None, help="random seed of the faults")
+
+
+def make_faults(arguments):
+    return Faults(arguments.latency, arguments.jitter, arguments.bandwidth, arguments.error_rate,
+                  arguments.throttle_rate, arguments.drop_rate, arguments.retry_after, arguments.seed)
+
+
+if __name__ == "__main__":
+    main()
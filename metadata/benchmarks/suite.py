@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from datetime import datetime, timezone
+from io import BytesIO
+
+# Benchmarks of the main steps of both pipelines on a synthetic corpus (see synthetic_corpus.py), without network
+# access: indexing EDM metadata (make_md_index, from a directory and from a dump archive), generating CMDI records
+# (generate_cmdi_records), writing a large record (write_xml_tree_to_file), parsing full text EDM (process_xml) and
+# extracting a full text dump (stream_unzip). Every case runs in a process of its own, so that peak RSS is that of the
+# case (its largest process); throughput is taken from the fastest of the repeats.
+#
+# Usage: python3 benchmarks/suite.py run [--scale small|medium|large] [--corpus DIR] [--output FILE]
+#                                        [--only CASE ...] [--repeat N] [--workers N]
+#        python3 benchmarks/suite.py compare BASELINE.json RESULTS.json [--threshold 0.1]
+#
+# compare exits with status 1 if a case got slower or uses more memory than the threshold (a fraction) allows.
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+METADATA_SRC_DIR = os.path.join(BENCHMARKS_DIR, '..', 'image', 'src')
+TEXT_SRC_DIR = os.path.join(BENCHMARKS_DIR, '..', '..', 'text', 'image', 'src')
+
+# arguments of generate_corpus
+SCALES = {
+    'small': {'titles': 5, 'years': 3, 'issues_per_year': 24, 'pages': 2, 'page_size': 2000},
+    'medium': {'titles': 20, 'years': 5, 'issues_per_year': 52, 'pages': 4, 'page_size': 4000},
+    'large': {'titles': 50, 'years': 10, 'issues_per_year': 150, 'pages': 8, 'page_size': 4000}
+}
+
+# records written by the write_xml_tree_to_file case
+XML_WRITES = 50
+
+
+def setup_metadata_case(corpus_dir, workers):
+    sys.path.insert(0, METADATA_SRC_DIR)
+    os.environ.setdefault('RECORD_API_KEY', 'benchmark')
+    os.environ.setdefault('CMDI_RECORDS_BASE_URL', 'http://localhost/cmdi')
+    # titles from the corpus, no API requests
+    os.environ['TITLE_CACHE_FILE'] = f"{corpus_dir}/title_cache.db"
+    os.environ['FILE_PROCESSING_THREAD_POOL_SIZE'] = str(workers)
+    os.environ['CMDI_GENERATION_THREAD_POOL_SIZE'] = str(workers)
+
+
+def setup_text_case(corpus_dir):
+    sys.path.insert(0, TEXT_SRC_DIR)
+    os.environ['DUMP_BASE_PATH'] = f"{corpus_dir}/fulltext"
+
+
+def get_collection_id(corpus_dir):
+    with open(f"{corpus_dir}/corpus.json") as file:
+        return json.load(file)['collection_id']
+
+
+def get_directory_size(directory):
+    return sum(os.path.getsize(f"{root}/{name}") for root, _, names in os.walk(directory) for name in names)
+
+
+# --------- Cases: each returns (seconds, items, bytes) ---------
+
+
+def make_md_index_case(corpus_dir, workers, archive=False):
+    setup_metadata_case(corpus_dir, workers)
+    from aggregate_collection import make_md_index
+
+    collection_id = get_collection_id(corpus_dir)
+    metadata_dir = f"{corpus_dir}/metadata/{collection_id}"
+    source = f"{metadata_dir}.zip" if archive else metadata_dir
+    start = time.perf_counter()
+    make_md_index(source)
+    seconds = time.perf_counter() - start
+    return seconds, len(os.listdir(metadata_dir)), get_directory_size(metadata_dir)
+
+
+def make_md_index_archive_case(corpus_dir, workers):
+    return make_md_index_case(corpus_dir, workers, archive=True)
+
+
+def generate_cmdi_records_case(corpus_dir, workers):
+    setup_metadata_case(corpus_dir, workers)
+    from aggregate_collection import make_md_index, generate_cmdi_records
+
+    collection_id = get_collection_id(corpus_dir)
+    index = make_md_index(f"{corpus_dir}/metadata/{collection_id}")
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as output_dir:
+        start = time.perf_counter()
+        generate_cmdi_records(collection_id, index, output_dir)
+        seconds = time.perf_counter() - start
+        return seconds, len(os.listdir(output_dir)), get_directory_size(output_dir)
+
+
+def write_xml_tree_to_file_case(corpus_dir, workers):
+    setup_metadata_case(corpus_dir, workers)
+    from aggregate_collection import make_md_index, get_templates, write_xml_tree_to_file
+    from aggregation_cmdi_creation import make_cmdi_record
+
+    # the title/year group with the most issues
+    collection_id = get_collection_id(corpus_dir)
+    index = make_md_index(f"{corpus_dir}/metadata/{collection_id}")
+    title, year = max(((title, year) for title in index for year in index[title]),
+                      key=lambda group: len(index[group[0]][group[1]]))
+    template, _ = get_templates()
+    records = index[title][year]
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as output_dir:
+        file_name = f"{output_dir}/record.xml"
+        start = time.perf_counter()
+        for _ in range(XML_WRITES):
+            # a record can only be written once (namespaces are cleaned up in place)
+            write_xml_tree_to_file(make_cmdi_record(file_name, template, collection_id, title, year, records),
+                                   file_name)
+        seconds = time.perf_counter() - start
+        return seconds, XML_WRITES, XML_WRITES * os.path.getsize(file_name)
+
+
+def process_xml_case(corpus_dir, workers):
+    setup_text_case(corpus_dir)
+    from retrieve_and_extract import process_xml
+
+    # read up front, only parsing is timed
+    collection_id = get_collection_id(corpus_dir)
+    with zipfile.ZipFile(f"{corpus_dir}/fulltext/{collection_id}.zip") as archive:
+        files = [(name, archive.read(name)) for name in archive.namelist()]
+    id_file_map = {}
+    start = time.perf_counter()
+    for name, xml in files:
+        process_xml(BytesIO(xml), id_file_map, f"{os.path.splitext(os.path.basename(name))[0]}.txt")
+    seconds = time.perf_counter() - start
+    return seconds, len(files), sum(len(xml) for _, xml in files)
+
+
+def stream_unzip_case(corpus_dir, workers):
+    setup_text_case(corpus_dir)
+    from stream_unzip import stream_unzip
+    from retrieve_and_extract import zipped_chunks_local, read_file_from_zip
+
+    count = 0
+    size = 0
+    start = time.perf_counter()
+    for file_name, _, unzipped_chunks in stream_unzip(zipped_chunks_local(get_collection_id(corpus_dir))):
+        size += len(read_file_from_zip(file_name, unzipped_chunks))
+        count += 1
+    seconds = time.perf_counter() - start
+    return seconds, count, size
+
+
+CASES = {
+    'make_md_index': make_md_index_case,
+    'make_md_index_archive': make_md_index_archive_case,
+    'generate_cmdi_records': generate_cmdi_records_case,
+    'write_xml_tree_to_file': write_xml_tree_to_file_case,
+    'process_xml': process_xml_case,
+    'stream_unzip': stream_unzip_case
+}
+
+
+def run_case(name, corpus_dir, workers):
+    # in the process of the case: result as JSON on the last line of the output
+    seconds, items, size = CASES[name](corpus_dir, workers)
+    print(json.dumps({'seconds': seconds, 'items': items, 'bytes': size}))
+
+
+def measure_case(name, corpus_dir, workers, repeat):
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryFile('w+') as log:
+            process = subprocess.Popen([sys.executable, os.path.realpath(__file__), 'case', name, corpus_dir,
+                                        '--workers', str(workers)], stdout=subprocess.PIPE, stderr=log, text=True)
+            output = process.stdout.read()
+            process.stdout.close()
+            # waited for here, for the resource usage of the case: ru_maxrss (in kilobytes on Linux) is the peak RSS
+            # of the largest of the case process and its pool workers
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode != 0:
+                log.seek(0)
+                sys.stderr.write(log.read())
+                raise RuntimeError(f"Benchmark {name} failed with exit status {process.returncode}")
+        run = json.loads(output.strip().splitlines()[-1])
+        run['peak_rss_mib'] = usage.ru_maxrss / 1024
+        runs += [run]
+    fastest = min(runs, key=lambda run: run['seconds'])
+    return {
+        'seconds': fastest['seconds'],
+        'seconds_all': [run['seconds'] for run in runs],
+        'items': fastest['items'],
+        'bytes': fastest['bytes'],
+        'items_per_second': fastest['items'] / fastest['seconds'],
+        'mib_per_second': fastest['bytes'] / 1024 / 1024 / fastest['seconds'],
+        'peak_rss_mib': max(run['peak_rss_mib'] for run in runs)
+    }
+
+
+def run_suite(arguments):
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from synthetic_corpus import generate_corpus, load_corpus_summary
+
+    corpus_dir = arguments.corpus or f"{tempfile.gettempdir()}/europeana-benchmark-{arguments.scale}"
+    corpus = load_corpus_summary(corpus_dir)
+    if corpus is None:
+        print(f"Generating {arguments.scale} corpus in {corpus_dir}")
+        corpus = generate_corpus(corpus_dir, **SCALES[arguments.scale])
+
+    results = {}
+    print(f"{corpus['issues']} issues, {arguments.workers} worker(s), best of {arguments.repeat}")
+    print_row('case', 'seconds', 'items/s', 'MiB/s', 'peak RSS MiB')
+    for name in arguments.only or CASES:
+        result = results[name] = measure_case(name, corpus_dir, arguments.workers, arguments.repeat)
+        print_row(name, f"{result['seconds']:.3f}", f"{result['items_per_second']:,.1f}",
+                  f"{result['mib_per_second']:,.2f}", f"{result['peak_rss_mib']:,.1f}")
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'workers': arguments.workers,
+        'repeat': arguments.repeat,
+        'corpus': corpus,
+        'cases': results
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {arguments.output}")
+
+
+def compare(arguments):
+    with open(arguments.baseline) as file:
+        baseline = json.load(file)
+    with open(arguments.results) as file:
+        results = json.load(file)
+    if baseline['corpus'] != results['corpus'] or baseline['workers'] != results['workers']:
+        print("Warning: the runs are not on the same corpus and/or number of workers")
+
+    regressions = []
+    print_row('case', 'seconds', 'ratio', 'peak RSS MiB', 'ratio', '')
+    for name, result in results['cases'].items():
+        base = baseline['cases'].get(name, None)
+        if base is None:
+            print_row(name, f"{result['seconds']:.3f}", 'new', f"{result['peak_rss_mib']:,.1f}", 'new', '')
+            continue
+        time_ratio = result['seconds'] / base['seconds']
+        rss_ratio = result['peak_rss_mib'] / base['peak_rss_mib']
+        slower = time_ratio > 1 + arguments.threshold
+        larger = rss_ratio > 1 + arguments.threshold
+        print_row(name, f"{result['seconds']:.3f}", f"{time_ratio:.2f}", f"{result['peak_rss_mib']:,.1f}",
+                  f"{rss_ratio:.2f}", ' '.join(filter(None, ['SLOWER' if slower else '', 'LARGER' if larger else ''])))
+        if slower or larger:
+            regressions += [name]
+
+    if regressions:
+        print(f"Regressions (threshold {arguments.threshold:.0%}): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+def print_row(*values):
+    print(f"{values[0]:<24}" + ''.join(f"{value:>14}" for value in values[1:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the aggregation and extraction pipelines")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run the benchmarks")
+    run_parser.add_argument('--scale', choices=SCALES, default='small', help="size of the generated corpus")
+    run_parser.add_argument('--corpus', help="corpus directory (generated if there is no corpus yet)")
+    run_parser.add_argument('--output', help="JSON file for the results")
+    run_parser.add_argument('--only', nargs='+', choices=CASES, help="cases to run (default: all)")
+    run_parser.add_argument('--repeat', type=int, default=3, help="runs per case")
+    run_parser.add_argument('--workers', type=int, default=1, help="pool size")
+
+    compare_parser = commands.add_parser('compare', help="compare the results of two runs")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help="allowed increase (fraction)")
+
+    # run by 'run', in a process of its own
+    case_parser = commands.add_parser('case')
+    case_parser.add_argument('name', choices=CASES)
+    case_parser.add_argument('corpus')
+    case_parser.add_argument('--workers', type=int, default=1)
+
+    arguments = parser.parse_args()
+    if arguments.command == 'run':
+        run_suite(arguments)
+    elif arguments.command == 'compare':
+        compare(arguments)
+    else:
+        run_case(arguments.name, arguments.corpus, arguments.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import random
+import sys
+import zipfile
+
+from xml.sax.saxutils import escape
+
+# Generates a synthetic Europeana newspaper collection: EDM metadata files (as a directory and as a dump archive),
+# a full text dump (EDM with the text of each issue) and the titles of the newspapers (JSON, and as a title cache so
+# that aggregation needs no API). Issues are numbered like the real BibliographicResource identifiers; the same
+# arguments (and seed) give the same corpus.
+#
+# Usage: python3 benchmarks/synthetic_corpus.py <output dir> [--titles N] [--years N] [--issues-per-year N]
+#                                                [--pages N] [--page-size characters] [--seed N]
+#
+# Layout of the output directory:
+#   metadata/<collection id>/      EDM metadata files
+#   metadata/<collection id>.zip   the same, as metadata dump
+#   fulltext/<collection id>.zip   full text dump
+#   titles.json                    parent record (edm id) -> newspaper title
+#   title_cache.db                 the same, as title cache (TITLE_CACHE_FILE)
+#   corpus.json                    the arguments and totals
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'image', 'src'))
+
+COLLECTION_ID = '9200396'
+FIRST_ISSUE = 3000118000000
+FIRST_PARENT = 3000095000000
+FIRST_YEAR = 1830
+
+TITLE_WORDS = [('Gazeta', 'pl'), ('Kurjer', 'pl'), ('Zeitung', 'de'), ('Presse', 'de'), ('Journal', 'fr'),
+               ('Courrier', 'fr'), ('Dagblad', 'nl'), ('Courant', 'nl'), ('Sanomat', 'fi'), ('Avīze', 'lv')]
+TITLE_QUALIFIERS = ['Neue', 'Freie', 'Warszawska', 'Lwowska', 'du Soir', 'de Paris', 'Algemeen', 'Helsingin',
+                    'Latviešu', 'Illustrirte', 'Codzienna', 'Provinciale']
+COUNTRIES = {'pl': 'Poland', 'de': 'Germany', 'fr': 'France', 'nl': 'Netherlands', 'fi': 'Finland', 'lv': 'Latvia'}
+PROVIDERS = ['National Library of Poland', 'Austrian National Library', 'National Library of France',
+             'National Library of the Netherlands', 'National Library of Finland', 'National Library of Latvia']
+RIGHTS = ['http://creativecommons.org/publicdomain/mark/1.0/', 'http://rightsstatements.org/vocab/NoC-NC/1.0/',
+          'http://rightsstatements.org/vocab/InC/1.0/']
+TEXT_WORDS = ['der', 'die', 'und', 'le', 'la', 'les', 'de', 'het', 'een', 'w', 'na', 'się', 'ja', 'on', 'ir',
+              'Regierung', 'gouvernement', 'regering', 'rząd', 'hallitus', 'valdība', 'Stadt', 'ville', 'miasto',
+              'Nachrichten', 'nouvelles', 'berichten', 'wiadomości', 'uutiset', 'ziņas', 'Markt', 'marché',
+              'Theater', 'théâtre', 'Bahnhof', 'gare', 'Kaiser', 'roi', 'koning', 'król', '1848', '12', 'fl.', 'Fr.']
+
+METADATA_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" \
+xmlns:edm="http://www.europeana.eu/schemas/edm/" xmlns:ore="http://www.openarchives.org/ore/terms/" \
+xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+{sections}</rdf:RDF>
+'''
+
+PROVIDER_SECTIONS_TEMPLATE = '''  <edm:ProvidedCHO rdf:about="http://data.europeana.eu/item/{edm_id}">
+    <dc:title>{issue_title}</dc:title>
+  </edm:ProvidedCHO>
+  <ore:Aggregation rdf:about="http://data.europeana.eu/aggregation/provider/{edm_id}">
+    <edm:aggregatedCHO rdf:resource="http://data.europeana.eu/item/{edm_id}"/>
+    <edm:dataProvider>{provider}</edm:dataProvider>
+    <edm:provider>The European Library</edm:provider>
+    <edm:rights rdf:resource="{rights}"/>
+  </ore:Aggregation>
+  <ore:Proxy rdf:about="http://data.europeana.eu/proxy/provider/{edm_id}">
+    <dc:identifier>http://data.theeuropeanlibrary.org/BibliographicResource/{identifier}</dc:identifier>
+    <dc:language>{language}</dc:language>
+    <dc:publisher>{publisher}</dc:publisher>
+    <dc:title>{issue_title}</dc:title>
+    <dc:type>Newspaper</dc:type>
+    <dc:type>Text</dc:type>
+    <dcterms:issued>{date}</dcterms:issued>
+{part_of}  </ore:Proxy>
+'''
+
+EUROPEANA_SECTIONS_TEMPLATE = '''  <ore:Proxy rdf:about="http://data.europeana.eu/proxy/europeana/{edm_id}">
+    <edm:europeanaProxy>true</edm:europeanaProxy>
+    <dc:language>{language}</dc:language>
+  </ore:Proxy>
+  <edm:EuropeanaAggregation rdf:about="http://data.europeana.eu/aggregation/europeana/{edm_id}">
+    <edm:country>{country}</edm:country>
+    <edm:landingPage rdf:resource="https://www.europeana.eu/item/{edm_id}"/>
+  </edm:EuropeanaAggregation>
+'''
+
+# every so many issues, the Europeana sections come before those of the provider (EDM does not fix an order)
+EUROPEANA_FIRST_INTERVAL = 10
+
+PART_OF_TEMPLATE = '''    <dcterms:isPartOf rdf:resource="http://data.europeana.eu/item/{parent_edm_id}"/>
+'''
+
+FULLTEXT_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" \
+xmlns:edm="http://www.europeana.eu/schemas/edm/" xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" \
+xml:base="http://data.europeana.eu/annotation/{edm_id}">
+  <edm:FullTextResource rdf:about="http://data.europeana.eu/fulltext/{edm_id}/{identifier}">
+    <dc:language>{language}</dc:language>
+    <dcterms:isPartOf rdf:resource="http://data.europeana.eu/item/{edm_id}"/>
+    <rdf:value>{text}</rdf:value>
+  </edm:FullTextResource>
+</rdf:RDF>
+'''
+
+
+def make_titles(count, rng):
+    # (title, language, parent edm id or None); some newspapers have no parent record, their issues are grouped by
+    # the (normalised) issue title
+    titles = []
+    for t in range(count):
+        word, language = TITLE_WORDS[t % len(TITLE_WORDS)]
+        title = f"{rng.choice(TITLE_QUALIFIERS)} {word} {t + 1}"
+        parent = f"{COLLECTION_ID}/BibliographicResource_{FIRST_PARENT + t}" if t % 5 != 4 else None
+        titles += [(title, language, parent)]
+    return titles
+
+
+def iterate_issues(titles, years, issues_per_year, rng):
+    identifier = FIRST_ISSUE
+    for t, (title, language, parent) in enumerate(titles):
+        first_year = FIRST_YEAR + (t * 7) % 60
+        for year in range(first_year, first_year + years):
+            # issues spread over the year
+            for i in range(issues_per_year):
+                day_of_year = i * 365 // issues_per_year
+                month, day = min(12, day_of_year // 31 + 1), day_of_year % 28 + 1
+                identifier += 1
+                yield {
+                    'identifier': str(identifier),
+                    'edm_id': f"{COLLECTION_ID}/BibliographicResource_{identifier}",
+                    'title': title,
+                    'language': language,
+                    'parent': parent,
+                    'date': f"{year}-{month:02d}-{day:02d}",
+                    'provider': PROVIDERS[t % len(PROVIDERS)],
+                    'publisher': f"{title.split(' ')[-2]} Verlag" if t % 2 else f"Imprimerie {t + 1}",
+                    'rights': RIGHTS[(t + year) % len(RIGHTS)],
+                    'random': rng.random()
+                }
+
+
+def make_metadata_record(issue):
+    part_of = PART_OF_TEMPLATE.format(parent_edm_id=issue['parent']) if issue['parent'] else ''
+    provider_sections = PROVIDER_SECTIONS_TEMPLATE.format(edm_id=issue['edm_id'], identifier=issue['identifier'],
+                                                          issue_title=escape(f"{issue['title']} - {issue['date']}"),
+                                                          provider=escape(issue['provider']), rights=issue['rights'],
+                                                          language=issue['language'],
+                                                          publisher=escape(issue['publisher']), date=issue['date'],
+                                                          part_of=part_of)
+    europeana_sections = EUROPEANA_SECTIONS_TEMPLATE.format(edm_id=issue['edm_id'], language=issue['language'],
+                                                            country=COUNTRIES.get(issue['language'], 'Europe'))
+    if int(issue['identifier']) % EUROPEANA_FIRST_INTERVAL == 0:
+        return METADATA_TEMPLATE.format(sections=europeana_sections + provider_sections)
+    return METADATA_TEMPLATE.format(sections=provider_sections + europeana_sections)
+
+
+def make_text(pages, page_size, rng):
+    # pages of 'words', separated by blank lines
+    page_texts = []
+    for _ in range(pages):
+        words = []
+        length = 0
+        while length < page_size:
+            word = rng.choice(TEXT_WORDS)
+            words += [word]
+            length += len(word) + 1
+        page_texts += [' '.join(words)[:page_size]]
+    return '\n\n'.join(page_texts)
+
+
+def make_fulltext_record(issue, text):
+    return FULLTEXT_TEMPLATE.format(edm_id=issue['edm_id'], identifier=issue['identifier'],
+                                    language=issue['language'], text=escape(text))
+
+
+def generate_corpus(output_dir, titles=20, years=5, issues_per_year=52, pages=4, page_size=4000, seed=1,
+                    collection_id=COLLECTION_ID):
+    rng = random.Random(seed)
+    metadata_dir = f"{output_dir}/metadata/{collection_id}"
+    fulltext_dir = f"{output_dir}/fulltext"
+    os.makedirs(metadata_dir, exist_ok=True)
+    os.makedirs(fulltext_dir, exist_ok=True)
+
+    title_list = make_titles(titles, rng)
+    count = 0
+    fulltext_bytes = 0
+    with zipfile.ZipFile(f"{output_dir}/metadata/{collection_id}.zip", 'w', zipfile.ZIP_DEFLATED) as metadata_zip, \
+            zipfile.ZipFile(f"{fulltext_dir}/{collection_id}.zip", 'w', zipfile.ZIP_DEFLATED) as fulltext_zip:
+        for issue in iterate_issues(title_list, years, issues_per_year, rng):
+            file_name = f"BibliographicResource_{issue['identifier']}.xml"
+            record = make_metadata_record(issue).encode('utf-8')
+            with open(f"{metadata_dir}/{file_name}", 'wb') as file:
+                file.write(record)
+            metadata_zip.writestr(f"{collection_id}/{file_name}", record)
+
+            # text size varies per issue, around the given page size
+            text = make_text(pages, int(page_size * (0.5 + issue['random'])), rng)
+            fulltext = make_fulltext_record(issue, text).encode('utf-8')
+            fulltext_zip.writestr(f"{collection_id}/{file_name}", fulltext)
+            fulltext_bytes += len(fulltext)
+            count += 1
+
+    parent_titles = {parent: title for title, _, parent in title_list if parent}
+    with open(f"{output_dir}/titles.json", 'w') as file:
+        json.dump(parent_titles, file, indent=2)
+    write_title_cache(f"{output_dir}/title_cache.db", parent_titles)
+
+    summary = {
+        'collection_id': collection_id, 'titles': titles, 'years': years, 'issues_per_year': issues_per_year,
+        'pages': pages, 'page_size': page_size, 'seed': seed,
+        'issues': count, 'fulltext_bytes': fulltext_bytes
+    }
+    with open(f"{output_dir}/corpus.json", 'w') as file:
+        json.dump(summary, file, indent=2)
+    return summary
+
+
+def write_title_cache(path, parent_titles):
+    # only imported here, needs the sources of the image
+    from title_cache import TitleCache
+    if os.path.exists(path):
+        os.remove(path)
+    with TitleCache(path) as cache:
+        cache.put_many(parent_titles)
+
+
+def load_corpus_summary(output_dir):
+    # None if there is no (complete) corpus in output_dir
+    try:
+        with open(f"{output_dir}/corpus.json") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Europeana newspaper collection")
+    parser.add_argument('output_dir', help="output directory")
+    parser.add_argument('--titles', type=int, default=20, help="number of newspapers")
+    parser.add_argument('--years', type=int, default=5, help="years per newspaper")
+    parser.add_argument('--issues-per-year', type=int, default=52, help="issues per newspaper and year")
+    parser.add_argument('--pages', type=int, default=4, help="pages of text per issue")
+    parser.add_argument('--page-size', type=int, default=4000, help="characters of text per page (on average)")
+    parser.add_argument('--seed', type=int, default=1, help="random seed")
+    arguments = parser.parse_args()
+
+    summary = generate_corpus(arguments.output_dir, arguments.titles, arguments.years, arguments.issues_per_year,
+                              arguments.pages, arguments.page_size, arguments.seed)
+    print(f"{summary['issues']} issues of {summary['titles']} newspapers in {arguments.output_dir}, "
+          f"{summary['fulltext_bytes'] / 1024 / 1024:,.1f} MiB of full text")
+
+
+if __name__ == "__main__":
+    main()
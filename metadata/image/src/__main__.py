@@ -1,6 +1,11 @@
 import aggregate_collection
+import argparse
 import logging
-import sys
+import metrics
+import profiling
+
+from env import METRICS_JSON_FILE, METRICS_PROMETHEUS_FILE
+from env import PROFILE_DIR, PROFILE_MEMORY, PROFILE_TOP_N
 
 logger = logging.getLogger(__name__)
 
@@ -9,22 +14,56 @@ def main():
     logging.basicConfig()
     logger.setLevel(logging.INFO)
 
-    if len(sys.argv) < 3:
-        print("ERROR: Provide collection id and locations for input and output")
-        print_usage()
-        exit(1)
-
-    arguments = sys.argv[1:]
-    logger.info(f"Arguments: {arguments}")
-    aggregate_collection.aggregate(arguments[0], arguments[1], arguments[2])
-
+    parser = argparse.ArgumentParser(description="Aggregate Europeana newspaper metadata into CMDI records")
+    parser.add_argument('collection_id', help="collection id")
+    parser.add_argument('metadata_dir', help="directory with the EDM metadata files, or the metadata dump (ZIP)")
+    parser.add_argument('output_dir', nargs='?',
+                        help="output directory for the CMDI records (optional with --archive)")
+    parser.add_argument('--archive', dest='archive_file',
+                        help="write the CMDI records to this ZIP archive, records are compressed in parallel")
+    parser.add_argument('--previous-archive', dest='previous_archive_file',
+                        help="archive written by a previous run, unchanged records are carried over from here")
+    parser.add_argument('--previous-output', dest='previous_output_dir',
+                        help="output of a previous run, unchanged records are carried over from here")
+    parser.add_argument('--previous-manifest', dest='previous_manifest_file',
+                        help="manifest written by a previous run (see --manifest)")
+    parser.add_argument('--manifest', dest='manifest_file',
+                        help="write a manifest of inputs and outputs to this file")
+    parser.add_argument('--index', dest='index_file',
+                        help="store the collection index in this file (or read it from here with --from-index)")
+    parser.add_argument('--index-only', action='store_true',
+                        help="only make (and store) the index, do not generate CMDI records")
+    parser.add_argument('--from-index', action='store_true',
+                        help="generate CMDI records from a stored index instead of reading the metadata")
+    arguments = parser.parse_args()
 
-def print_usage():
-    print(f"""
-    Usage:
-        {sys.executable} {__file__} <collection id> <metadata path> <output directory>
+    if not (arguments.output_dir or arguments.archive_file or arguments.index_only):
+        parser.error("an output directory and/or --archive is required")
+    if (arguments.index_only or arguments.from_index) and not arguments.index_file:
+        parser.error("--index-only and --from-index require --index")
+    if arguments.index_only and arguments.from_index:
+        parser.error("--index-only and --from-index are mutually exclusive")
+    if arguments.from_index and (arguments.previous_manifest_file or arguments.manifest_file):
+        parser.error("--from-index cannot be combined with incremental aggregation (manifest)")
 
-    """)
+    logger.info(f"Arguments: {vars(arguments)}")
+    if PROFILE_DIR:
+        profiling.start(PROFILE_DIR, PROFILE_MEMORY)
+    try:
+        with metrics.stage('total'):
+            aggregate_collection.aggregate(arguments.collection_id, arguments.metadata_dir, arguments.output_dir,
+                                           previous_output_dir=arguments.previous_output_dir,
+                                           previous_manifest_file=arguments.previous_manifest_file,
+                                           manifest_file=arguments.manifest_file,
+                                           index_file=arguments.index_file,
+                                           index_only=arguments.index_only,
+                                           from_index=arguments.from_index,
+                                           archive_file=arguments.archive_file,
+                                           previous_archive_file=arguments.previous_archive_file)
+    finally:
+        # also for a failed run
+        metrics.write_reports(METRICS_JSON_FILE, METRICS_PROMETHEUS_FILE, prefix='europeana_metadata_aggregation')
+        profiling.finish(PROFILE_TOP_N)
 
 
 if __name__ == "__main__":
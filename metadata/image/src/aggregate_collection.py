@@ -1,45 +1,110 @@
+import hashlib
 import json
 import logging
+import metrics
 import os
+import resource
+import shutil
+import tempfile
+import threading
 import time
-import re
 
-from glom import glom, PathAccessError
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
+from itertools import groupby
 from lxml import etree
-from multiprocessing import Pool, Manager
+from zipfile import BadZipFile
 
 from aggregation_cmdi_creation import make_cmdi_record, make_cmdi_template
 from aggregation_cmdi_creation import make_collection_record, make_collection_record_template
+from aggregation_cmdi_creation import make_facet_summary, merge_facet_summaries
+from aggregation_cmdi_creation import FULL_TEXT_RECORD_TEMPLATE_FILE, COLLECTION_RECORD_TEMPLATE_FILE
+from aggregation_manifest import AggregationManifest, file_stat, make_digest
+from cmdi_stream import make_record_envelope, make_collection_record_envelope
+from cmdi_stream import write_cmdi_record, write_collection_record
 from common import log_progress
-from common import get_json_from_http
-from common import xpath, xpath_text_values
 from common import normalize_issue_title, normalize_identifier, date_to_year, filename_safe, unique_filename
 
 from common import ALL_NAMESPACES
-from env import FILE_PROCESSING_THREAD_POOL_SIZE, RECORD_API_URL, RECORD_API_KEY, PRETTY_CMDI_XML
+from compact_index import CompactIndex
+from edm_extraction import get_extractor
+from external_sort import ExternalSorter
+from env import FILE_PROCESSING_THREAD_POOL_SIZE, PRETTY_CMDI_XML, EDM_EXTRACTOR
+from env import CMDI_GENERATION_THREAD_POOL_SIZE, CMDI_WRITER
+from env import FILE_PROCESSING_CHUNK_SIZE, FILE_PROCESSING_MAX_IN_FLIGHT
+from env import MAX_MEMORY, EXTERNAL_SORT_DIR
+from env import CMDI_RECORDS_BASE_URL, COLLECTION_DISPLAY_NAME, LANDING_PAGE_URL
+from index_store import save_index, load_index
+from metadata_archive import is_metadata_archive, list_archive_members, open_archive_member
+from profiling import make_pool
+from zip_output import RecordOutput, ZipOutput
+from title_resolution import resolve_titles
 
 logger = logging.getLogger(__name__)
 
-EDM_ID_PATTERN = re.compile(r'^[A-z]+://data.europeana.eu/item/([^/]+/[^/]+)$')
 MAX_TITLE_LENGTH = 100
+FINGERPRINT_SOURCE_FILES = ['aggregate_collection.py', 'aggregation_cmdi_creation.py', 'cmdi_stream.py', 'common.py',
+                            'edm_extraction.py', 'zip_output.py', FULL_TEXT_RECORD_TEMPLATE_FILE,
+                            COLLECTION_RECORD_TEMPLATE_FILE]
 
 
-def aggregate(collection_id, metadata_dir, output_dir):
+def aggregate(collection_id, metadata_dir, output_dir,
+              previous_output_dir=None, previous_manifest_file=None, manifest_file=None,
+              index_file=None, index_only=False, from_index=False,
+              archive_file=None, previous_archive_file=None):
+    # records are written to output_dir and/or (as ZIP) to archive_file
     start_time = time.time()
 
     logging.basicConfig()
     logger.setLevel(logging.INFO)
     logger.info(f"Start time: {time.strftime('%c', time.localtime(start_time))}")
 
-    os.makedirs(output_dir, exist_ok=True)
-
-    # 'index' metadata records based on properties
-    logger.info("Making index for metadata")
-    index = make_md_index(metadata_dir)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # manifest of inputs and outputs, to only redo what changed since a previous run
+    manifest = None
+    if manifest_file or previous_manifest_file:
+        manifest = AggregationManifest(get_settings_fingerprint(collection_id), previous_manifest_file)
+
+    if MAX_MEMORY and not (from_index or index_only):
+        # records are grouped on disk instead of in an index, a collection that does not fit in memory can be done
+        if manifest is not None or index_file:
+            logger.warning("MAX_MEMORY is set: no incremental aggregation and no index file")
+        aggregate_external(collection_id, metadata_dir, output_dir, archive_file)
+        logger.info(f"Aggregation of {collection_id} completed in {time.time() - start_time:,.2f} seconds")
+        return None
+
+    if from_index:
+        # generate from a previously stored index, without reading the metadata
+        logger.info(f"Loading index from {index_file}")
+        with metrics.stage('load_index'):
+            index = load_index(index_file)
+    else:
+        # 'index' metadata records based on properties
+        logger.info("Making index for metadata")
+        with metrics.stage('index'):
+            index = make_md_index(metadata_dir, manifest)
+        if index_file:
+            save_index(index, index_file, collection_id)
+        if index_only:
+            logger.info(f"Indexing of {collection_id} completed in {time.time() - start_time:,.2f} seconds")
+            return index
 
     # generate CMDI for the indexed property combinations
-    logger.info(f"Creating CMDI record for items in index in {output_dir}")
-    generate_cmdi_records(collection_id, index, metadata_dir, output_dir)
+    logger.info(f"Creating CMDI record for items in index in {', '.join(filter(None, [output_dir, archive_file]))}")
+    plan = plan_cmdi_records(index)
+    with ZipOutput(archive_file) if archive_file else nullcontext() as archive:
+        reusable = set()
+        if manifest is not None:
+            with metrics.stage('carry_over'):
+                reusable = carry_over_records(plan, index, manifest, previous_output_dir, output_dir,
+                                              previous_archive_file, archive)
+        with metrics.stage('cmdi_generation'):
+            generate_cmdi_records(collection_id, index, output_dir, plan, reusable, archive)
+
+    if manifest_file:
+        manifest.save(manifest_file)
 
     end_time = time.time()
 
@@ -47,196 +112,502 @@ def aggregate(collection_id, metadata_dir, output_dir):
     return index
 
 
-def make_md_index(metadata_dir):
-    md_index = {}
-    files = os.listdir(metadata_dir)
-    logger.info(f"Reading metadata from {len(files)} files in {metadata_dir}")
-    total = len(files)
+def aggregate_external(collection_id, metadata_dir, output_dir, archive_file=None):
+    logger.info(f"Grouping metadata on disk, with at most {MAX_MEMORY} MiB of records in memory")
+    with external_md_groups(metadata_dir, MAX_MEMORY * 1024 * 1024) as (skeleton, groups):
+        logger.info(f"Creating CMDI records in {', '.join(filter(None, [output_dir, archive_file]))}")
+        plan = plan_cmdi_records(skeleton)
+        with ZipOutput(archive_file) if archive_file else nullcontext() as archive:
+            with metrics.stage('cmdi_generation'):
+                generate_cmdi_records(collection_id, skeleton, output_dir, plan, archive=archive, groups=groups)
+
+
+def make_md_index(metadata_dir, manifest=None):
+    # metadata_dir is a directory of EDM files or a metadata dump (ZIP archive) to read them from
+    md_index = CompactIndex()
 
-    with Manager() as manager:
-        part_of_title_map = manager.dict()
-        map_lock = manager.Lock()
-        indexer = FileProcessor(md_index, metadata_dir, total, part_of_title_map, map_lock)
-        with Pool(int(FILE_PROCESSING_THREAD_POOL_SIZE)) as p:
-            data = p.map(indexer.process, files)
-
-        for item in data:
-            # non-matching files yield no response
-            if item is not None:
-                add_to_index(md_index,
-                             identifier=item['identifier'],
-                             titles=item['titles'],
-                             years=item['years'],
-                             filename=item['filename'])
+    # records go into the index as soon as they are read; what is needed to add them to their title/year groups
+    # once titles are resolved is kept by position in the list of files, to keep the index order independent of
+    # the order in which the workers finish
+    pending = {}
+    for position, item in read_metadata_files(metadata_dir, manifest):
+        record = md_index.add_record(item['identifier'], item['filename'], item['facts'])
+        pending[position] = (record, item['part_of_refs'], item['cho_titles'], item['years'])
+
+    # resolve (newspaper) titles for all records in one go, then join them in
+    with metrics.stage('title_resolution'):
+        title_map = resolve_titles(ref for _, part_of_refs, _, _ in pending.values() for ref in part_of_refs)
+
+    for position in sorted(pending):
+        record, part_of_refs, cho_titles, years = pending.pop(position)
+        for title in get_titles(part_of_refs, cho_titles, title_map):
+            for year in years:
+                md_index.add_to_group(title, year, record)
 
     return md_index
 
 
+@contextmanager
+def external_md_groups(metadata_dir, max_memory):
+    # as make_md_index, but the records are spilled to sorted runs on disk (using about max_memory bytes) instead of
+    # kept in an index; yields the index without records (title -> year -> group number) and an iterator of
+    # (title, year, identifier -> {file, facts}) over the groups in index order, with one group in memory at a time
+    with tempfile.TemporaryDirectory(prefix='aggregation-', dir=EXTERNAL_SORT_DIR) as directory:
+        with metrics.stage('index'):
+            # by position, as in make_md_index the index order does not depend on the order in which workers finish
+            items = ExternalSorter(f"{directory}/items", max_memory)
+            part_of_refs = set()
+            for position, item in read_metadata_files(metadata_dir):
+                part_of_refs.update(item['part_of_refs'])
+                items.add(position, item)
+
+            with metrics.stage('title_resolution'):
+                title_map = resolve_titles(part_of_refs)
+
+            # titles and years are numbered in order of appearance, the records then sorted by group
+            skeleton = {}
+            title_numbers = {}
+            records = ExternalSorter(f"{directory}/records", max_memory)
+            for position, item in items.sorted():
+                for title in get_titles(item['part_of_refs'], item['cho_titles'], title_map):
+                    for year in item['years']:
+                        title_number = title_numbers.setdefault(title, len(title_numbers))
+                        years = skeleton.setdefault(title, {})
+                        year_number = years.setdefault(year, len(years))
+                        records.add((title_number, year_number, position),
+                                    (item['identifier'], item['filename'], item['facts']))
+        logger.info(f"{records.count} records in {sum(len(years) for years in skeleton.values())} groups")
+
+        def iterate_groups():
+            titles = list(skeleton)
+            years = [list(skeleton[title]) for title in titles]
+            for (title_number, year_number), entries in groupby(records.sorted(), key=lambda entry: entry[0][:2]):
+                # as in the index, a later record with the same identifier takes the place of the earlier one
+                yield titles[title_number], years[title_number][year_number], {
+                    identifier: {'file': filename, 'facts': facts} for _, (identifier, filename, facts) in entries
+                }
+
+        yield skeleton, iterate_groups()
+
+
+def read_metadata_files(metadata_dir, manifest=None):
+    # (position in the list of files, extracted values) for all metadata files, in the order read; files are sorted
+    # by base name, so that a directory and a dump of the same files give the same order (and so the same output)
+    archive_members = None
+    if is_metadata_archive(metadata_dir):
+        archive_members, archive_stats = list_archive_members(metadata_dir)
+        files = sorted(archive_members)
+    else:
+        files = sorted(os.listdir(metadata_dir))
+
+    # values extracted from files unchanged since the previous run are taken from the manifest
+    stats = {}
+    previous_items = {}
+    if manifest is not None:
+        for filename in files:
+            if archive_members is not None:
+                stats[filename] = archive_stats[filename]
+            else:
+                stats[filename] = file_stat(f"{metadata_dir}/{filename}")
+            unchanged, item = manifest.get_previous_item(filename, stats[filename])
+            if unchanged:
+                previous_items[filename] = item
+        logger.info(f"{len(previous_items)} of {len(files)} files unchanged since previous run")
+
+    def register(position, item):
+        if manifest is not None:
+            manifest.add_file(files[position], stats[files[position]], item)
+        # non-matching files yield no response
+        return item is not None
+
+    tasks = []
+    for position, filename in enumerate(files):
+        if filename in previous_items:
+            item = previous_items.pop(filename)
+            metrics.inc('metadata_files_total', result='unchanged')
+            if register(position, item):
+                yield position, item
+        else:
+            tasks += [(position, archive_members[filename] if archive_members is not None else filename)]
+
+    total = len(tasks)
+    workers = int(FILE_PROCESSING_THREAD_POOL_SIZE)
+    chunksize = FILE_PROCESSING_CHUNK_SIZE or max(1, min(64, total // (workers * 16)))
+    max_in_flight = max(FILE_PROCESSING_MAX_IN_FLIGHT, 2 * chunksize * workers)
+    logger.info(f"Reading metadata from {total} files in {metadata_dir} ({EDM_EXTRACTOR} extractor, "
+                f"chunks of {chunksize}, at most {max_in_flight} files in flight)")
+    start_time = time.perf_counter()
+
+    indexer = FileProcessor(metadata_dir, EDM_EXTRACTOR, archive_members is not None)
+    count = 0
+    last_log = 0
+    with make_pool(workers) as p:
+        for position, item in imap_bounded(p, indexer.process, tasks, chunksize, max_in_flight):
+            if register(position, item):
+                yield position, item
+            count += 1
+            last_log = log_progress(logger, total, count, last_log, category="Reading metadata files")
+
+    log_extraction_stats(total, time.perf_counter() - start_time)
+
+
+def imap_bounded(pool, function, tasks, chunksize, max_in_flight):
+    # pool.imap_unordered, but the pool takes no more than max_in_flight tasks ahead of the results consumed, so that
+    # results do not pile up when the consumer is slower than the workers; metrics recorded by the workers are merged
+    # into those of this process
+    slots = threading.Semaphore(max_in_flight)
+    stopped = threading.Event()
+
+    def feed():
+        # chunks of tasks, each task taking a slot
+        chunk = []
+        for task in tasks:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            chunk += [task]
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    # chunks are made here rather than by the pool, as the iterator of the pool can then be read on after an exception
+    chunk_results = pool.imap_unordered(ChunkFunction(metrics.WorkerFunction(function)), feed())
+    try:
+        for results in chunk_results:
+            for result in metrics.collect(results):
+                yield result
+                slots.release()
+    finally:
+        # when the consumer or a worker raised, the task feeding thread of the pool stops instead of waiting for a slot
+        # forever (Pool.terminate joins it), and the chunks in flight are finished, so that no worker is writing a
+        # result when the pool is terminated (the pool could otherwise block on a queue lock held by a killed worker)
+        stopped.set()
+        slots.release()
+        discard_results(chunk_results)
+
+
+def discard_results(results):
+    while True:
+        try:
+            next(results)
+        except StopIteration:
+            return
+        except Exception:
+            pass
+
+
+class ChunkFunction:
+    # applies a function to each task of a chunk, in a pool worker
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, chunk):
+        return [self.function(task) for task in chunk]
+
+
 class FileProcessor:
 
-    def __init__(self, md_index, metadata_dir, total, part_of_title_map, map_lock):
-        self.md_index = md_index
+    def __init__(self, metadata_dir, extractor_name, from_archive=False):
         self.metadata_dir = metadata_dir
-        self.total = total
-        self.count = 0
-        self.last_log = 0
+        # metadata_dir is a metadata archive, files are processed by member name
+        self.from_archive = from_archive
+        self.extractor = get_extractor(extractor_name)
 
-        self.part_of_title_map = part_of_title_map
-        self.map_lock = map_lock
-
-    def process(self, filename):
+    def process(self, task):
+        # (position, file or member name) -> (position, extracted values or None)
+        position, filename = task
         if filename.endswith(".xml"):
+            if self.from_archive:
+                logging.debug(f"Processing metadata file {filename} in {self.metadata_dir}")
+                try:
+                    with open_archive_member(self.metadata_dir, filename) as file:
+                        return position, self.process_file(file, os.path.basename(filename),
+                                                           f"{self.metadata_dir}:{filename}")
+                except BadZipFile as err:
+                    logger.error(f"Error reading {filename} from {self.metadata_dir}: {err=}")
+                    metrics.inc('metadata_files_total', result='error')
+                    return position, None
             file_path = f"{self.metadata_dir}/{filename}"
             logging.debug(f"Processing metadata file {file_path}")
-            return self.process_file(file_path, filename)
-
-        self.count += 1
-        self.last_log = log_progress(None, self.total, self.count, self.last_log,
-                                     category="Reading metadata files",
-                                     interval=1)
+            return position, self.process_file(file_path, filename, file_path)
+        metrics.inc('metadata_files_total', result='skipped')
+        return position, None
 
-    def process_file(self, file_path, filename):
+    def process_file(self, source, filename, location):
         try:
-            doc = etree.parse(file_path)
-            identifiers = xpath_text_values(doc, '/rdf:RDF/ore:Proxy/dc:identifier')
+            with metrics.stage('parse'):
+                edm = self.extractor(source)
+            identifiers = edm['identifiers']
             if len(identifiers) == 0:
-                logger.error(f"No identifier in {file_path}")
+                logger.error(f"No identifier in {location}")
+                metrics.inc('metadata_files_total', result='no_identifier')
             else:
                 identifier = normalize_identifier(identifiers[0])
-                titles = self.get_titles(doc)
-                years = [date_to_year(date)
-                         for date in xpath_text_values(doc, '/rdf:RDF/ore:Proxy/dcterms:issued')]
+                years = [date_to_year(date) for date in edm['issued']]
 
+                # titles are resolved afterwards for the whole collection
+                metrics.inc('metadata_files_total', result='indexed')
                 return {
                     'identifier': identifier,
-                    'titles': titles,
+                    'part_of_refs': edm['part_of_refs'],
+                    'cho_titles': edm['cho_titles'],
                     'years': years,
-                    'filename': filename
+                    'filename': filename,
+                    'facts': edm['facts']
                 }
 
         except etree.Error as err:
             logger.error(f"Error processing XML document: {err=}")
-
-    def get_titles(self, doc):
-        # look up (newspaper) collection title (or use previously looked up)
-        part_of_refs = xpath(doc, '/rdf:RDF/ore:Proxy/dcterms:isPartOf/@rdf:resource')
-        titles = [self.look_up_title(ref) for ref in part_of_refs if ref is not None]
-        titles = [title for title in titles if title is not None]
-        if titles and len(titles) > 0:
-            return titles
-
-        # use normalized issue title(s)
-        return [normalize_issue_title(title)
-                for title
-                in xpath_text_values(doc, '/rdf:RDF/edm:ProvidedCHO/dc:title')]
-
-    def look_up_title(self, ref):
-        # mplog = log_to_stderr()
-        # mplog.setLevel(logging.INFO)
-        with self.map_lock:
-            from_map = self.part_of_title_map.get(ref, None)
-            if from_map:
-                # fetch title from map (cache)
-                return from_map
-            else:
-                # retrieve title from API
-                match = EDM_ID_PATTERN.match(ref)
-                if match:
-                    edm_id = match.group(1)
-                    url = f"{RECORD_API_URL}/{edm_id}.json?wskey={RECORD_API_KEY}"
-                    # mplog.info(f"Getting collection record from {url}")
-                    json_doc = get_json_from_http(url)
-                    if json_doc is not None:
-                        proxies = glom(json_doc, 'object.proxies', default=None, skip_exc=PathAccessError)
-                        if proxies:
-                            for proxy in proxies:
-                                titles = glom(proxy, 'dcTitle.def', default=None, skip_exc=PathAccessError)
-                                if titles and len(titles) > 0:
-                                    title = titles[0]
-                                    # mplog.info(f"Setting title in map: {ref} -> {title}")
-                                    self.part_of_title_map[ref] = title
-                                    return title
-
-
-def add_to_index(index, identifier, titles, years, filename):
-    for title in titles:
-        if title not in index:
-            index[title] = {}
-        for year in years:
-            if year not in index[title]:
-                index[title][year] = {}
-            index[title][year][identifier] = {
-                'file': filename
-            }
-
-
-def generate_cmdi_records(collection_id, index, metadata_dir, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
-    template = make_cmdi_template()
-    collection_template = make_collection_record_template()
-    total = sum([len(index[title]) for title in index])
+            metrics.inc('metadata_files_total', result='error')
+
+
+def get_titles(part_of_refs, cho_titles, title_map):
+    # (newspaper) collection title(s) resolved from the parent records
+    titles = [title_map[ref] for ref in part_of_refs if ref in title_map]
+    if len(titles) > 0:
+        return titles
+
+    # use normalized issue title(s)
+    return [normalize_issue_title(title) for title in cho_titles]
+
+
+def log_extraction_stats(total, seconds):
+    # peak RSS of the (terminated) pool workers, ru_maxrss is in kilobytes on Linux
+    workers = int(FILE_PROCESSING_THREAD_POOL_SIZE)
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    logger.info(f"Read {total} metadata files in {seconds:,.2f} seconds with {EDM_EXTRACTOR} extractor: "
+                f"{total / seconds:,.1f} files/s, {total / seconds / workers:,.1f} files/s per worker, "
+                f"peak worker RSS {peak_rss / 1024:,.1f} MiB")
+
+
+def generate_cmdi_records(collection_id, index, output_dir, plan=None, reusable=frozenset(), archive=None,
+                          groups=None):
+    # records are written to output_dir (if given) and/or compressed by the workers and added to archive (ZipOutput);
+    # records in 'reusable' are already in place (carried over from a previous run); the records of the title/year
+    # groups are taken from the index, or from 'groups', an iterator of (title, year, identifier -> {file, facts})
+    # in index order
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    output = RecordOutput(output_dir, archive is not None)
+    if plan is None:
+        plan = plan_cmdi_records(index)
+    total = sum([len(year_files) for _, year_files, _ in plan])
     count = 0
     last_log = 0
 
-    filenames_history = []
-    for title in index:
-        files_for_years = {}
-        years = index[title]
-        for year in years:
-            # for each year there is a dict of identifier -> {file, annotation_ref[]}
-            records = years[year]
-
-            if file_created := generate_cmdi_record(records, collection_id, title, year,
-                                                    output_dir, metadata_dir, template, filenames_history):
-                files_for_years[year] = file_created
+    # title/year records first; for each title there is a dict of year -> identifier -> {file, facts}
+    # each year also yields a small summary of its facets, collection records are made from those
+    files_created = {}
+    summaries = {}
+    for title, year_files, collection_file_name in plan:
+        for year, file_name in year_files.items():
+            if file_name in reusable:
+                files_created.setdefault(title, {})[year] = file_name
+                if collection_file_name and collection_file_name not in reusable:
+                    summaries.setdefault(title, {})[year] = make_facet_summary(index[title][year])
+                count += 1
+
+    # groups are only taken (and held) as the workers get to them
+    if groups is None:
+        groups = ((title, year, index[title][year]) for title, year_files, _ in plan for year in year_files)
+    file_names = {title: year_files for title, year_files, _ in plan}
+    year_jobs = ((title, year, records, file_names[title][year]) for title, year, records in groups
+                 if file_names[title][year] not in reusable)
+
+    with make_job_runner() as run_jobs:
+        for title, year, file_created, summary, member in run_jobs(partial(generate_year_record_job, collection_id,
+                                                                           output),
+                                                                   year_jobs):
+            if file_created:
+                files_created.setdefault(title, {})[year] = file_created
+                metrics.inc('cmdi_records_total', type='year')
+            summaries.setdefault(title, {})[year] = summary
+            if member is not None:
+                archive.add(member)
 
             count += 1
             last_log = log_progress(logger, total, count, last_log,
                                     category="Generating CMDI records",
                                     interval=1)
 
-        logger.info(f"{len(files_for_years)} year records generated for title '{title}'")
-
-        if len(files_for_years) > 1:
-            # join records from all years
-            title_records = {}
-            for year_records in years.values():
-                title_records.update(year_records)
-            # Make a 'parent' record for the title that links to all years
-            logger.info(f"Generating collection record for title '{title}'")
-            generate_collection_record(title_records, collection_id, title, files_for_years,
-                                       output_dir, metadata_dir, collection_template, filenames_history)
-
-
-def generate_cmdi_record(records, collection_id, title, year, output_dir, metadata_dir, template, previous_filenames):
-    file_name = f"{unique_filename(filename_safe(title[0:MAX_TITLE_LENGTH] + '_' + year), previous_filenames)}.xml"
-    file_path = f"{output_dir}/{file_name}"
-    logger.debug(f"Generating metadata file {file_path}")
-    if cmdi_file := make_cmdi_record(file_name, template, collection_id, title, year, records, metadata_dir):
-        write_xml_tree_to_file(cmdi_file, file_path)
-        return file_name
-
-
-def generate_collection_record(input_records, collection_id, title, year_files, output_dir,
-                               metadata_dir, template, previous_filenames):
-    file_name = f"{unique_filename(filename_safe(title + '_collection'), previous_filenames)}.xml"
-    file_path = f"{output_dir}/{file_name}"
-    logger.debug(f"Generating metadata file {file_path}")
+        # then the 'parent' records for titles, linking to all years
+        collection_jobs = []
+        for title, year_files, collection_file_name in plan:
+            files_for_years = {year: files_created[title][year]
+                               for year in year_files if year in files_created.get(title, {})}
+            logger.info(f"{len(files_for_years)} year records generated for title '{title}'")
+            if collection_file_name in reusable:
+                logger.info(f"Collection record for title '{title}' carried over")
+            elif collection_file_name and len(files_for_years) > 1:
+                # join the summaries of all years, in index order
+                facet_summary = merge_facet_summaries([summaries[title][year] for year in year_files])
+                logger.info(f"Generating collection record for title '{title}'")
+                collection_jobs += [(title, facet_summary, files_for_years, collection_file_name)]
+
+        for member in run_jobs(partial(generate_collection_record_job, collection_id, output), collection_jobs):
+            metrics.inc('cmdi_records_total', type='collection')
+            if member is not None:
+                archive.add(member)
+
+
+def plan_cmdi_records(index):
+    # assign all file names up front, in index order: (title, {year: file name}, collection file name or None)
+    plan = []
+    previous_filenames = set()
+    for title in index:
+        year_files = {}
+        for year in index[title]:
+            name = filename_safe(title[0:MAX_TITLE_LENGTH] + '_' + year)
+            year_files[year] = f"{unique_filename(name, previous_filenames)}.xml"
+        collection_file_name = None
+        if len(year_files) > 1:
+            collection_file_name = f"{unique_filename(filename_safe(title + '_collection'), previous_filenames)}.xml"
+        plan += [(title, year_files, collection_file_name)]
+    return plan
+
+
+def carry_over_records(plan, index, manifest, previous_output_dir, output_dir, previous_archive=None, archive=None):
+    # register the inputs of all planned records; those with the same inputs as in the previous run are linked
+    # (or copied) from the previous output, and/or copied from the previous archive, instead of generated again
+    for title, year_files, collection_file_name in plan:
+        year_digests = []
+        for year, file_name in year_files.items():
+            inputs = [record['file'] for record in index[title][year].values()]
+            digest = make_digest([title, year, file_name, [[name, manifest.get_stat(name)] for name in inputs]])
+            manifest.add_output(file_name, {'title': title, 'year': year, 'inputs': inputs, 'digest': digest})
+            year_digests += [digest]
+        if collection_file_name:
+            # covers all years, so any change in a year also renews the collection record
+            digest = make_digest([title, collection_file_name, year_files, year_digests])
+            manifest.add_output(collection_file_name, {'title': title, 'years': year_files, 'digest': digest})
+
+    # only records available in each form of output written
+    reusable = [file_name for file_name in manifest.outputs if manifest.is_unchanged_output(file_name)]
+    if output_dir:
+        if previous_output_dir and os.path.isdir(previous_output_dir):
+            reusable = [file_name for file_name in reusable
+                        if os.path.exists(f"{previous_output_dir}/{file_name}")]
+        else:
+            reusable = []
+    if archive is not None:
+        if previous_archive and os.path.isfile(previous_archive):
+            copied = archive.copy(previous_archive, reusable)
+            reusable = [file_name for file_name in reusable if file_name in copied]
+        else:
+            reusable = []
+    if output_dir:
+        for file_name in reusable:
+            link_or_copy(f"{previous_output_dir}/{file_name}", f"{output_dir}/{file_name}")
+    reusable = set(reusable)
+    logger.info(f"{len(reusable)} of {len(manifest.outputs)} records unchanged and carried over")
+    return reusable
+
+
+def link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def get_settings_fingerprint(collection_id):
+    # records can only be carried over if made by the same code, from the same templates, with the same settings
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sha = hashlib.sha1()
+    for source_file in FINGERPRINT_SOURCE_FILES:
+        with open(f"{script_path}/{source_file}", 'rb') as file:
+            sha.update(file.read())
+    sha.update(json.dumps([collection_id, CMDI_RECORDS_BASE_URL, COLLECTION_DISPLAY_NAME,
+                           LANDING_PAGE_URL, PRETTY_CMDI_XML, CMDI_WRITER]).encode('utf-8'))
+    return sha.hexdigest()
+
+
+@contextmanager
+def make_job_runner(chunksize=4):
+    # yields a function to map jobs over, either in a process pool or serially in this process; jobs are taken from
+    # their iterator only shortly before a worker is free for them
+    if CMDI_GENERATION_THREAD_POOL_SIZE > 1:
+        with make_pool(CMDI_GENERATION_THREAD_POOL_SIZE) as p:
+            yield partial(imap_bounded, p, chunksize=chunksize,
+                          max_in_flight=2 * chunksize * CMDI_GENERATION_THREAD_POOL_SIZE)
+    else:
+        yield map
+
+
+@lru_cache(maxsize=None)
+def get_templates():
+    # parsed once per (worker) process, records are made from deep copies
+    return make_cmdi_template(), make_collection_record_template()
+
+
+@lru_cache(maxsize=None)
+def get_envelopes(collection_id):
+    # static parts of the streamed records, serialised once per (worker) process
+    template, collection_template = get_templates()
+    return make_record_envelope(template, collection_id), make_collection_record_envelope(collection_template,
+                                                                                          collection_id)
+
+
+def generate_year_record_job(collection_id, output, job):
+    title, year, records, file_name = job
+    template, _ = get_templates()
+    file_created, member = generate_cmdi_record(records, collection_id, title, year, output, template, file_name)
+    return title, year, file_created, make_facet_summary(records), member
+
+
+def generate_collection_record_job(collection_id, output, job):
+    title, facet_summary, year_files, file_name = job
+    _, collection_template = get_templates()
+    _, member = generate_collection_record(facet_summary, collection_id, title, year_files,
+                                           output, collection_template, file_name)
+    return member
+
+
+def generate_cmdi_record(records, collection_id, title, year, output, template, file_name):
+    # (file name, compressed member for the output archive) or (None, None) if no record could be made
+    logger.debug(f"Generating metadata file {file_name}")
+    if CMDI_WRITER == 'stream':
+        envelope, _ = get_envelopes(collection_id)
+        return file_name, output.write(file_name, partial(write_cmdi_record, envelope=envelope,
+                                                          collection_id=collection_id, title=title, year=year,
+                                                          records_map=records, record_file_name=file_name))
+    if cmdi_file := make_cmdi_record(file_name, template, collection_id, title, year, records):
+        return file_name, output.write(file_name, partial(write_xml_tree, cmdi_file))
+    return None, None
+
+
+def generate_collection_record(facet_summary, collection_id, title, year_files, output,
+                               template, file_name):
+    logger.debug(f"Generating metadata file {file_name}")
+    if CMDI_WRITER == 'stream':
+        _, envelope = get_envelopes(collection_id)
+        return file_name, output.write(file_name, partial(write_collection_record, envelope=envelope,
+                                                          collection_id=collection_id, title=title,
+                                                          year_files=year_files, facet_summary=facet_summary,
+                                                          file_name=file_name))
     if cmdi_file := make_collection_record(file_name, template, collection_id, title, year_files,
-                                           input_records, metadata_dir):
-        write_xml_tree_to_file(cmdi_file, file_path)
+                                           facet_summary):
+        return file_name, output.write(file_name, partial(write_xml_tree, cmdi_file))
+    return None, None
 
 
 def write_xml_tree_to_file(cmdi_file, file_name):
-    # wrap up and write to file
+    with open(file_name, 'wb') as file:
+        write_xml_tree(cmdi_file, file)
+
+
+def write_xml_tree(cmdi_file, file):
+    # wrap up and write to (binary) file
     if PRETTY_CMDI_XML:
         etree.indent(cmdi_file, space="  ", level=0)
     etree.cleanup_namespaces(cmdi_file, top_nsmap=ALL_NAMESPACES)
-    with open(file_name, 'wb') as file:
-        cmdi_file.write(file,
-                        encoding='utf-8',
-                        xml_declaration=True,
-                        pretty_print=PRETTY_CMDI_XML)
+    cmdi_file.write(file,
+                    encoding='utf-8',
+                    xml_declaration=True,
+                    pretty_print=PRETTY_CMDI_XML)
 
 
 def collect_fulltext_ids(fulltext_dir):
@@ -297,13 +668,13 @@ def test_run():
     collection_id = '9200396'
     # result = aggregate(collection_id,
     #                    metadata_dir=f"./test-input/{collection_id}",
-    #                    output_dir=f"./test-output/{collection_id}")
+    #                    output_dir=f"./test-output/{collection_id}",
+    #                    index_file=f"./test-input/{collection_id}/index.db",
+    #                    index_only=True)
 
-    with open(f"./test-input/{collection_id}/index.json", 'r') as index_file:
-        index = json.load(index_file)
+    index = load_index(f"./test-input/{collection_id}/index.db")
 
     generate_cmdi_records(collection_id, index,
-                          metadata_dir=f"./test-input/{collection_id}",
                           output_dir=f"./test-output/{collection_id}")
     # pprint.pprint(result)
 
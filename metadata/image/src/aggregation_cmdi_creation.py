@@ -3,11 +3,12 @@ import os
 
 from copy import deepcopy
 from datetime import date
+from functools import lru_cache
 from iso639 import languages
 from lxml import etree
 
 from common import CMD_NS, CMDP_NS_RECORD, CMDP_NS_COLLECTION_RECORD, CMD_NAMESPACES
-from common import xpath, get_unique_xpath_values
+from common import xpath, get_unique_fact_values
 from common import normalize_identifier, xml_id, is_valid_date
 from env import COLLECTION_DISPLAY_NAME, LANDING_PAGE_URL, CMDI_RECORDS_BASE_URL, PRETTY_CMDI_XML
 
@@ -16,6 +17,12 @@ EDM_DUMP_PROXY_ID = 'archive_edm'
 ALTO_DUMP_PROXY_ID = 'archive_alto'
 DUMP_MEDIA_TYPE = 'application/zip'
 RECORD_PAGE_MEDIA_TYPE = 'text/html'
+# facets of a title record, summarised per year
+SUMMARY_FACETS = ['types', 'publishers', 'languages', 'countries', 'rights']
+DUMP_SUBRESOURCES = [(EDM_DUMP_PROXY_ID,
+                      'Archive containing full text content in EDM format which includes this title'),
+                     (ALTO_DUMP_PROXY_ID,
+                      'Archive containing full text content in ALTO format which includes this title')]
 FULL_TEXT_RECORD_TEMPLATE_FILE = 'fulltextresource-template.xml'
 COLLECTION_RECORD_TEMPLATE_FILE = 'collectionrecord-template.xml'
 
@@ -36,11 +43,11 @@ def make_collection_record_template():
     return make_template(COLLECTION_RECORD_TEMPLATE_FILE)
 
 
-def make_cmdi_record(record_file_name, template, collection_id, title, year, records_map, metadata_dir):
+def make_cmdi_record(record_file_name, template, collection_id, title, year, records_map):
     cmdi_file = deepcopy(template)
 
-    # load EDM metadata records
-    edm_records = load_emd_records(records_map, metadata_dir)
+    # EDM metadata facts collected at indexing time
+    edm_records = get_record_facts(records_map)
 
     # Metadata headers
     set_metadata_headers(cmdi_file, collection_id, record_file_name)
@@ -65,22 +72,30 @@ def make_cmdi_record(record_file_name, template, collection_id, title, year, rec
     return cmdi_file
 
 
-def load_emd_records(records_map, metadata_dir):
+def get_record_facts(records_map):
     edm_records = []
     for identifier in records_map:
-        file_name = records_map[identifier].get('file', None)
-        if file_name is None:
-            logger.error(f"No file name in records map for {identifier}")
+        facts = records_map[identifier].get('facts', None)
+        if facts is None:
+            logger.error(f"No metadata facts in records map for {identifier}")
         else:
-            file_path = f"{metadata_dir}/{file_name}"
-            logger.debug(f"Loading metadata file {file_path}")
-            try:
-                edm_records += [etree.parse(file_path)]
-            except etree.Error as err:
-                logger.error(f"Error processing XML document: {err=}")
+            edm_records += [facts]
     return edm_records
 
 
+def make_facet_summary(records_map):
+    # unique facet values of the records for one year, in document order
+    facts_list = [record['facts'] for record in records_map.values() if record.get('facts') is not None]
+    return {facet: get_unique_fact_values(facts_list, facet) for facet in SUMMARY_FACETS}
+
+
+def merge_facet_summaries(summaries):
+    # unique values of the summaries, in order: the same as a summary of the records of all years together, except
+    # that a record (identifier) in several years counts in each of them, as in their year records (not only the last
+    # of them, as when the records of all years were joined by identifier)
+    return {facet: get_unique_fact_values(summaries, facet) for facet in SUMMARY_FACETS}
+
+
 def set_metadata_headers(doc, collection_id, record_file_name):
     creator_header = xpath(doc, '/cmd:CMD/cmd:Header/cmd:MdCreator')
     if creator_header:
@@ -99,23 +114,39 @@ def set_metadata_headers(doc, collection_id, record_file_name):
         collection_name_header[0].text = COLLECTION_DISPLAY_NAME
 
 
-def insert_resource_proxies(resource_proxies_list, collection_id, edm_records):
-    # landing page
-    insert_resource_proxy(resource_proxies_list, LANDING_PAGE_ID, "LandingPage", LANDING_PAGE_URL)
+@lru_cache(maxsize=None)
+def get_fragment(builder, *args):
+    # static subtree(s) made by builder(parent, *args), built once per process; the elements are shared, so they are
+    # only ever inserted as copies
+    holder = etree.Element('fragment')
+    builder(holder, *args)
+    return holder
 
-    # dump URLs
-    insert_resource_proxy(resource_proxies_list, EDM_DUMP_PROXY_ID, "Resource",
-                          make_edm_dump_ref(collection_id), DUMP_MEDIA_TYPE)
-    insert_resource_proxy(resource_proxies_list, ALTO_DUMP_PROXY_ID, "Resource",
-                          make_alto_dump_ref(collection_id), DUMP_MEDIA_TYPE)
+
+def insert_fragment(parent, builder, *args):
+    for element in get_fragment(builder, *args):
+        parent.append(deepcopy(element))
+
+
+def insert_resource_proxies(resource_proxies_list, collection_id, edm_records):
+    # landing page and dump URLs
+    insert_fragment(resource_proxies_list, build_common_resource_proxies, collection_id)
 
     # record landing pages
-    for record_page_ref in get_unique_xpath_values(
-            edm_records, '/rdf:RDF/edm:EuropeanaAggregation/edm:landingPage/@rdf:resource'):
+    for record_page_ref in get_unique_fact_values(edm_records, 'landing_pages'):
         insert_resource_proxy(resource_proxies_list, make_record_page_ref(record_page_ref), "Resource",
                               record_page_ref, RECORD_PAGE_MEDIA_TYPE)
 
 
+def build_common_resource_proxies(parent, collection_id):
+    # landing page
+    insert_resource_proxy(parent, LANDING_PAGE_ID, "LandingPage", LANDING_PAGE_URL)
+
+    # dump URLs
+    insert_resource_proxy(parent, EDM_DUMP_PROXY_ID, "Resource", make_edm_dump_ref(collection_id), DUMP_MEDIA_TYPE)
+    insert_resource_proxy(parent, ALTO_DUMP_PROXY_ID, "Resource", make_alto_dump_ref(collection_id), DUMP_MEDIA_TYPE)
+
+
 def insert_resource_proxy(parent, proxy_id, resource_type, ref, media_type=None):
     proxy_node = etree.SubElement(parent, '{' + CMD_NS + '}ResourceProxy', nsmap=CMD_NAMESPACES)
     proxy_node.attrib['id'] = proxy_id
@@ -159,7 +190,7 @@ def insert_title_and_description(parent, title, year):
     description_info_node = etree.SubElement(parent, '{' + CMDP_NS_RECORD + '}Description', nsmap=CMD_NAMESPACES)
     description_node = etree.SubElement(description_info_node, '{' + CMDP_NS_RECORD + '}description',
                                         nsmap=CMD_NAMESPACES)
-    description_node.text = f"Full text content aggregated from Europeana. Title: \"{title}\". Year: {year}."
+    description_node.text = make_record_description(title, year)
 
     # Add resource type ('Text')
     resource_type_node = etree.SubElement(parent, '{' + CMDP_NS_RECORD + '}ResourceType', nsmap=CMD_NAMESPACES)
@@ -170,7 +201,7 @@ def insert_title_and_description(parent, title, year):
 
 def insert_keywords(parent, edm_records, namespace=CMDP_NS_RECORD):
     # include dc:type values as keyword
-    keywords = get_unique_xpath_values(edm_records, '/rdf:RDF/ore:Proxy/dc:type/text()')
+    keywords = get_unique_fact_values(edm_records, 'types')
     for keyword in keywords:
         keyword_node = etree.SubElement(parent, '{' + namespace + '}Keyword', nsmap=CMD_NAMESPACES)
         label_node = etree.SubElement(keyword_node, '{' + namespace + '}label', nsmap=CMD_NAMESPACES)
@@ -178,9 +209,7 @@ def insert_keywords(parent, edm_records, namespace=CMDP_NS_RECORD):
 
 
 def insert_publisher(parent, edm_records, namespace=CMDP_NS_RECORD):
-    publishers = get_unique_xpath_values(edm_records,
-                                         '/rdf:RDF/ore:Aggregation/edm:dataProvider/text()'
-                                         '|/rdf:RDF/ore:Aggregation/edm:provider/text()')
+    publishers = get_unique_fact_values(edm_records, 'publishers')
     for publisher in publishers:
         keyword_node = etree.SubElement(parent, '{' + namespace + '}Publisher', nsmap=CMD_NAMESPACES)
         label_node = etree.SubElement(keyword_node, '{' + namespace + '}name', nsmap=CMD_NAMESPACES)
@@ -188,9 +217,9 @@ def insert_publisher(parent, edm_records, namespace=CMDP_NS_RECORD):
 
 
 def insert_languages(parent, edm_records, namespace=CMDP_NS_RECORD):
-    language_codes = get_unique_xpath_values(edm_records, '/rdf:RDF/ore:Proxy/dc:language/text()')
+    language_codes = get_unique_fact_values(edm_records, 'languages')
     for language_code in language_codes:
-        create_language_component(parent, language_code, namespace)
+        insert_fragment(parent, build_language_component, language_code, namespace)
 
 
 def insert_temporal_coverage(parent, year):
@@ -208,8 +237,8 @@ def insert_temporal_coverage(parent, year):
     end_year.text = year
 
 
-def insert_countries(parent, edm_record, namespace=CMDP_NS_RECORD):
-    countries = get_unique_xpath_values(edm_record, '/rdf:RDF/edm:EuropeanaAggregation/edm:country/text()')
+def insert_countries(parent, edm_records, namespace=CMDP_NS_RECORD):
+    countries = get_unique_fact_values(edm_records, 'countries')
     for country in countries:
         geolocation_node = etree.SubElement(parent, '{' + namespace + '}GeoLocation', nsmap=CMD_NAMESPACES)
         label_node = etree.SubElement(geolocation_node, '{' + namespace + '}label', nsmap=CMD_NAMESPACES)
@@ -220,7 +249,7 @@ def insert_countries(parent, edm_record, namespace=CMDP_NS_RECORD):
 
 
 def insert_licences(parent, edm_records, namespace=CMDP_NS_RECORD):
-    rights_urls = get_unique_xpath_values(edm_records, '/rdf:RDF/ore:Aggregation/edm:rights/@rdf:resource')
+    rights_urls = get_unique_fact_values(edm_records, 'rights')
     if len(rights_urls) > 0:
         access_info_node = etree.SubElement(parent, '{' + namespace + '}AccessInfo', nsmap=CMD_NAMESPACES)
         for rights_url in rights_urls:
@@ -247,18 +276,17 @@ def insert_issue_subresource_info(parent, record, namespace=CMDP_NS_RECORD):
                                                     nsmap=CMD_NAMESPACES)
 
     # proxy ref
-    record_page_ref = get_unique_xpath_values(
-        [record], '/rdf:RDF/edm:EuropeanaAggregation/edm:landingPage/@rdf:resource')
+    record_page_ref = record.get('landing_pages', [])
     if len(record_page_ref) > 0:
         subresource_node.attrib['{' + CMD_NS + '}ref'] = make_record_page_ref(record_page_ref[0])
 
     # title info
-    for title in get_unique_xpath_values([record], '/rdf:RDF/ore:Proxy/dc:title/text()'):
+    for title in record.get('titles', []):
         label_node = etree.SubElement(subresource_description_node, '{' + namespace + '}label', nsmap=CMD_NAMESPACES)
         label_node.text = f"{title}"
 
     # identifier(s)
-    for identifier in get_unique_xpath_values([record], '/rdf:RDF/ore:Proxy/dc:identifier/text()'):
+    for identifier in record.get('identifiers', []):
         identification_info_node = etree.SubElement(subresource_description_node,
                                                     '{' + namespace + '}IdentificationInfo',
                                                     nsmap=CMD_NAMESPACES)
@@ -273,11 +301,11 @@ def insert_issue_subresource_info(parent, record, namespace=CMDP_NS_RECORD):
         identifier_node.text = normalized_id
 
     # languages
-    for language_code in get_unique_xpath_values([record], '/rdf:RDF/ore:Proxy/dc:language/text()'):
-        create_language_component(subresource_description_node, language_code, namespace)
+    for language_code in record.get('languages', []):
+        insert_fragment(subresource_description_node, build_language_component, language_code, namespace)
 
     # temporal coverage
-    for issue_date in get_unique_xpath_values([record], '/rdf:RDF/ore:Proxy/dcterms:issued/text()'):
+    for issue_date in record.get('issued', []):
         temporal_coverage_node = etree.SubElement(subresource_description_node, '{' + namespace + '}TemporalCoverage',
                                                   nsmap=CMD_NAMESPACES)
         label_node = etree.SubElement(temporal_coverage_node, '{' + namespace + '}label',
@@ -294,7 +322,7 @@ def insert_issue_subresource_info(parent, record, namespace=CMDP_NS_RECORD):
             end.text = issue_date
 
     # geolocation
-    for country in get_unique_xpath_values([record], '/rdf:RDF/edm:EuropeanaAggregation/edm:country/text()'):
+    for country in record.get('countries', []):
         geolocation_node = etree.SubElement(subresource_description_node, '{' + namespace + '}GeoLocation',
                                             nsmap=CMD_NAMESPACES)
         label_node = etree.SubElement(geolocation_node, '{' + namespace + '}label', nsmap=CMD_NAMESPACES)
@@ -305,10 +333,11 @@ def insert_issue_subresource_info(parent, record, namespace=CMDP_NS_RECORD):
 
 
 def insert_dump_subresource_info(parent, namespace=CMDP_NS_RECORD):
-    for dump in [(EDM_DUMP_PROXY_ID,
-                  'Archive containing full text content in EDM format which includes this title'),
-                 (ALTO_DUMP_PROXY_ID,
-                  'Archive containing full text content in ALTO format which includes this title')]:
+    insert_fragment(parent, build_dump_subresource_info, namespace)
+
+
+def build_dump_subresource_info(parent, namespace):
+    for dump in DUMP_SUBRESOURCES:
         subresource_node = etree.SubElement(parent, '{' + namespace + '}Subresource', nsmap=CMD_NAMESPACES)
         subresource_description_node = etree.SubElement(subresource_node,
                                                         '{' + namespace + '}SubresourceDescription',
@@ -318,11 +347,21 @@ def insert_dump_subresource_info(parent, namespace=CMDP_NS_RECORD):
         label_node.text = dump[1]
 
 
-def create_language_component(parent, language_code, namespace=CMDP_NS_RECORD):
+def build_language_component(parent, language_code, namespace):
     language_node = etree.SubElement(parent, '{' + namespace + '}Language', nsmap=CMD_NAMESPACES)
     language_name_node = etree.SubElement(language_node, '{' + namespace + '}name', nsmap=CMD_NAMESPACES)
-    language = None
+    language = look_up_language(language_code)
+    if language is None:
+        language_name_node.text = language_code
+    else:
+        language_name_node.text = language.name
+        language_code_node = etree.SubElement(language_node, '{' + namespace + '}code', nsmap=CMD_NAMESPACES)
+        language_code_node.text = language.part3
 
+
+@lru_cache(maxsize=None)
+def look_up_language(language_code):
+    language = None
     try:
         if len(language_code) == 2:
             # lookup 639-1 code to get name + 3 letter code
@@ -332,16 +371,19 @@ def create_language_component(parent, language_code, namespace=CMDP_NS_RECORD):
             language = languages.get(part3=language_code)
     except KeyError:
         logger.warning(f"Language name lookup failed: no code '{language_code}' in dictionary")
-    if language is None:
-        language_name_node.text = language_code
-    else:
-        language_name_node.text = language.name
-        language_code_node = etree.SubElement(language_node, '{' + namespace + '}code', nsmap=CMD_NAMESPACES)
-        language_code_node.text = language.part3
+    return language
 
 
 def insert_metadata_info(parent):
-    metadata_info = etree.XML(f'''
+    insert_fragment(parent, build_metadata_info, today_string())
+
+
+def build_metadata_info(parent, creation_date):
+    parent.append(etree.XML(make_metadata_info_xml(creation_date), parser=parser))
+
+
+def make_metadata_info_xml(creation_date):
+    return f'''
         <MetadataInfo>
             <Publisher>
               <name>CLARIN ERIC</name>
@@ -362,7 +404,7 @@ def insert_metadata_info(parent):
                   <method>Conversion</method>
                   <note>Converted from EDM to CMDI</note>
                   <When>
-                    <date>{today_string()}</date>
+                    <date>{creation_date}</date>
                   </When>
                 </ActivityInfo>
               </Creation>
@@ -379,15 +421,14 @@ def insert_metadata_info(parent):
               </Collection>
             </ProvenanceInfo>
           </MetadataInfo>
-        ''', parser=parser)
-    parent.insert(len(parent), metadata_info)
+        '''
 
 # ###################
 # Collection records
 # ###################
 
 
-def make_collection_record(file_name, template, collection_id, title, year_files, input_record_map, metadata_dir):
+def make_collection_record(file_name, template, collection_id, title, year_files, facet_summary):
     cmdi_file = deepcopy(template)
 
     # Metadata headers
@@ -407,8 +448,8 @@ def make_collection_record(file_name, template, collection_id, title, year_files
         logger.error("Expecting exactly one components root element")
         return None
     else:
-        # load EDM metadata records
-        edm_records = load_emd_records(input_record_map, metadata_dir)
+        # facets of all years (summary has the same structure as the facts of a single record)
+        edm_records = [facet_summary]
         # insert component content
         collection_insert_component_content(components_root[0], title, sorted(list(year_files)),
                                             year_files, edm_records)
@@ -417,14 +458,8 @@ def make_collection_record(file_name, template, collection_id, title, year_files
 
 
 def collection_insert_resource_proxies(resource_proxies_list, year_files, collection_id):
-    # landing page
-    insert_resource_proxy(resource_proxies_list, LANDING_PAGE_ID, "LandingPage", LANDING_PAGE_URL)
-
-    # dump URLs
-    insert_resource_proxy(resource_proxies_list, EDM_DUMP_PROXY_ID, "Resource",
-                          make_edm_dump_ref(collection_id), DUMP_MEDIA_TYPE)
-    insert_resource_proxy(resource_proxies_list, ALTO_DUMP_PROXY_ID, "Resource",
-                          make_alto_dump_ref(collection_id), DUMP_MEDIA_TYPE)
+    # landing page and dump URLs
+    insert_fragment(resource_proxies_list, build_common_resource_proxies, collection_id)
 
     # links to metadata records
     for year in sorted(year_files):
@@ -468,9 +503,7 @@ def collection_insert_title_and_description(parent, title, years):
                                              nsmap=CMD_NAMESPACES)
     description_node = etree.SubElement(description_info_node, '{' + CMDP_NS_COLLECTION_RECORD + '}description',
                                         nsmap=CMD_NAMESPACES)
-    description_node.text = f"Full text content aggregated from Europeana. " \
-                            f"Title: \"{title}\". " \
-                            f"Years: {', '.join(years)}."
+    description_node.text = make_collection_description(title, years)
 
     # Add resource type ('Text')
     resource_type_node = etree.SubElement(parent, '{' + CMDP_NS_COLLECTION_RECORD + '}ResourceType',
@@ -516,6 +549,16 @@ def collection_insert_subresource_info(parent, title, year_files, namespace=CMDP
         label_node.text = year
 
 
+def make_record_description(title, year):
+    return f"Full text content aggregated from Europeana. Title: \"{title}\". Year: {year}."
+
+
+def make_collection_description(title, years):
+    return f"Full text content aggregated from Europeana. " \
+           f"Title: \"{title}\". " \
+           f"Years: {', '.join(years)}."
+
+
 def make_edm_dump_ref(collection_id):
     return f"ftp://download.europeana.eu/newspapers/fulltext/edm_issue/{collection_id}.zip"
 
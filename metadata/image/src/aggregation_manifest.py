@@ -0,0 +1,75 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+# Keeps track of the input files of an aggregation (size, modification time and the values extracted from them) and of
+# the inputs that went into each output record. A manifest from a previous run tells which files need to be read again
+# and which records can be carried over unchanged.
+class AggregationManifest:
+
+    def __init__(self, settings, previous_manifest_file=None):
+        self.settings = settings
+        self.files = {}
+        self.outputs = {}
+        self.previous_files = {}
+        self.previous_outputs = {}
+        if previous_manifest_file and os.path.exists(previous_manifest_file):
+            self.load(previous_manifest_file)
+
+    def load(self, path):
+        logger.info(f"Loading previous manifest from {path}")
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('version') != MANIFEST_VERSION or data.get('settings') != self.settings:
+            logger.info("Previous manifest was made by a different version or with different settings, ignoring it")
+        else:
+            self.previous_files = data['files']
+            self.previous_outputs = data['outputs']
+
+    def save(self, path):
+        logger.info(f"Writing manifest for {len(self.files)} files and {len(self.outputs)} records to {path}")
+        temp_path = f"{path}.tmp"
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as file:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'settings': self.settings,
+                'files': self.files,
+                'outputs': self.outputs
+            }, file)
+        os.replace(temp_path, path)
+
+    def get_previous_item(self, filename, stat):
+        # (True, item) if the file is unchanged since the previous run, item is None for files that yielded nothing
+        previous = self.previous_files.get(filename, None)
+        if previous is not None and previous['stat'] == stat:
+            return True, previous['item']
+        return False, None
+
+    def add_file(self, filename, stat, item):
+        self.files[filename] = {'stat': stat, 'item': item}
+
+    def get_stat(self, filename):
+        return self.files[filename]['stat']
+
+    def add_output(self, file_name, entry):
+        self.outputs[file_name] = entry
+
+    def is_unchanged_output(self, file_name):
+        previous = self.previous_outputs.get(file_name, None)
+        return previous is not None and previous['digest'] == self.outputs[file_name]['digest']
+
+
+def file_stat(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def make_digest(value):
+    return hashlib.sha1(json.dumps(value).encode('utf-8')).hexdigest()
@@ -0,0 +1,433 @@
+import logging
+import re
+
+from contextlib import contextmanager
+from copy import deepcopy
+from io import TextIOWrapper
+from lxml import etree
+
+from aggregation_cmdi_creation import set_metadata_headers, get_record_facts, look_up_language
+from aggregation_cmdi_creation import make_record_description, make_collection_description, make_metadata_info_xml
+from aggregation_cmdi_creation import make_edm_dump_ref, make_alto_dump_ref, make_record_page_ref, today_string
+from aggregation_cmdi_creation import parser
+from aggregation_cmdi_creation import LANDING_PAGE_ID, EDM_DUMP_PROXY_ID, ALTO_DUMP_PROXY_ID, DUMP_SUBRESOURCES
+from aggregation_cmdi_creation import DUMP_MEDIA_TYPE, RECORD_PAGE_MEDIA_TYPE
+from common import CMD_NS, CMDP_NS_RECORD, CMDP_NS_COLLECTION_RECORD, ALL_NAMESPACES
+from common import xpath, get_unique_fact_values, normalize_identifier, xml_id, is_valid_date
+from env import LANDING_PAGE_URL, CMDI_RECORDS_BASE_URL, PRETTY_CMDI_XML
+
+logger = logging.getLogger(__name__)
+
+INDENT = '  '
+RECORD_FILE_NAME_MARKER = '@@RECORD_FILE_NAME@@'
+CREATION_DATE_MARKER = '@@CREATION_DATE@@'
+PROXIES_MARKER = '@@RESOURCE_PROXIES@@'
+COMPONENTS_MARKER = '@@COMPONENTS@@'
+
+CMD_REF = '{' + CMD_NS + '}ref'
+# characters that are not allowed in XML 1.0, which lxml refuses in text and attribute values
+INVALID_XML_CHARACTERS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+# Writes CMDI records straight to file, producing the same documents as building a tree with the functions in
+# aggregation_cmdi_creation and writing it with write_xml_tree_to_file. The static parts of the document come from
+# the template, serialised once; the content is written element by element.
+class CmdiEnvelope:
+
+    def __init__(self, template, collection_id, proxies_path, components_path):
+        doc = deepcopy(template)
+        set_metadata_headers(doc, collection_id, RECORD_FILE_NAME_MARKER)
+        xpath(doc, '/cmd:CMD/cmd:Header/cmd:MdCreationDate')[0].text = CREATION_DATE_MARKER
+        proxies_list = xpath(doc, proxies_path)[0]
+        proxies_list.text = PROXIES_MARKER
+        components_root = xpath(doc, components_path)[0]
+        components_root.text = COMPONENTS_MARKER
+
+        if PRETTY_CMDI_XML:
+            etree.indent(doc, space=INDENT, level=0)
+        etree.cleanup_namespaces(doc, top_nsmap=ALL_NAMESPACES)
+        serialised = etree.tostring(doc, encoding='UTF-8', xml_declaration=True,
+                                    pretty_print=PRETTY_CMDI_XML).decode('utf-8')
+
+        self.head, rest = serialised.split(PROXIES_MARKER)
+        self.middle, self.tail = rest.split(COMPONENTS_MARKER)
+        self.proxies_level = len(list(proxies_list.iterancestors()))
+        self.components_level = len(list(components_root.iterancestors()))
+        # prefixes as declared on the root after clean up, the default namespace has no prefix
+        self.prefixes = {uri: (f"{prefix}:" if prefix else '') for prefix, uri in doc.getroot().nsmap.items()}
+        self.metadata_info = etree.XML(make_metadata_info_xml(CREATION_DATE_MARKER), parser=parser)
+
+    def write_head(self, file, record_file_name, creation_date):
+        file.write(self.head
+                   .replace(RECORD_FILE_NAME_MARKER, escape_text(record_file_name))
+                   .replace(CREATION_DATE_MARKER, creation_date))
+
+
+def make_record_envelope(template, collection_id):
+    return CmdiEnvelope(template, collection_id,
+                        '/cmd:CMD/cmd:Resources/cmd:ResourceProxyList',
+                        '/cmd:CMD/cmd:Components/cmdp:TextResource')
+
+
+def make_collection_record_envelope(template, collection_id):
+    return CmdiEnvelope(template, collection_id,
+                        '/cmd:CMD/cmd:Resources/cmd:ResourceProxyList',
+                        '/cmd:CMD/cmd:Components/cmdp_c:MetadataCollection')
+
+
+class XmlStreamWriter:
+
+    def __init__(self, file, prefixes, level, pretty=PRETTY_CMDI_XML):
+        self.file = file
+        self.prefixes = prefixes
+        self.pretty = pretty
+        self.level = level
+        self.names = {}
+        self.open_elements = []
+        self.start_pending = False
+        self.has_content = False
+
+    def start(self, tag, attributes=None):
+        self.close_start()
+        if self.open_elements:
+            self.open_elements[-1][1] = True
+        else:
+            self.has_content = True
+        if self.pretty:
+            self.file.write('\n' + INDENT * (self.level + len(self.open_elements) + 1))
+
+        name = self.qname(tag)
+        self.file.write('<' + name)
+        if attributes:
+            for key, value in attributes.items():
+                self.file.write(f' {self.qname(key)}="{escape_attribute(value)}"')
+        self.open_elements += [[name, False]]
+        self.start_pending = True
+
+    def text(self, text):
+        self.close_start()
+        self.file.write(escape_text(text))
+
+    def end(self):
+        name, has_children = self.open_elements.pop()
+        if self.start_pending:
+            self.file.write('/>')
+            self.start_pending = False
+        else:
+            if has_children and self.pretty:
+                self.file.write('\n' + INDENT * (self.level + len(self.open_elements) + 1))
+            self.file.write('</' + name + '>')
+
+    def element(self, tag, text=None, attributes=None):
+        self.start(tag, attributes)
+        if text is not None:
+            self.text(text)
+        self.end()
+
+    def tree(self, element, replacements=None):
+        # write an existing (static) element tree, whitespace between elements is not content
+        self.start(element.tag, element.attrib)
+        if len(element) == 0:
+            if element.text is not None:
+                self.text(replace_all(element.text, replacements))
+        else:
+            if element.text is not None and element.text.strip():
+                self.text(replace_all(element.text, replacements))
+            for child in element:
+                self.tree(child, replacements)
+        self.end()
+
+    def finish(self):
+        # closing tag of the container follows
+        if self.has_content and self.pretty:
+            self.file.write('\n' + INDENT * self.level)
+
+    def close_start(self):
+        if self.start_pending:
+            self.file.write('>')
+            self.start_pending = False
+
+    def qname(self, tag):
+        name = self.names.get(tag, None)
+        if name is None:
+            if tag[0] == '{':
+                uri, local_name = tag[1:].split('}')
+                name = self.prefixes[uri] + local_name
+            else:
+                name = tag
+            self.names[tag] = name
+        return name
+
+
+@contextmanager
+def text_output(output):
+    # text on top of the binary output, which is left open
+    file = TextIOWrapper(output, encoding='utf-8', newline='')
+    try:
+        yield file
+    finally:
+        file.flush()
+        file.detach()
+
+
+def escape_text(text):
+    # raises ValueError for characters not allowed in XML, as lxml does when a tree is built
+    if INVALID_XML_CHARACTERS.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+
+
+def escape_attribute(text):
+    return escape_text(text).replace('"', '&quot;').replace('\n', '&#10;').replace('\t', '&#9;')
+
+
+def replace_all(text, replacements):
+    if replacements:
+        for old, new in replacements.items():
+            text = text.replace(old, new)
+    return text
+
+
+def write_cmdi_record(output, envelope, collection_id, title, year, records_map, record_file_name):
+    # output is a binary file
+    edm_records = get_record_facts(records_map)
+    creation_date = today_string()
+    with text_output(output) as file:
+        envelope.write_head(file, record_file_name, creation_date)
+
+        writer = XmlStreamWriter(file, envelope.prefixes, envelope.proxies_level)
+        write_resource_proxies(writer, collection_id, edm_records)
+        writer.finish()
+        file.write(envelope.middle)
+
+        writer = XmlStreamWriter(file, envelope.prefixes, envelope.components_level)
+        write_component_content(writer, envelope, title, year, edm_records, creation_date)
+        writer.finish()
+        file.write(envelope.tail)
+    return record_file_name
+
+
+def write_resource_proxies(writer, collection_id, edm_records):
+    write_common_resource_proxies(writer, collection_id)
+    # record landing pages
+    for record_page_ref in get_unique_fact_values(edm_records, 'landing_pages'):
+        write_resource_proxy(writer, make_record_page_ref(record_page_ref), "Resource",
+                             record_page_ref, RECORD_PAGE_MEDIA_TYPE)
+
+
+def write_common_resource_proxies(writer, collection_id):
+    # landing page
+    write_resource_proxy(writer, LANDING_PAGE_ID, "LandingPage", LANDING_PAGE_URL)
+    # dump URLs
+    write_resource_proxy(writer, EDM_DUMP_PROXY_ID, "Resource", make_edm_dump_ref(collection_id), DUMP_MEDIA_TYPE)
+    write_resource_proxy(writer, ALTO_DUMP_PROXY_ID, "Resource", make_alto_dump_ref(collection_id), DUMP_MEDIA_TYPE)
+
+
+def write_resource_proxy(writer, proxy_id, resource_type, ref, media_type=None):
+    writer.start('{' + CMD_NS + '}ResourceProxy', {'id': proxy_id})
+    writer.element('{' + CMD_NS + '}ResourceType', resource_type,
+                   {'mimetype': media_type} if media_type is not None else None)
+    writer.element('{' + CMD_NS + '}ResourceRef', ref)
+    writer.end()
+
+
+def write_component_content(writer, envelope, title, year, edm_records, creation_date):
+    ns = '{' + CMDP_NS_RECORD + '}'
+    # Title and description
+    write_title_and_description(writer, f"{title} - {year}", make_record_description(title, year), ns)
+    # Resource type, publisher, language information
+    write_keywords_publishers_languages(writer, edm_records, ns)
+    # Temporal coverage
+    writer.start(ns + 'TemporalCoverage')
+    writer.element(ns + 'label', year)
+    write_year_range(writer, year, year, ns)
+    writer.end()
+    # Countries and licence information
+    write_countries_and_licences(writer, edm_records, ns)
+    # Subresources
+    write_dump_subresource_info(writer, ns)
+    for record in edm_records:
+        write_issue_subresource_info(writer, record, ns)
+    # Metadata information
+    writer.tree(envelope.metadata_info, {CREATION_DATE_MARKER: creation_date})
+
+
+def write_title_and_description(writer, title, description, ns):
+    writer.start(ns + 'TitleInfo')
+    writer.element(ns + 'title', title)
+    writer.end()
+    writer.start(ns + 'Description')
+    writer.element(ns + 'description', description)
+    writer.end()
+    writer.start(ns + 'ResourceType')
+    writer.element(ns + 'label', "Text")
+    writer.end()
+
+
+def write_keywords_publishers_languages(writer, edm_records, ns):
+    for keyword in get_unique_fact_values(edm_records, 'types'):
+        writer.start(ns + 'Keyword')
+        writer.element(ns + 'label', keyword)
+        writer.end()
+    for publisher in get_unique_fact_values(edm_records, 'publishers'):
+        writer.start(ns + 'Publisher')
+        writer.element(ns + 'name', publisher)
+        writer.end()
+    for language_code in get_unique_fact_values(edm_records, 'languages'):
+        write_language(writer, language_code, ns)
+
+
+def write_year_range(writer, start, end, ns):
+    writer.start(ns + 'Start')
+    writer.element(ns + 'year', start)
+    writer.end()
+    writer.start(ns + 'End')
+    writer.element(ns + 'year', end)
+    writer.end()
+
+
+def write_countries_and_licences(writer, edm_records, ns):
+    for country in get_unique_fact_values(edm_records, 'countries'):
+        write_geolocation(writer, country, ns)
+    rights_urls = get_unique_fact_values(edm_records, 'rights')
+    if len(rights_urls) > 0:
+        writer.start(ns + 'AccessInfo')
+        for rights_url in rights_urls:
+            writer.start(ns + 'Licence')
+            writer.element(ns + 'identifier', rights_url)
+            writer.element(ns + 'label', rights_url)
+            writer.element(ns + 'url', rights_url)
+            writer.end()
+        writer.end()
+
+
+def write_geolocation(writer, country, ns):
+    writer.start(ns + 'GeoLocation')
+    writer.element(ns + 'label', country)
+    writer.start(ns + 'Country')
+    writer.element(ns + 'label', country)
+    writer.end()
+    writer.end()
+
+
+def write_language(writer, language_code, ns):
+    writer.start(ns + 'Language')
+    language = look_up_language(language_code)
+    if language is None:
+        writer.element(ns + 'name', language_code)
+    else:
+        writer.element(ns + 'name', language.name)
+        writer.element(ns + 'code', language.part3)
+    writer.end()
+
+
+def write_dump_subresource_info(writer, ns):
+    for proxy_id, label in DUMP_SUBRESOURCES:
+        writer.start(ns + 'Subresource', {CMD_REF: proxy_id})
+        writer.start(ns + 'SubresourceDescription')
+        writer.element(ns + 'label', label)
+        writer.end()
+        writer.end()
+
+
+def write_issue_subresource_info(writer, record, ns):
+    record_page_ref = record.get('landing_pages', [])
+    writer.start(ns + 'Subresource',
+                 {CMD_REF: make_record_page_ref(record_page_ref[0])} if len(record_page_ref) > 0 else None)
+    writer.start(ns + 'SubresourceDescription')
+
+    # title info
+    for title in record.get('titles', []):
+        writer.element(ns + 'label', title)
+
+    # identifier(s)
+    for identifier in record.get('identifiers', []):
+        writer.start(ns + 'IdentificationInfo')
+        normalized_id = normalize_identifier(identifier)
+        if identifier != normalized_id:
+            writer.element(ns + 'identifier', identifier)
+        writer.element(ns + 'identifier', normalized_id)
+        writer.end()
+
+    # languages
+    for language_code in record.get('languages', []):
+        write_language(writer, language_code, ns)
+
+    # temporal coverage
+    for issue_date in record.get('issued', []):
+        writer.start(ns + 'TemporalCoverage')
+        writer.element(ns + 'label', issue_date)
+        if is_valid_date(issue_date):
+            writer.start(ns + 'Start')
+            writer.element(ns + 'date', issue_date)
+            writer.end()
+            writer.start(ns + 'End')
+            writer.element(ns + 'date', issue_date)
+            writer.end()
+        writer.end()
+
+    # geolocation
+    for country in record.get('countries', []):
+        write_geolocation(writer, country, ns)
+
+    writer.end()
+    writer.end()
+
+
+# ###################
+# Collection records
+# ###################
+
+
+def write_collection_record(output, envelope, collection_id, title, year_files, facet_summary, file_name):
+    # output is a binary file
+    edm_records = [facet_summary]
+    sorted_years = sorted(list(year_files))
+    creation_date = today_string()
+    with text_output(output) as file:
+        envelope.write_head(file, file_name, creation_date)
+
+        writer = XmlStreamWriter(file, envelope.prefixes, envelope.proxies_level)
+        write_common_resource_proxies(writer, collection_id)
+        # links to metadata records
+        for year in sorted(year_files):
+            ref = f"{CMDI_RECORDS_BASE_URL}/{collection_id}/{year_files[year]}"
+            write_resource_proxy(writer, xml_id(year), "Metadata", ref)
+        writer.finish()
+        file.write(envelope.middle)
+
+        writer = XmlStreamWriter(file, envelope.prefixes, envelope.components_level)
+        write_collection_component_content(writer, envelope, title, sorted_years, year_files, edm_records,
+                                           creation_date)
+        writer.finish()
+        file.write(envelope.tail)
+    return file_name
+
+
+def write_collection_component_content(writer, envelope, title, sorted_years, year_files, edm_records,
+                                       creation_date):
+    ns = '{' + CMDP_NS_COLLECTION_RECORD + '}'
+    # Title and description
+    write_title_and_description(writer, f"{title}", make_collection_description(title, sorted_years), ns)
+    # Resource type, publisher, language information
+    write_keywords_publishers_languages(writer, edm_records, ns)
+    # Temporal coverage
+    writer.start(ns + 'TemporalCoverage')
+    writer.element(ns + 'label', f"{sorted_years[0]} - {sorted_years[-1]}")
+    write_year_range(writer, sorted_years[0], sorted_years[-1], ns)
+    writer.end()
+    # Countries and licence information
+    write_countries_and_licences(writer, edm_records, ns)
+    # Subresources
+    write_dump_subresource_info(writer, ns)
+    for year in sorted(year_files):
+        writer.start(ns + 'Subresource', {CMD_REF: xml_id(year)})
+        writer.start(ns + 'SubresourceDescription')
+        writer.element(ns + 'label', f"{title} - {year}")
+        writer.start(ns + 'TemporalCoverage')
+        writer.element(ns + 'label', year)
+        writer.end()
+        writer.end()
+        writer.end()
+    # Metadata information
+    writer.tree(envelope.metadata_info, {CREATION_DATE_MARKER: creation_date})
@@ -2,8 +2,6 @@ import os
 import re
 import logging
 import unidecode
-import requests
-import json
 
 DEFAULT_OUTPUT_DIRECTORY = "./output"
 DEFAULT_USER_AGENT = 'clarin-fulltext-aggregator/1.0'
@@ -138,7 +136,7 @@ def unique_filename(name, previous_names):
     else:
         new_name = name
 
-    previous_names += [new_name]
+    previous_names.add(new_name)
     return new_name
 
 
@@ -153,6 +151,10 @@ def get_all_xpath_values(docs, path):
     return values
 
 
+def get_unique_fact_values(facts_list, key):
+    return list(dict.fromkeys(value for facts in facts_list for value in facts.get(key, [])))
+
+
 def filter_fulltext_ids(ids, fulltext_dir):
     available_files = os.listdir(fulltext_dir)
     return list(filter(lambda identifier: id_to_fulltext_file(identifier) in available_files, ids))
@@ -172,37 +174,6 @@ def get_user_agent():
     return user_agent
 
 
-def http_request(url, session=None):
-    headers = {
-        'User-Agent': get_user_agent()
-    }
-
-    if session is None:
-        return requests.get(url, headers=headers)
-    else:
-        return session.get(url, headers=headers)
-
-
-def get_json_from_http(url, session=None):
-    logger.debug(f"Making request: {url}")
-    response = http_request(url, session)
-    logger.debug(f"API response for {url}: {response}")
-
-    response_content = response.text
-    if response_content is None:
-        logger.error(f"No response or invalid response from {url} ({response.status_code})")
-        return None
-
-    if response.status_code != requests.codes.ok:
-        logger.warning(f'Response status code: {response.status_code}')
-        logger.debug(f'Response content: {response_content[0:100]}...')
-
-    try:
-        return json.loads(response_content)
-    except json.JSONDecodeError:
-        logger.error(f"Error decoding response from {url}")
-
-
 def log_progress(logr, total, current, last_log, category=None, interval_pct=5, interval=-1):
     if last_log is None:
         last_log = 0
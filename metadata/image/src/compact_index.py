@@ -0,0 +1,166 @@
+from array import array
+from collections.abc import Mapping
+
+from edm_extraction import EDM_FACT_PATHS
+
+FACT_KEYS = list(EDM_FACT_PATHS)
+
+
+# The collection index (title -> year -> identifier -> {file, facts}) for large collections. All strings are interned
+# and referred to by integer id; records and their facts are kept in flat arrays, groups are arrays of record numbers.
+# A record is stored once, also if it is part of several groups. Reading works as with the nested dicts, the values
+# are made on access. Records of a group are pickled as plain dicts (ex. when sent to a pool worker).
+class CompactIndex(Mapping):
+
+    def __init__(self, fact_keys=None):
+        self.fact_keys = list(fact_keys or FACT_KEYS)
+        self.strings = []
+        self.string_ids = {}
+        # per record: identifier and file (string ids)
+        self.record_identifiers = array('I')
+        self.record_files = array('I')
+        # values of fact k of record r: fact_values[fact_offsets[r * K + k]:fact_offsets[r * K + k + 1]]
+        self.fact_offsets = array('I', [0])
+        self.fact_values = array('I')
+        # title id -> year id -> record numbers
+        self.groups = {}
+        # identifiers already in a group, only those need checking for duplicates
+        self.grouped_identifiers = bytearray()
+
+    def intern(self, value):
+        string_id = self.string_ids.get(value, None)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings += [value]
+            self.string_ids[value] = string_id
+        return string_id
+
+    def add_record(self, identifier, filename, facts):
+        # returns the record number, to add it to groups with add_to_group
+        self.record_identifiers.append(self.intern(identifier))
+        self.record_files.append(self.intern(filename))
+        facts = facts or {}
+        for key in self.fact_keys:
+            self.fact_values.extend(self.intern(value) for value in facts.get(key, []))
+            self.fact_offsets.append(len(self.fact_values))
+        return len(self.record_files) - 1
+
+    def add_to_group(self, title, year, record):
+        # as index[title][year][identifier] = record: a record with the same identifier is replaced, in place
+        years = self.groups.setdefault(self.intern(title), {})
+        group = years.setdefault(self.intern(year), array('I'))
+        identifier_id = self.record_identifiers[record]
+        if identifier_id >= len(self.grouped_identifiers):
+            self.grouped_identifiers.extend(bytes(identifier_id + 1 - len(self.grouped_identifiers)))
+        elif self.grouped_identifiers[identifier_id]:
+            for position, other in enumerate(group):
+                if self.record_identifiers[other] == identifier_id:
+                    group[position] = record
+                    return
+        self.grouped_identifiers[identifier_id] = 1
+        group.append(record)
+
+    def add(self, title, year, identifier, filename, facts):
+        self.add_to_group(title, year, self.add_record(identifier, filename, facts))
+
+    def get_facts(self, record):
+        strings = self.strings
+        offsets = self.fact_offsets[record * len(self.fact_keys):(record + 1) * len(self.fact_keys) + 1]
+        return {key: [strings[value_id] for value_id in self.fact_values[offsets[k]:offsets[k + 1]]]
+                for k, key in enumerate(self.fact_keys)}
+
+    def __getitem__(self, title):
+        title_id = self.string_ids.get(title, None)
+        if title_id is None or title_id not in self.groups:
+            raise KeyError(title)
+        return TitleView(self, self.groups[title_id])
+
+    def __iter__(self):
+        for title_id in self.groups:
+            yield self.strings[title_id]
+
+    def __len__(self):
+        return len(self.groups)
+
+    def record_count(self):
+        return len(self.record_files)
+
+
+class TitleView(Mapping):
+    __slots__ = ['index', 'years']
+
+    def __init__(self, index, years):
+        self.index = index
+        self.years = years
+
+    def __getitem__(self, year):
+        year_id = self.index.string_ids.get(year, None)
+        if year_id is None or year_id not in self.years:
+            raise KeyError(year)
+        return GroupView(self.index, self.years[year_id])
+
+    def __iter__(self):
+        for year_id in self.years:
+            yield self.index.strings[year_id]
+
+    def __len__(self):
+        return len(self.years)
+
+
+class GroupView(Mapping):
+    __slots__ = ['index', 'records', 'positions']
+
+    def __init__(self, index, records):
+        self.index = index
+        self.records = records
+        self.positions = None
+
+    def __getitem__(self, identifier):
+        if self.positions is None:
+            self.positions = {self.index.record_identifiers[record]: record for record in self.records}
+        identifier_id = self.index.string_ids.get(identifier, None)
+        if identifier_id is None or identifier_id not in self.positions:
+            raise KeyError(identifier)
+        return RecordView(self.index, self.positions[identifier_id])
+
+    def __iter__(self):
+        for record in self.records:
+            yield self.index.strings[self.index.record_identifiers[record]]
+
+    def __len__(self):
+        return len(self.records)
+
+    def items(self):
+        return [(self.index.strings[self.index.record_identifiers[record]], RecordView(self.index, record))
+                for record in self.records]
+
+    def values(self):
+        return [RecordView(self.index, record) for record in self.records]
+
+    def __reduce__(self):
+        return dict, (self.items(),)
+
+
+class RecordView(Mapping):
+    __slots__ = ['index', 'record']
+    KEYS = ('file', 'facts')
+
+    def __init__(self, index, record):
+        self.index = index
+        self.record = record
+
+    def __getitem__(self, key):
+        if key == 'file':
+            return self.index.strings[self.index.record_files[self.record]]
+        if key == 'facts':
+            return self.index.get_facts(self.record)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __reduce__(self):
+        return dict, ([(key, self[key]) for key in self.KEYS],)
@@ -0,0 +1,179 @@
+import logging
+
+from contextlib import nullcontext
+from lxml import etree
+
+from common import xpath, xpath_text_values
+from common import EDM_NAMESPACES
+
+logger = logging.getLogger(__name__)
+
+# Values extracted from each EDM record at indexing time, everything needed for CMDI generation
+EDM_FACT_PATHS = {
+    'landing_pages': '/rdf:RDF/edm:EuropeanaAggregation/edm:landingPage/@rdf:resource',
+    'types': '/rdf:RDF/ore:Proxy/dc:type/text()',
+    'publishers': '/rdf:RDF/ore:Aggregation/edm:dataProvider/text()'
+                  '|/rdf:RDF/ore:Aggregation/edm:provider/text()',
+    'languages': '/rdf:RDF/ore:Proxy/dc:language/text()',
+    'countries': '/rdf:RDF/edm:EuropeanaAggregation/edm:country/text()',
+    'rights': '/rdf:RDF/ore:Aggregation/edm:rights/@rdf:resource',
+    'titles': '/rdf:RDF/ore:Proxy/dc:title/text()',
+    'identifiers': '/rdf:RDF/ore:Proxy/dc:identifier/text()',
+    'issued': '/rdf:RDF/ore:Proxy/dcterms:issued/text()',
+}
+
+
+def ns_tag(prefix, name):
+    return '{' + EDM_NAMESPACES[prefix] + '}' + name
+
+
+RDF_ROOT = ns_tag('rdf', 'RDF')
+RDF_RESOURCE = ns_tag('rdf', 'resource')
+
+PROVIDED_CHO = ns_tag('edm', 'ProvidedCHO')
+AGGREGATION = ns_tag('ore', 'Aggregation')
+PROXY = ns_tag('ore', 'Proxy')
+EUROPEANA_AGGREGATION = ns_tag('edm', 'EuropeanaAggregation')
+
+DC_IDENTIFIER = ns_tag('dc', 'identifier')
+DC_LANGUAGE = ns_tag('dc', 'language')
+DC_TITLE = ns_tag('dc', 'title')
+DC_TYPE = ns_tag('dc', 'type')
+DCTERMS_IS_PART_OF = ns_tag('dcterms', 'isPartOf')
+DCTERMS_ISSUED = ns_tag('dcterms', 'issued')
+EDM_DATA_PROVIDER = ns_tag('edm', 'dataProvider')
+EDM_PROVIDER = ns_tag('edm', 'provider')
+EDM_RIGHTS = ns_tag('edm', 'rights')
+EDM_COUNTRY = ns_tag('edm', 'country')
+EDM_LANDING_PAGE = ns_tag('edm', 'landingPage')
+
+PROXY_TEXT_FACTS = {
+    DC_IDENTIFIER: 'identifiers',
+    DC_LANGUAGE: 'languages',
+    DC_TITLE: 'titles',
+    DC_TYPE: 'types',
+    DCTERMS_ISSUED: 'issued',
+}
+
+TEXT_NODES = etree.XPath('text()')
+
+
+def extract_with_xpath(source):
+    # full DOM, queries evaluated against the whole document
+    doc = etree.parse(source)
+    return {
+        'identifiers': xpath_text_values(doc, '/rdf:RDF/ore:Proxy/dc:identifier'),
+        'issued': xpath_text_values(doc, '/rdf:RDF/ore:Proxy/dcterms:issued'),
+        'part_of_refs': [str(ref) for ref in xpath(doc, '/rdf:RDF/ore:Proxy/dcterms:isPartOf/@rdf:resource')],
+        'cho_titles': xpath_text_values(doc, '/rdf:RDF/edm:ProvidedCHO/dc:title'),
+        'facts': extract_edm_facts(doc)
+    }
+
+
+def extract_edm_facts(doc):
+    # unique values per fact, in document order (plain strings, no references to the tree)
+    return {key: [str(value) for value in dict.fromkeys(xpath(doc, path))]
+            for key, path in EDM_FACT_PATHS.items()}
+
+
+def extract_with_iterparse(source):
+    # streaming: only the top level sections of interest are inspected, and everything read so far is
+    # discarded after each section. The whole document is read, as EDM does not fix the order of the
+    # sections (the Europeana proxy can come before that of the provider) and any of them can repeat
+    values = {
+        'identifiers': [],
+        'issued': [],
+        'part_of_refs': [],
+        'cho_titles': [],
+        'facts': {key: [] for key in EDM_FACT_PATHS}
+    }
+    with open_source(source) as file:
+        for _, element in etree.iterparse(file, events=('end',), tag=list(SECTION_READERS)):
+            parent = element.getparent()
+            if parent is None or parent.tag != RDF_ROOT or parent.getparent() is not None:
+                continue
+
+            SECTION_READERS[element.tag](element, values)
+
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+
+    values['facts'] = {key: list(dict.fromkeys(facts)) for key, facts in values['facts'].items()}
+    return values
+
+
+def text_values(element):
+    # equivalent of text() on the element
+    if len(element) == 0:
+        return [] if element.text is None else [element.text]
+    return [str(text) for text in TEXT_NODES(element)]
+
+
+def read_provided_cho(element, values):
+    for title in element.iterchildren(DC_TITLE):
+        values['cho_titles'] += [title.text]
+
+
+def read_aggregation(element, values):
+    facts = values['facts']
+    for child in element.iterchildren(EDM_DATA_PROVIDER, EDM_PROVIDER, EDM_RIGHTS):
+        if child.tag == EDM_RIGHTS:
+            append_resource(child, facts['rights'])
+        else:
+            facts['publishers'] += text_values(child)
+
+
+def read_proxy(element, values):
+    facts = values['facts']
+    for child in element.iterchildren(DCTERMS_IS_PART_OF, *PROXY_TEXT_FACTS):
+        if child.tag == DCTERMS_IS_PART_OF:
+            append_resource(child, values['part_of_refs'])
+        else:
+            facts[PROXY_TEXT_FACTS[child.tag]] += text_values(child)
+            if child.tag == DC_IDENTIFIER:
+                values['identifiers'] += [child.text]
+            elif child.tag == DCTERMS_ISSUED:
+                values['issued'] += [child.text]
+
+
+def read_europeana_aggregation(element, values):
+    facts = values['facts']
+    for child in element.iterchildren(EDM_COUNTRY, EDM_LANDING_PAGE):
+        if child.tag == EDM_COUNTRY:
+            facts['countries'] += text_values(child)
+        else:
+            append_resource(child, facts['landing_pages'])
+
+
+def append_resource(element, target):
+    resource = element.get(RDF_RESOURCE)
+    if resource is not None:
+        target += [resource]
+
+
+SECTION_READERS = {
+    PROVIDED_CHO: read_provided_cho,
+    AGGREGATION: read_aggregation,
+    PROXY: read_proxy,
+    EUROPEANA_AGGREGATION: read_europeana_aggregation,
+}
+
+EXTRACTORS = {
+    'xpath': extract_with_xpath,
+    'iterparse': extract_with_iterparse,
+}
+
+
+def open_source(source):
+    # extractors take a file path or an open (binary) file, ex. a member of a ZIP archive
+    if isinstance(source, str):
+        return open(source, 'rb')
+    return nullcontext(source)
+
+
+def get_extractor(name):
+    if name not in EXTRACTORS:
+        logger.error(f"Unknown EDM extractor '{name}', expecting one of {', '.join(EXTRACTORS)}")
+        exit(1)
+    return EXTRACTORS[name]
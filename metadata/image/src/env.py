@@ -1,4 +1,8 @@
 from common import get_optional_env_var, get_mandatory_env_var
+from response_cache import DEFAULT_MAX_SIZE_MB
+from title_cache import DEFAULT_TTL_DAYS
+
+TITLE_RESOLVERS = ['record', 'search']
 
 # Mandatory variables
 RECORD_API_KEY = get_mandatory_env_var(
@@ -20,12 +24,93 @@ LANDING_PAGE_URL = get_optional_env_var(
 RECORD_API_URL = get_optional_env_var(
     'RECORD_API_URL',
     'https://api.europeana.eu/record/v2')
+IIIF_CACHE_FILE = get_optional_env_var(
+    'IIIF_CACHE_FILE') or None
+IIIF_CACHE_MAX_SIZE = int(get_optional_env_var(
+    'IIIF_CACHE_MAX_SIZE',
+    str(DEFAULT_MAX_SIZE_MB)))
+IIIF_CACHE_MAX_AGE = float(get_optional_env_var(
+    'IIIF_CACHE_MAX_AGE',
+    '0'))
+HTTP_CONNECT_TIMEOUT = float(get_optional_env_var(
+    'HTTP_CONNECT_TIMEOUT',
+    '10'))
+HTTP_READ_TIMEOUT = float(get_optional_env_var(
+    'HTTP_READ_TIMEOUT',
+    '60'))
+HTTP_MAX_RETRIES = int(get_optional_env_var(
+    'HTTP_MAX_RETRIES',
+    '5'))
+HTTP_BACKOFF_BASE = float(get_optional_env_var(
+    'HTTP_BACKOFF_BASE',
+    '0.5'))
+HTTP_BACKOFF_MAX = float(get_optional_env_var(
+    'HTTP_BACKOFF_MAX',
+    '60'))
+HTTP_RATE_LIMIT = float(get_optional_env_var(
+    'HTTP_RATE_LIMIT',
+    '10'))
+HTTP_POOL_SIZE = int(get_optional_env_var(
+    'HTTP_POOL_SIZE',
+    '10'))
 FILE_PROCESSING_THREAD_POOL_SIZE = int(get_optional_env_var(
     'FILE_PROCESSING_THREAD_POOL_SIZE',
     '5'))
+FILE_PROCESSING_CHUNK_SIZE = int(get_optional_env_var(
+    'FILE_PROCESSING_CHUNK_SIZE',
+    '0'))
+FILE_PROCESSING_MAX_IN_FLIGHT = int(get_optional_env_var(
+    'FILE_PROCESSING_MAX_IN_FLIGHT',
+    '1000'))
 API_RETRIEVAL_THREAD_POOL_SIZE = int(get_optional_env_var(
     'API_RETRIEVAL_THREAD_POOL_SIZE',
     '1'))
+CMDI_GENERATION_THREAD_POOL_SIZE = int(get_optional_env_var(
+    'CMDI_GENERATION_THREAD_POOL_SIZE',
+    '5'))
+TITLE_RESOLUTION_THREAD_POOL_SIZE = int(get_optional_env_var(
+    'TITLE_RESOLUTION_THREAD_POOL_SIZE',
+    '4'))
+TITLE_RESOLVER = get_optional_env_var(
+    'TITLE_RESOLVER',
+    'record')
+if TITLE_RESOLVER not in TITLE_RESOLVERS:
+    print(f"ERROR: unknown TITLE_RESOLVER '{TITLE_RESOLVER}', expecting one of {', '.join(TITLE_RESOLVERS)}")
+    exit(1)
+SEARCH_API_URL = get_optional_env_var(
+    'SEARCH_API_URL',
+    f"{RECORD_API_URL}/search.json")
+TITLE_SEARCH_BATCH_SIZE = int(get_optional_env_var(
+    'TITLE_SEARCH_BATCH_SIZE',
+    '50'))
+TITLE_CACHE_FILE = get_optional_env_var(
+    'TITLE_CACHE_FILE')
+TITLE_CACHE_TTL_DAYS = float(get_optional_env_var(
+    'TITLE_CACHE_TTL_DAYS',
+    str(DEFAULT_TTL_DAYS)))
 PRETTY_CMDI_XML = 'TRUE' == get_optional_env_var(
     'PRETTY_CMDI_XML',
     "False").upper()
+EDM_EXTRACTOR = get_optional_env_var(
+    'EDM_EXTRACTOR',
+    'xpath')
+CMDI_WRITER = get_optional_env_var(
+    'CMDI_WRITER',
+    'tree')
+MAX_MEMORY = int(get_optional_env_var(
+    'MAX_MEMORY',
+    '0'))
+EXTERNAL_SORT_DIR = get_optional_env_var(
+    'EXTERNAL_SORT_DIR') or None
+METRICS_JSON_FILE = get_optional_env_var(
+    'METRICS_JSON_FILE')
+METRICS_PROMETHEUS_FILE = get_optional_env_var(
+    'METRICS_PROMETHEUS_FILE')
+PROFILE_DIR = get_optional_env_var(
+    'PROFILE_DIR') or None
+PROFILE_MEMORY = 'TRUE' == get_optional_env_var(
+    'PROFILE_MEMORY',
+    "False").upper()
+PROFILE_TOP_N = int(get_optional_env_var(
+    'PROFILE_TOP_N',
+    '20'))
@@ -0,0 +1,85 @@
+import heapq
+import logging
+import os
+import pickle
+
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+# runs merged at once, more are first merged into intermediate runs
+MAX_FAN_IN = 64
+# per item, on top of its pickled size
+ITEM_OVERHEAD = 120
+
+
+# Sorts (key, value) items that do not all fit in memory: items are buffered up to max_memory bytes (estimated from
+# their pickled size), then sorted and written to a run file. Reading the result merges all runs. Items with equal keys
+# come out in the order in which they were added.
+class ExternalSorter:
+
+    def __init__(self, directory, max_memory):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.buffer = []
+        self.buffer_size = 0
+        self.runs = []
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, key, value):
+        blob = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        self.buffer += [(key, self.count, blob)]
+        self.count += 1
+        self.buffer_size += len(blob) + ITEM_OVERHEAD
+        if self.buffer_size >= self.max_memory:
+            self.spill()
+
+    def spill(self):
+        if not self.buffer:
+            return
+        self.buffer.sort(key=itemgetter(0, 1))
+        path = f"{self.directory}/run_{len(self.runs)}"
+        with open(path, 'wb') as file:
+            for _, _, blob in self.buffer:
+                file.write(blob)
+        logger.debug(f"Wrote {len(self.buffer)} items ({self.buffer_size:,} bytes) to {path}")
+        self.runs += [path]
+        self.buffer = []
+        self.buffer_size = 0
+
+    def sorted(self):
+        # (key, value) in key order; can be read once
+        if not self.runs:
+            self.buffer.sort(key=itemgetter(0, 1))
+            buffer, self.buffer = self.buffer, []
+            return (pickle.loads(blob) for _, _, blob in buffer)
+
+        self.spill()
+        logger.info(f"Merging {self.count} items from {len(self.runs)} sorted runs in {self.directory}")
+        runs = list(self.runs)
+        while len(runs) > MAX_FAN_IN:
+            path = f"{self.directory}/run_{len(self.runs)}"
+            with open(path, 'wb') as file:
+                for item in merge_runs(runs[:MAX_FAN_IN]):
+                    pickle.dump(item, file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.runs += [path]
+            runs = [path] + runs[MAX_FAN_IN:]
+        return merge_runs(runs)
+
+
+def merge_runs(paths):
+    # runs are read in order, so items with equal keys keep the order of the runs
+    readers = [read_run(path) for path in paths]
+    yield from heapq.merge(*readers, key=itemgetter(0))
+
+
+def read_run(path):
+    with open(path, 'rb') as file:
+        unpickler = pickle.Unpickler(file)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                break
+    os.remove(path)
@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+# Append-only journal of a IIIF harvest (see retrieve_iiif_annotations.py): a line of JSON per harvested manifest with
+# its status and full text references, written through to disk before the next one. A manifest is done if it was
+# retrieved with its canvases and so were all its annotation lists (see retrieve_iiif_annotations.harvest_manifests).
+# A harvest restarted with the same journal skips the manifests that are done and retries the failed ones and those it
+# did not get to. A last line that was cut off when a run was killed is dropped when the journal is opened; of several
+# lines for a manifest, the last one counts.
+class HarvestJournal:
+
+    def __init__(self, path):
+        self.path = path
+        # manifest URL -> {'status', 'refs': [(fulltext ref, label), ...]}
+        self.entries = {}
+        self.recover()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def recover(self):
+        if not os.path.exists(self.path):
+            return
+        # end of the last complete line
+        end = 0
+        with open(self.path, 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                end += len(line)
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry['manifest']] = {'status': entry['status'],
+                                                       'refs': [tuple(ref) for ref in entry['refs']]}
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(f"Skipping invalid line in {self.path}: {line[:100]}")
+        if end < os.path.getsize(self.path):
+            logger.warning(f"Dropping incomplete last line of {self.path}")
+            os.truncate(self.path, end)
+
+    def record(self, manifest_url, refs, complete):
+        entry = {'manifest': manifest_url, 'status': DONE if complete else FAILED, 'refs': [list(ref) for ref in refs]}
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries[manifest_url] = {'status': entry['status'], 'refs': list(refs)}
+
+    def is_done(self, manifest_url):
+        entry = self.entries.get(manifest_url, None)
+        return entry is not None and entry['status'] == DONE
+
+    def pending(self, manifest_urls):
+        # the manifests still to harvest, once each, in order
+        return [url for url in dict.fromkeys(manifest_urls) if not self.is_done(url)]
+
+    def refs(self, manifest_url):
+        entry = self.entries.get(manifest_url, None)
+        return entry['refs'] if entry else []
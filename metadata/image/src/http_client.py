@@ -0,0 +1,243 @@
+import json
+import logging
+import metrics
+import os
+import random
+import requests
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+from common import get_user_agent
+from env import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_POOL_SIZE
+from env import HTTP_MAX_RETRIES, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_RATE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# responses worth another try, after slowing down: the server is (temporarily) overloaded or failing
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# longest Retry-After honoured (seconds)
+MAX_RETRY_AFTER = 600
+# the request rate of a host is halved after a failed or throttled request, but at most once per interval (seconds),
+# so that a burst of failures of concurrent requests counts once, and not below the minimum (requests per second)
+RATE_DECREASE_INTERVAL = 1.0
+MIN_RATE = 0.5
+# part of the configured rate added after a successful request
+RATE_INCREASE = 0.05
+
+
+# Token bucket limiting the requests to a host, shared by all threads of a process. The rate adapts to the host:
+# it is lowered on errors and throttled responses and raised again (up to the configured rate) while requests succeed;
+# a Retry-After pauses all requests to the host.
+class TokenBucket:
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.updated = self.paused_until
+
+    def slow_down(self):
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.decreased + RATE_DECREASE_INTERVAL:
+                self.rate = max(min(MIN_RATE, self.max_rate), self.rate / 2)
+                self.decreased = now
+            return self.rate
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE * self.max_rate)
+            return self.rate
+
+
+# Per host: a session keeping up to HTTP_POOL_SIZE connections alive, and the rate limiter of the host
+class HostClient:
+
+    def __init__(self, host):
+        self.host = host
+        self.session = requests.Session()
+        # retries are done by HttpClient, which also knows about rate limits
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.bucket = TokenBucket(HTTP_RATE_LIMIT) if HTTP_RATE_LIMIT > 0 else None
+
+
+class HttpClient:
+
+    def __init__(self):
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def get_host_client(self, host):
+        with self.lock:
+            client = self.hosts.get(host, None)
+            if client is None:
+                client = self.hosts[host] = HostClient(host)
+            return client
+
+    def get(self, url, session=None, headers=None):
+        # response of the last attempt; raises requests.RequestException if no attempt got a response
+        host = urlparse(url).hostname
+        client = self.get_host_client(host)
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            last_attempt = attempt == HTTP_MAX_RETRIES
+            if client.bucket:
+                client.bucket.acquire()
+            start_time = time.perf_counter()
+            try:
+                response = (session or client.session).get(url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                                                            headers={'User-Agent': get_user_agent(),
+                                                                     **(headers or {})})
+            except requests.RequestException as e:
+                metrics.inc('http_requests_total', host=host, status='error')
+                if not isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                    raise
+                self.slow_down(client)
+                if last_attempt:
+                    raise
+                logger.warning(f"Request to {url} failed ({type(e).__name__}), retrying")
+                self.back_off(host, attempt, 'error')
+                continue
+            finally:
+                metrics.observe('http_request_duration_seconds', time.perf_counter() - start_time, host=host)
+            metrics.inc('http_requests_total', host=host, status=response.status_code)
+
+            if response.status_code not in RETRY_STATUS_CODES:
+                if client.bucket:
+                    metrics.set_gauge('http_rate_limit', client.bucket.speed_up(), host=host)
+                return response
+            self.slow_down(client)
+            if last_attempt:
+                return response
+
+            logger.warning(f"Response {response.status_code} from {url}, retrying")
+            retry_after = get_retry_after(response)
+            if retry_after is None:
+                self.back_off(host, attempt, response.status_code)
+            else:
+                metrics.inc('http_retries_total', host=host, reason=response.status_code)
+                if client.bucket:
+                    # holds all threads requesting from the host
+                    client.bucket.pause(retry_after)
+                else:
+                    time.sleep(retry_after)
+
+    def slow_down(self, client):
+        if client.bucket:
+            rate = client.bucket.slow_down()
+            metrics.set_gauge('http_rate_limit', rate, host=client.host)
+            logger.debug(f"Request rate for {client.host} lowered to {rate:.2f}/s")
+
+    def back_off(self, host, attempt, reason):
+        # exponential backoff with full jitter
+        metrics.inc('http_retries_total', host=host, reason=reason)
+        time.sleep(random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt)))
+
+
+def get_retry_after(response):
+    # Retry-After in seconds (a number of seconds or an HTTP date), None if absent or invalid
+    value = response.headers.get('Retry-After', None)
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+
+def get_json_from_http(url, session=None, cache=None):
+    # connections, rate limits and retries are handled by the shared client; a session can be given to use
+    # (only) its connections instead. With a cache (ResponseCache), a cached response is revalidated with a
+    # conditional request, or used as is if it is fresh enough. Returns the decoded document, {} if there is no such
+    # document (404) and None if the request failed
+    logger.debug(f"Making request: {url}")
+    entry = cache.get(url) if cache else None
+    if entry and entry['fresh']:
+        cache.touch(url)
+        count_cache_result(cache, 'hit')
+        return decode_json(entry['body'], url)
+
+    headers = {}
+    if entry and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    response = CLIENT.get(url, session, headers)
+    logger.debug(f"API response for {url}: {response}")
+
+    if entry and response.status_code == requests.codes.not_modified:
+        cache.touch(url, validated=True)
+        count_cache_result(cache, 'revalidated')
+        return decode_json(entry['body'], url)
+
+    response_content = response.text
+    if response.status_code == requests.codes.not_found:
+        # a genuine miss: an empty document, which callers can remember as 'not found'
+        logger.warning(f"Not found: {url}")
+        return {}
+    if response.status_code != requests.codes.ok:
+        # an error response (after the retries of the client) is no answer, its body is not data
+        logger.error(f"Request to {url} failed with status {response.status_code}")
+        logger.debug(f'Response content: {response_content[0:100]}...')
+        return None
+
+    if cache:
+        cache.put(url, response_content, response.headers.get('ETag', None), response.headers.get('Last-Modified', None))
+        count_cache_result(cache, 'changed' if entry else 'miss')
+
+    return decode_json(response_content, url)
+
+
+def decode_json(content, url):
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        logger.error(f"Error decoding response from {url}")
+
+
+def count_cache_result(cache, result):
+    cache.count(result)
+    metrics.inc('http_cache_requests_total', result=result)
+
+
+def reset():
+    # a forked (pool worker) process makes connections of its own
+    global CLIENT
+    CLIENT = HttpClient()
+
+
+CLIENT = HttpClient()
+os.register_at_fork(after_in_child=reset)
@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from compact_index import CompactIndex
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT_VERSION = '1'
+
+
+# The collection index (title -> year -> identifier -> {file, facts}) stored in SQLite, one row per entry. Rows are
+# numbered in index order, so loading reproduces the same (dict) order and thus the same output.
+def save_index(index, path, collection_id=None):
+    temp_path = f"{path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE records ('
+                           'seq INTEGER PRIMARY KEY, '
+                           'title TEXT, '
+                           'year TEXT, '
+                           'identifier TEXT, '
+                           'file TEXT, '
+                           'facts TEXT)')
+        connection.executemany('INSERT INTO info (key, value) VALUES (?, ?)', [
+            ('version', INDEX_FORMAT_VERSION),
+            ('collection_id', collection_id),
+            ('created', time.strftime('%Y-%m-%dT%H:%M:%S'))
+        ])
+        connection.executemany('INSERT INTO records (title, year, identifier, file, facts) VALUES (?, ?, ?, ?, ?)',
+                               ((title, year, identifier, record.get('file'), json.dumps(record.get('facts')))
+                                for title in index
+                                for year in index[title]
+                                for identifier, record in index[title][year].items()))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temp_path, path)
+    logger.info(f"Index with {len(index)} titles saved to {path}")
+
+
+def load_index(path):
+    index = CompactIndex()
+    for title, year, records in iterate_index_groups(path):
+        for identifier, record in records.items():
+            index.add(title, year, identifier, record['file'], record['facts'])
+    logger.info(f"Index with {len(index)} titles loaded from {path}")
+    return index
+
+
+def iterate_index_groups(path):
+    # (title, year, {identifier: {file, facts}}) for each group, in index order, without loading everything at once
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        version = connection.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+        if version is None or version[0] != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format in {path}")
+
+        # rows of a group are stored consecutively
+        current = None
+        records = {}
+        for title, year, identifier, file, facts in connection.execute(
+                'SELECT title, year, identifier, file, facts FROM records ORDER BY seq'):
+            if (title, year) != current:
+                if current is not None:
+                    yield current[0], current[1], records
+                current = (title, year)
+                records = {}
+            records[identifier] = {
+                'file': file,
+                'facts': json.loads(facts)
+            }
+        if current is not None:
+            yield current[0], current[1], records
+    finally:
+        connection.close()
@@ -0,0 +1,44 @@
+import logging
+import os
+import zipfile
+
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+# Europeana metadata dumps are ZIP archives with one EDM file per record, in subdirectories. Instead of extracting them,
+# members are read directly by random access through the central directory. Members are known by their base name, like
+# the files of an extracted and flattened dump.
+
+def is_metadata_archive(path):
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
+
+
+def list_archive_members(path):
+    # (base name -> member name, base name -> [size, CRC]) in archive order; of several members with the same base
+    # name only the first is used
+    members = {}
+    stats = {}
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            filename = os.path.basename(info.filename)
+            if filename in members:
+                logger.warning(f"Skipping {info.filename} in {path}: duplicate of {members[filename]}")
+                continue
+            members[filename] = info.filename
+            stats[filename] = [info.file_size, info.CRC]
+    return members, stats
+
+
+def open_archive_member(path, member):
+    return get_archive(path).open(member)
+
+
+@lru_cache(maxsize=None)
+def get_archive(path):
+    # one open archive per (worker) process; the parent process never opens one through here, so forked workers do not
+    # share a file position
+    return zipfile.ZipFile(path)
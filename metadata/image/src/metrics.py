@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Counters, gauges, histograms and stage timers of a run. Every process records into its own registry; pool workers
+# send what they recorded back with their results (see WorkerFunction), to be merged into the registry of the parent.
+# Keys are (name, ((label, value), ...)).
+#
+# The text extraction image has a copy of this module (text/image/src/metrics.py), as each image is built from its own
+# src directory. Keep the two the same (only this one refers to profiling.py, which the text image does not have), so
+# that the metrics of both pipelines keep the same format.
+class Metrics:
+
+    def __init__(self):
+        # told when a stage is entered and left (see profiling.py)
+        self.stage_listeners = []
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.stages = {}
+
+    def inc(self, name, value=1, **labels):
+        key = make_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        # the highest value is kept as well, as <name>_max
+        key = make_key(name, labels)
+        max_key = make_key(f"{name}_max", labels)
+        with self.lock:
+            self.gauges[key] = value
+            self.gauges[max_key] = max(value, self.gauges.get(max_key, value))
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = make_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                # counts per bucket, the last one for values above the highest bound
+                histogram = self.histograms[key] = {'bounds': list(buckets), 'counts': [0] * (len(buckets) + 1),
+                                                    'sum': 0.0, 'count': 0}
+            histogram['counts'][bisect_left(histogram['bounds'], value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def add_stage(self, name, wall_seconds, cpu_seconds, calls=1):
+        with self.lock:
+            totals = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            totals['calls'] += calls
+            totals['wall_seconds'] += wall_seconds
+            totals['cpu_seconds'] += cpu_seconds
+
+    @contextmanager
+    def stage(self, name):
+        # wall and CPU time of a stage; CPU time includes that of pool workers that were ended within the stage
+        for listener in self.stage_listeners:
+            listener.enter_stage(name)
+        wall, cpu = time.perf_counter(), get_cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, get_cpu_time() - cpu
+            for listener in reversed(self.stage_listeners):
+                listener.exit_stage(name)
+            self.add_stage(name, wall, cpu)
+
+    def take(self):
+        # everything recorded so far as plain data, after which the registry starts over
+        with self.lock:
+            snapshot = self.counters, self.gauges, self.histograms, self.stages
+            self.counters, self.gauges, self.histograms, self.stages = {}, {}, {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        counters, gauges, histograms, stages = snapshot
+        for key, value in counters.items():
+            self.inc(key[0], value, **dict(key[1]))
+        with self.lock:
+            for key, value in gauges.items():
+                if key[0].endswith('_max'):
+                    value = max(value, self.gauges.get(key, value))
+                self.gauges[key] = value
+            for key, histogram in histograms.items():
+                totals = self.histograms.get(key, None)
+                if totals is None or totals['bounds'] != histogram['bounds']:
+                    self.histograms[key] = histogram
+                else:
+                    totals['counts'] = [a + b for a, b in zip(totals['counts'], histogram['counts'])]
+                    totals['sum'] += histogram['sum']
+                    totals['count'] += histogram['count']
+        for name, totals in stages.items():
+            self.add_stage(name, totals['wall_seconds'], totals['cpu_seconds'], totals['calls'])
+
+    def get_stage_seconds(self, name):
+        return self.stages.get(name, {}).get('wall_seconds', 0.0)
+
+    def to_dict(self):
+        return {
+            'stages': self.stages,
+            'counters': {format_key(key): value for key, value in sorted(self.counters.items())},
+            'gauges': {format_key(key): value for key, value in sorted(self.gauges.items())},
+            'histograms': {format_key(key): {
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'buckets': dict(zip([str(bound) for bound in histogram['bounds']] + ['+Inf'],
+                                    cumulate(histogram['counts']))),
+                'p50': estimate_quantile(histogram, .5),
+                'p95': estimate_quantile(histogram, .95),
+                'p99': estimate_quantile(histogram, .99)
+            } for key, histogram in sorted(self.histograms.items())}
+        }
+
+    def to_prometheus(self, prefix):
+        # text exposition format, for the node exporter textfile collector: metric name -> (type, samples)
+        metrics = {}
+
+        def add(name, metric_type, key, value):
+            metrics.setdefault(f"{prefix}_{name}", (metric_type, []))[1].append(f"{prefix}_{format_key(key)} {value}")
+
+        for name, totals in self.stages.items():
+            for measure in ['wall_seconds', 'cpu_seconds', 'calls']:
+                add(f"stage_{measure}", 'gauge', (f"stage_{measure}", (('stage', name),)), totals[measure])
+        for key, value in sorted(self.counters.items()):
+            add(key[0], 'counter', key, value)
+        for key, value in sorted(self.gauges.items()):
+            add(key[0], 'gauge', key, value)
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            for bound, count in zip([str(bound) for bound in histogram['bounds']] + ['+Inf'],
+                                    cumulate(histogram['counts'])):
+                add(name, 'histogram', (f"{name}_bucket", labels + (('le', bound),)), count)
+            add(name, 'histogram', (f"{name}_sum", labels), histogram['sum'])
+            add(name, 'histogram', (f"{name}_count", labels), histogram['count'])
+        add('last_run_timestamp_seconds', 'gauge', ('last_run_timestamp_seconds', ()), f"{time.time():.0f}")
+
+        lines = []
+        for name, (metric_type, samples) in metrics.items():
+            lines += [f"# TYPE {name} {metric_type}"] + samples
+        return ''.join(f"{line}\n" for line in lines)
+
+
+# Wraps a function to run in pool workers: it returns (result, metrics recorded by the worker for it), see collect
+class WorkerFunction:
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args):
+        result = self.function(*args)
+        return result, REGISTRY.take()
+
+
+def collect(results):
+    # results of a WorkerFunction, with the worker metrics merged into the registry of this process
+    for result, snapshot in results:
+        REGISTRY.merge(snapshot)
+        yield result
+
+
+def make_key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def format_key(key):
+    name, labels = key
+    if not labels:
+        return name
+    label_values = ','.join(f'{label}="{escape_label_value(value)}"' for label, value in labels)
+    return f"{name}{{{label_values}}}"
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def cumulate(counts):
+    total = 0
+    cumulative = []
+    for count in counts:
+        total += count
+        cumulative += [total]
+    return cumulative
+
+
+def estimate_quantile(histogram, quantile):
+    # upper bound of the bucket the quantile falls in (None if above the highest bound, or no observations)
+    if histogram['count'] == 0:
+        return None
+    rank = quantile * histogram['count']
+    for bound, count in zip(histogram['bounds'], cumulate(histogram['counts'])):
+        if count >= rank:
+            return bound
+    return None
+
+
+def get_cpu_time():
+    # this process and its ended (and waited for) child processes
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def write_reports(json_file=None, prometheus_file=None, prefix='aggregation'):
+    # summary in the log, and to the files given; files are replaced in one go, so that a collector never reads
+    # a partial file
+    log_summary()
+    if json_file:
+        write_atomically(json_file, json.dumps(REGISTRY.to_dict(), indent=2))
+        logger.info(f"Wrote metrics to {json_file}")
+    if prometheus_file:
+        write_atomically(prometheus_file, REGISTRY.to_prometheus(prefix))
+        logger.info(f"Wrote metrics to {prometheus_file}")
+
+
+def write_atomically(path, content):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{path}.tmp", 'w') as file:
+        file.write(content)
+    os.replace(f"{path}.tmp", path)
+
+
+def log_summary():
+    for name, totals in REGISTRY.stages.items():
+        logger.info(f"Stage {name}: {totals['wall_seconds']:,.2f} s wall, {totals['cpu_seconds']:,.2f} s CPU, "
+                    f"{totals['calls']} calls")
+    for key, value in sorted(REGISTRY.counters.items()):
+        logger.info(f"{format_key(key)}: {value:,}")
+    for key, histogram in sorted(REGISTRY.histograms.items()):
+        if histogram['count'] > 0:
+            logger.info(f"{format_key(key)}: {histogram['count']:,} observations, "
+                        f"mean {histogram['sum'] / histogram['count']:.3f}, "
+                        f"p95 <= {estimate_quantile(histogram, .95)}")
+
+
+REGISTRY = Metrics()
+# a forked (pool worker) process starts with an empty registry, and a lock not held by any of the parent's threads
+os.register_at_fork(after_in_child=REGISTRY.reset)
+
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set_gauge
+observe = REGISTRY.observe
+stage = REGISTRY.stage
@@ -0,0 +1,153 @@
+import cProfile
+import glob
+import io
+import logging
+import metrics
+import os
+import pstats
+import re
+import tracemalloc
+
+from common import filename_safe
+from contextlib import contextmanager
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# set by start(), profiling is off otherwise
+PROFILER = None
+
+
+# Profiles the stages of the pipeline (see metrics.stage) with cProfile, a profile per stage name. Only one profiler
+# can be active at a time, so a nested stage pauses the stage around it: each profile holds the time spent in the stage
+# itself. A pool worker has a single profile, for the stage the pool was made in. Profiles and (optionally) tracemalloc
+# snapshots at the end of outermost stages are written to the profile directory as <stage>[.worker-<pid>].pstats and
+# .tracemalloc. Peak memory is reported per stage, including nested stages.
+class StageProfiler:
+
+    def __init__(self, directory, memory=False, suffix=''):
+        self.directory = directory
+        self.memory = memory
+        self.suffix = suffix
+        self.profiles = {}
+        self.stack = []
+        # with memory: traced peak so far per open stage, and the highest peak per stage name
+        self.stage_peaks = []
+        self.peak_memory = {}
+
+    def enter_stage(self, name):
+        if self.stack:
+            self.profiles[self.stack[-1]].disable()
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # the peak of the enclosing stage so far is kept before the peak is reset for this one
+            if self.stack:
+                self.stage_peaks[-1] = max(self.stage_peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.stage_peaks += [0]
+        self.stack += [name]
+        self.profiles.setdefault(name, cProfile.Profile()).enable()
+
+    def exit_stage(self, name):
+        self.profiles[self.stack.pop()].disable()
+        if self.memory:
+            peak = max(self.stage_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            self.peak_memory[name] = max(peak, self.peak_memory.get(name, 0))
+            if self.stack:
+                # a peak of a nested stage is one of the stage around it
+                self.stage_peaks[-1] = max(self.stage_peaks[-1], peak)
+            else:
+                # snapshots (which take a while) of outermost stages only, not of the stages entered per task
+                tracemalloc.take_snapshot().dump(self.get_path(name, 'tracemalloc'))
+        if self.stack:
+            self.profiles[self.stack[-1]].enable()
+
+    def pause(self):
+        if self.stack:
+            self.profiles[self.stack[-1]].disable()
+
+    def get_path(self, name, extension):
+        return f"{self.directory}/{filename_safe(name)}{self.suffix}.{extension}"
+
+    def dump(self):
+        # stages still open (those of pool workers) end here
+        while self.stack:
+            self.exit_stage(self.stack[-1])
+        for name, profile in self.profiles.items():
+            profile.dump_stats(self.get_path(name, 'pstats'))
+        for name, peak in self.peak_memory.items():
+            logger.info(f"Peak traced memory in stage {name}{self.suffix}: {peak / 1024 / 1024:,.1f} MiB")
+
+
+def start(directory, memory=False):
+    # profile the stages of this process, and of the pool workers made with make_pool
+    global PROFILER
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(f"{directory}/*.pstats") + glob.glob(f"{directory}/*.tracemalloc"):
+        os.remove(path)
+    PROFILER = StageProfiler(directory, memory)
+    metrics.REGISTRY.stage_listeners += [PROFILER]
+    logger.info(f"Profiling stages to {directory}{' (with tracemalloc)' if memory else ''}")
+
+
+def start_worker(directory, memory, stage):
+    # pool initializer: the whole worker process is profiled as part of the stage the pool was made in, stages within
+    # tasks (entered for every task) do not get profiles of their own
+    global PROFILER
+    if PROFILER is not None:
+        # inherited from the parent, which was profiling when forking
+        PROFILER.pause()
+    PROFILER = StageProfiler(directory, memory, suffix=f".worker-{os.getpid()}")
+    metrics.REGISTRY.stage_listeners = []
+    PROFILER.enter_stage(stage)
+    # runs when the worker ends normally (not when it is terminated), see make_pool
+    Finalize(PROFILER, PROFILER.dump, exitpriority=10)
+
+
+@contextmanager
+def make_pool(processes):
+    # a process pool; when profiling, its workers are profiled and, to have them write their profiles, ended normally
+    if PROFILER is None:
+        with Pool(processes) as pool:
+            yield pool
+        return
+
+    stage = PROFILER.stack[-1] if PROFILER.stack else 'pool'
+    with Pool(processes, initializer=start_worker, initargs=(PROFILER.directory, PROFILER.memory, stage)) as pool:
+        yield pool
+        pool.close()
+        pool.join()
+
+
+def finish(top_n=20):
+    # write the profiles of this process, then report the functions with the most time of their own, per stage
+    # (over this process and all workers) and overall
+    if PROFILER is None:
+        return
+    PROFILER.dump()
+
+    files_by_stage = {}
+    for path in sorted(glob.glob(f"{PROFILER.directory}/*.pstats")):
+        stage = re.sub(r'(\.worker-\d+)?\.pstats$', '', os.path.basename(path))
+        files_by_stage[stage] = files_by_stage.get(stage, []) + [path]
+
+    report_path = f"{PROFILER.directory}/report.txt"
+    with open(report_path, 'w') as file:
+        for stage, paths in files_by_stage.items():
+            file.write(f"==== {stage} ({len(paths)} profiles) ====\n")
+            print_top_functions(paths, file, top_n)
+    logger.info(f"Profile report per stage written to {report_path}")
+
+    report = io.StringIO()
+    print_top_functions(sum(files_by_stage.values(), []), report, top_n)
+    logger.info(f"Top {top_n} functions by own time, all stages and workers:\n{report.getvalue()}")
+
+
+def print_top_functions(paths, stream, top_n):
+    stats = pstats.Stats(*paths, stream=stream)
+    # not the list of all files merged
+    stats.files = []
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top_n)
@@ -0,0 +1,163 @@
+import logging
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+from common import get_optional_env_var
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_MAX_SIZE_MB = 1024
+# after eviction, the cache is at most this part of its maximum size
+EVICTION_TARGET = 0.9
+
+
+# Persistent cache of HTTP responses (IIIF manifests and annotation lists), keyed by URL. Bodies are stored compressed,
+# with their ETag and Last-Modified, to revalidate them with a conditional request (see http_client.get_json_from_http).
+# The least recently used entries are evicted when the compressed bodies take more than max_size bytes. One connection
+# is shared by the threads of a process.
+class ResponseCache:
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE_MB * 1024 * 1024, max_age=0):
+        self.path = path
+        self.max_size = max_size
+        # entries younger than this (seconds) are used without revalidation
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                                'url TEXT PRIMARY KEY, '
+                                'body BLOB NOT NULL, '
+                                'etag TEXT, '
+                                'last_modified TEXT, '
+                                'size INTEGER NOT NULL, '
+                                'validated REAL NOT NULL, '
+                                'used REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        # per run: hit (used without request), revalidated (304), changed (200 for a cached URL), miss (not cached)
+        self.stats = {'hit': 0, 'revalidated': 0, 'changed': 0, 'miss': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, url):
+        # {'body', 'etag', 'last_modified', 'fresh'} or None
+        with self.lock:
+            row = self.connection.execute('SELECT body, etag, last_modified, validated FROM responses WHERE url = ?',
+                                          [url]).fetchone()
+        if row is None:
+            return None
+        body, etag, last_modified, validated = row
+        return {'body': zlib.decompress(body).decode('utf-8'), 'etag': etag, 'last_modified': last_modified,
+                'fresh': time.time() - validated < self.max_age}
+
+    def put(self, url, body, etag, last_modified):
+        # only responses that can be revalidated are worth keeping
+        if etag is None and last_modified is None:
+            return
+        compressed = zlib.compress(body.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                previous = self.connection.execute('SELECT size FROM responses WHERE url = ?', [url]).fetchone()
+                self.connection.execute('INSERT OR REPLACE INTO responses '
+                                        '(url, body, etag, last_modified, size, validated, used) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        [url, compressed, etag, last_modified, len(compressed), now, now])
+            self.size += len(compressed) - (previous[0] if previous else 0)
+            if self.size > self.max_size:
+                self.evict()
+
+    def touch(self, url, validated=False):
+        # mark as used (and revalidated)
+        now = time.time()
+        with self.lock:
+            if validated:
+                self.connection.execute('UPDATE responses SET used = ?, validated = ? WHERE url = ?', [now, now, url])
+            else:
+                self.connection.execute('UPDATE responses SET used = ? WHERE url = ?', [now, url])
+
+    def evict(self):
+        # least recently used first, with the lock held
+        target = self.max_size * EVICTION_TARGET
+        count = 0
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            while self.size > target:
+                rows = self.connection.execute('SELECT url, size FROM responses ORDER BY used LIMIT 100').fetchall()
+                if not rows:
+                    break
+                for url, size in rows:
+                    self.connection.execute('DELETE FROM responses WHERE url = ?', [url])
+                    self.size -= size
+                    count += 1
+                    if self.size <= target:
+                        break
+        logger.debug(f"Evicted {count} responses from {self.path}, {self.size:,} bytes left")
+
+    def count(self, result):
+        with self.lock:
+            self.stats[result] += 1
+
+    def log_stats(self):
+        total = sum(self.stats.values())
+        if total:
+            logger.info(f"Response cache {self.path}: {total} requests, "
+                        f"{', '.join(f'{count} {result}' for result, count in self.stats.items())}, "
+                        f"{(self.stats['hit'] + self.stats['revalidated']) / total:.0%} served from cache, "
+                        f"{self.size / 1024 / 1024:,.1f} MiB in cache")
+
+    def summary(self):
+        entries, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'entries': entries, 'size': size}
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            count = self.connection.execute('DELETE FROM responses').rowcount
+        self.connection.execute('VACUUM')
+        self.size = 0
+        return count
+
+
+def main():
+    logging.basicConfig()
+
+    if len(sys.argv) < 3 or sys.argv[2] not in ['inspect', 'clear']:
+        print_usage()
+        exit(1)
+
+    path, command = sys.argv[1], sys.argv[2]
+    max_size = int(get_optional_env_var('IIIF_CACHE_MAX_SIZE', str(DEFAULT_MAX_SIZE_MB))) * 1024 * 1024
+    with ResponseCache(path, max_size) as cache:
+        if command == 'inspect':
+            summary = cache.summary()
+            print(f"{path}: {summary['entries']} entries, {summary['size'] / 1024 / 1024:,.1f} MiB compressed "
+                  f"(maximum {max_size / 1024 / 1024:,.0f} MiB)")
+        else:
+            print(f"Removed {cache.clear()} entries from {path}")
+
+
+def print_usage():
+    print(f"""
+    Usage:
+        {sys.executable} {__file__} <cache file> inspect
+        {sys.executable} {__file__} <cache file> clear
+
+    """)
+
+
+if __name__ == "__main__":
+    main()
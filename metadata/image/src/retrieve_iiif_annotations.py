@@ -1,65 +1,136 @@
+import asyncio
+import json
 import logging
+import os
+import sys
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from glom import glom, flatten, PathAccessError
-from multiprocessing import Pool
+from requests import RequestException
 
-from common import get_json_from_http
 from env import IIIF_API_URL, API_RETRIEVAL_THREAD_POOL_SIZE
+from env import IIIF_CACHE_FILE, IIIF_CACHE_MAX_SIZE, IIIF_CACHE_MAX_AGE
+from harvest_journal import HarvestJournal
+from http_client import get_json_from_http
+from response_cache import ResponseCache
 
 logger = logging.getLogger(__name__)
 
 
-def retrieve_annotation_refs(iiif_manifest_url, session):
-    if not iiif_manifest_url.startswith(IIIF_API_URL):
-        logger.warning(f"Skipping URL, not a IIIF service URL: {iiif_manifest_url}")
-        return []
-
-    logger.debug(f"Getting manifest from {iiif_manifest_url}")
-    manifest = get_json_from_http(iiif_manifest_url, session)
-
+# Harvesting of full text references from IIIF manifests: for each manifest, the annotation lists of its canvases
+# ('otherContent') are retrieved, and from each annotation list the reference of the page text. A whole collection is
+# harvested in one event loop; requests are made by the shared HTTP client (connection reuse, retries, rate limits) in
+# a thread pool of API_RETRIEVAL_THREAD_POOL_SIZE, which limits the requests in flight across all manifests. Responses
+# are cached in IIIF_CACHE_FILE (if set) and revalidated with conditional requests in later runs.
+
+
+def harvest_annotation_refs(manifest_urls, concurrency=API_RETRIEVAL_THREAD_POOL_SIZE):
+    # (fulltext ref, label) for the manifests (an iterable, read as the harvest goes), as they come in
+    for _, refs, _ in harvest_manifests(manifest_urls, concurrency):
+        yield from refs
+
+
+def harvest_manifests(manifest_urls, concurrency=API_RETRIEVAL_THREAD_POOL_SIZE):
+    # (manifest URL, [(fulltext ref, label), ...], complete) per manifest, in order of completion; complete is False if
+    # the manifest (with its sequences of canvases) or any of its annotation lists could not be retrieved
+    with open_response_cache() as cache:
+        loop = asyncio.new_event_loop()
+        results = harvest(manifest_urls, concurrency, cache)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.close()
+            if cache:
+                cache.log_stats()
+
+
+def open_response_cache():
+    if IIIF_CACHE_FILE:
+        return ResponseCache(IIIF_CACHE_FILE, IIIF_CACHE_MAX_SIZE * 1024 * 1024, IIIF_CACHE_MAX_AGE)
+    return nullcontext()
+
+
+async def harvest(manifest_urls, concurrency, cache=None):
+    with ThreadPoolExecutor(concurrency, thread_name_prefix='iiif') as executor:
+        requests_slots = asyncio.Semaphore(concurrency)
+
+        async def get_json(url):
+            # None if the request failed (after the retries of the HTTP client)
+            async with requests_slots:
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(
+                        executor, partial(get_json_from_http, url, cache=cache))
+                except RequestException as e:
+                    logger.error(f"Request to {url} failed: {e}")
+                    return None
+
+        # manifests are taken from the input as others complete, each can have many annotation lists in flight
+        manifests = iter(manifest_urls)
+        pending = set()
+        try:
+            while True:
+                for manifest_url in manifests:
+                    pending.add(asyncio.ensure_future(harvest_manifest(manifest_url, get_json)))
+                    if len(pending) >= concurrency:
+                        break
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def harvest_manifest(manifest_url, get_json):
+    if not manifest_url.startswith(IIIF_API_URL):
+        logger.warning(f"Skipping URL, not a IIIF service URL: {manifest_url}")
+        return manifest_url, [], False
+
+    logger.debug(f"Getting manifest from {manifest_url}")
+    manifest = await get_json(manifest_url)
     if manifest is None:
-        logger.warning(f"No valid response from manifest request at {iiif_manifest_url}")
-    else:
-        with Pool(API_RETRIEVAL_THREAD_POOL_SIZE) as p:
-            # collection annotation URLs for record
-            canvases = glom(manifest, ('sequences', ['canvases']), skip_exc=PathAccessError)
-            if canvases is not None:
-                annotation_urls = glom(flatten(canvases),
-                                       [{'urls': 'otherContent', 'label': 'label'}],
-                                       skip_exc=PathAccessError)
-                if annotation_urls is not None:
-                    logger.debug(f"{len(annotation_urls)} annotation references found")
-
-                    retrieval_context = RetrievalContext(session)
-                    # retrieval of fulltext URLs in thread pool
-                    fulltext_labeled_urls = \
-                        p.map(retrieval_context.retrieve_fulltext_refs_from_annotation, annotation_urls)
-                    return [url for url in flatten(fulltext_labeled_urls) if url is not None]
-    return []
-
-
-class RetrievalContext:
-
-    def __init__(self, session):
-        self.session = session
-
-    def retrieve_fulltext_refs_from_annotation(self, annotation_urls_label):
-        refs = []
-        urls = annotation_urls_label.get('urls', None)
-        label = annotation_urls_label.get('label', None)
-        if urls:
-            for annotation_url in urls:
-                annotations = get_json_from_http(annotation_url, self.session)
-                if annotations is None:
-                    logger.error(f"No content for annotations at {annotation_url}")
-                else:
-                    fulltext_ref = get_fulltext_ref_from_annotations(annotations)
-                    if fulltext_ref is None:
-                        logger.warning(f"No full text content in annotations data at {annotation_url}")
-                    else:
-                        refs += [(fulltext_ref, label)]
-
-        return refs
+        logger.warning(f"No valid response from manifest request at {manifest_url}")
+        return manifest_url, [], False
+
+    # only a manifest with sequences of canvases is harvested (not a 404, or any other document)
+    canvases = glom(manifest, ('sequences', ['canvases']), skip_exc=PathAccessError)
+    if canvases is None:
+        logger.warning(f"No sequences of canvases in manifest at {manifest_url}")
+        return manifest_url, [], False
+
+    # collection annotation URLs for record
+    annotation_urls = []
+    labeled_urls = glom(flatten(canvases), [{'urls': 'otherContent', 'label': 'label'}], skip_exc=PathAccessError)
+    if labeled_urls is not None:
+        annotation_urls = [(url, labeled['label']) for labeled in labeled_urls for url in labeled['urls'] or []]
+    logger.debug(f"{len(annotation_urls)} annotation references found")
+
+    results = await asyncio.gather(*[retrieve_fulltext_ref(url, label, get_json)
+                                     for url, label in annotation_urls])
+    refs = [ref for ref, _ in results if ref is not None]
+    return manifest_url, refs, all(complete for _, complete in results)
+
+
+async def retrieve_fulltext_ref(annotation_url, label, get_json):
+    # ((fulltext ref, label) or None, whether the annotations could be retrieved)
+    annotations = await get_json(annotation_url)
+    if annotations is None:
+        logger.error(f"No content for annotations at {annotation_url}")
+        return None, False
+    fulltext_ref = get_fulltext_ref_from_annotations(annotations)
+    if fulltext_ref is None:
+        logger.warning(f"No full text content in annotations data at {annotation_url}")
+        return None, True
+    return (fulltext_ref, label), True
 
 
 def get_fulltext_ref_from_annotations(annotations):
@@ -70,3 +141,61 @@ def get_fulltext_ref_from_annotations(annotations):
                 return glom(resource, 'resource.@id', skip_exc=PathAccessError)
 
     return None
+
+
+def retrieve_annotation_refs(iiif_manifest_url):
+    return list(harvest_annotation_refs([iiif_manifest_url]))
+
+
+def main():
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+
+    if len(sys.argv) < 3:
+        print_usage()
+        exit(1)
+
+    manifest_list, output_file = sys.argv[1], sys.argv[2]
+    journal_file = sys.argv[3] if len(sys.argv) > 3 else f"{output_file}.journal"
+    with open(manifest_list) as file:
+        manifest_urls = list(dict.fromkeys(line.strip() for line in file if line.strip()))
+
+    # progress is kept in the journal, so that an interrupted harvest can be resumed by running it again
+    with HarvestJournal(journal_file) as journal:
+        pending = journal.pending(manifest_urls)
+        logger.info(f"Harvesting full text references from {len(pending)} manifests, "
+                    f"{len(manifest_urls) - len(pending)} done in a previous run (journal {journal_file})")
+        for manifest_url, refs, complete in harvest_manifests(pending):
+            journal.record(manifest_url, refs, complete)
+        incomplete = write_refs(journal, manifest_urls, output_file)
+    logger.info(f"Wrote full text references to {output_file}, {incomplete} manifests incomplete")
+
+
+def write_refs(journal, manifest_urls, output_file):
+    # the references of all manifests from the journal, in the order of the manifest list; returns the number of
+    # manifests that are not done
+    incomplete = 0
+    temporary_file = f"{output_file}.tmp"
+    with open(temporary_file, 'w') as output:
+        for manifest_url in manifest_urls:
+            for fulltext_ref, label in journal.refs(manifest_url):
+                output.write(json.dumps({'manifest': manifest_url, 'fulltext': fulltext_ref, 'label': label}) + '\n')
+            if not journal.is_done(manifest_url):
+                incomplete += 1
+    os.replace(temporary_file, output_file)
+    return incomplete
+
+
+def print_usage():
+    print(f"""
+    Usage:
+        {sys.executable} {__file__} <file with manifest URLs, one per line> <output file (JSON lines)> [<journal file>]
+
+    The journal (by default <output file>.journal) records the progress of the harvest. When run again with the same
+    journal, manifests that were harvested before are skipped, and failed and remaining ones are retried.
+
+    """)
+
+
+if __name__ == "__main__":
+    main()
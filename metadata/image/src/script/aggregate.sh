@@ -7,19 +7,48 @@ if ! ([ "${INPUT}" ] && [ "${OUTPUT}" ] && [ "${NEW_OUTPUT}" ] && [ "${COLLECTIO
 fi
 
 
-if ! [ -d "${INPUT}" ]; then
-  echo "ERROR - Input directory does not exist. Run $0 retrieve first!"
+# metadata dump as retrieved (ZIP archive) or unpacked into a directory
+if [ -f "${INPUT}.zip" ]; then
+  INPUT="${INPUT}.zip"
+elif ! [ -d "${INPUT}" ]; then
+  echo "ERROR - Input directory or archive does not exist. Run $0 retrieve first!"
   exit 1
 fi
 
-if [ -d "${NEW_OUTPUT}" ]; then
+if [ -d "${NEW_OUTPUT}" ] || [ -e "${NEW_OUTPUT}.zip" ]; then
   echo "Cleaning up temporary output at ${NEW_OUTPUT}"
-  rm -rf "${NEW_OUTPUT}"
+  rm -rf "${NEW_OUTPUT}" "${NEW_OUTPUT}.zip"
+fi
+
+# records are written to the archive (compressed in parallel) and optionally to a directory
+ARCHIVE="${OUTPUT}.zip"
+NEW_ARCHIVE="${NEW_OUTPUT}.zip"
+OUTPUT_ARGS=("--archive" "${NEW_ARCHIVE}")
+if [ "${WRITE_OUTPUT_DIRECTORY:-true}" = "true" ]; then
+  mkdir -p "${NEW_OUTPUT}"
+  OUTPUT_ARGS=("${NEW_OUTPUT}" "${OUTPUT_ARGS[@]}")
+fi
+
+# manifest of inputs and outputs, kept next to the output
+MANIFEST="${OUTPUT}.manifest.json.gz"
+NEW_MANIFEST="${NEW_OUTPUT}.manifest.json.gz"
+INCREMENTAL_ARGS=("--manifest" "${NEW_MANIFEST}")
+if [ "${MAX_MEMORY:-0}" != "0" ]; then
+  # records are grouped on disk, no manifest is kept
+  INCREMENTAL_ARGS=()
+elif [ "${INCREMENTAL_AGGREGATION:-true}" = "true" ] && [ -e "${MANIFEST}" ]; then
+  echo "Incremental aggregation: carrying over unchanged records from ${OUTPUT}"
+  INCREMENTAL_ARGS+=("--previous-manifest" "${MANIFEST}")
+  if [ -d "${OUTPUT}" ]; then
+    INCREMENTAL_ARGS+=("--previous-output" "${OUTPUT}")
+  fi
+  if [ -f "${ARCHIVE}" ]; then
+    INCREMENTAL_ARGS+=("--previous-archive" "${ARCHIVE}")
+  fi
 fi
 
-mkdir -p "${NEW_OUTPUT}"
 (
-  if python3 '__main__.py' "${COLLECTION_ID}" "${INPUT}" "${NEW_OUTPUT}"; then
+  if python3 '__main__.py' "${COLLECTION_ID}" "${INPUT}" "${OUTPUT_ARGS[@]}" "${INCREMENTAL_ARGS[@]}"; then
     # success: move to final output location, replace existing if applicable
     echo "Moving output into place"
 
@@ -29,7 +58,12 @@ mkdir -p "${NEW_OUTPUT}"
       mv "${OUTPUT}" "${OLD_OUTPUT}"
     fi
     # Move new output to old location
-    if mv "${NEW_OUTPUT}" "${OUTPUT}"; then
+    if mv "${NEW_ARCHIVE}" "${ARCHIVE}" && { ! [ -d "${NEW_OUTPUT}" ] || mv "${NEW_OUTPUT}" "${OUTPUT}"; }; then
+      if [ -e "${NEW_MANIFEST}" ]; then
+        mv "${NEW_MANIFEST}" "${MANIFEST}"
+      else
+        rm -f "${MANIFEST}"
+      fi
       if [ -d "${OLD_OUTPUT}" ]; then
         rm -rf "${OLD_OUTPUT}"
       fi
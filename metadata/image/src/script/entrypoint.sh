@@ -77,14 +77,8 @@ main() {
       NEW_OUTPUT="${TEMP_OUTPUT_DIR}/${COLLECTION_ID}"
       export COLLECTION_ID INPUT OUTPUT NEW_OUTPUT
       if bash "${SCRIPT_DIR}/aggregate.sh"; then
-        echo "Done. Archiving results..."
-        # zip output (TODO: make optional?)
-        ZIP_TARGET="${OUTPUT_DIR}/${COLLECTION_ID}.zip"
-        if [ -e "${ZIP_TARGET}" ]; then
-          rm "${ZIP_TARGET}"
-        fi
-        zip -jrq "${ZIP_TARGET}" "${OUTPUT}"
-        echo "Results archived in ${ZIP_TARGET}"
+        # the archive is written by the aggregation itself
+        echo "Done. Results archived in ${OUTPUT}.zip"
       else
         echo "Aggregation failed"
         exit 1
@@ -96,14 +90,15 @@ main() {
     echo "Erasing content for ${COLLECTION_ID} in ${INPUT_DIR}"
     if [ -d "${INPUT_DIR}" ]; then
       ( cd "${INPUT_DIR}" && find . -name "${COLLECTION_ID}" -type d -maxdepth 1 -mindepth 1 -print0|xargs -0 rm -rf )
+      rm -f "${INPUT_DIR}/${COLLECTION_ID}.zip"
     else
       echo "Error: ${INPUT_DIR} not found"
     fi
     
     OUTPUT_TMP="${TEMP_OUTPUT_DIR}/${COLLECTION_ID}"
-    if [ -d "${OUTPUT_TMP}" ]; then
+    if [ -d "${OUTPUT_TMP}" ] || [ -e "${OUTPUT_TMP}.zip" ]; then
       	echo "Cleaning up temporary output at ${OUTPUT_TMP}"
-      	rm -rf "${OUTPUT_TMP}"
+      	rm -rf "${OUTPUT_TMP}" "${OUTPUT_TMP}.zip"
     fi
   fi
 }
@@ -27,7 +27,7 @@ main() {
     RESULT=$?
   done
 
-  echo "$(date) - Done retrieving and unpacking for collection ${COLLECTION_ID}."
+  echo "$(date) - Done retrieving metadata for collection ${COLLECTION_ID}."
 }
 
 
@@ -50,6 +50,13 @@ download_and_unpack() {
       fi
     fi
 
+    if [ "${UNPACK_METADATA_DUMP:-false}" != "true" ]; then
+      # the aggregation reads the metadata directly from the archive
+      echo "$(date) - Keeping metadata dump as ${DIR}.zip"
+      mv "${FILE}" "${DIR}.zip"
+      return 0
+    fi
+
     echo "$(date) - Decompressing ${FILE} in ${DIR}"
     mkdir -p "${DIR}" && cd "${DIR}"
     if 7z x "${FILE}" -aoa; then
@@ -0,0 +1,126 @@
+import logging
+import sqlite3
+import sys
+import time
+
+from common import get_optional_env_var
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_DAYS = 30
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+# Persistent cache of Record API title lookups, keyed by EDM item id (ex. '9200396/BibliographicResource_1').
+# Negative results (record without title, unknown record) are stored with a NULL title. SQLite takes care of locking,
+# so a cache file can be shared by several processes and runs at once.
+class TitleCache:
+
+    def __init__(self, path, ttl_days=DEFAULT_TTL_DAYS):
+        self.path = path
+        self.ttl = ttl_days * SECONDS_PER_DAY
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS titles ('
+                                'edm_id TEXT PRIMARY KEY, '
+                                'title TEXT, '
+                                'retrieved REAL NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get_many(self, edm_ids):
+        # fresh entries only: edm id -> title (None for a negative result)
+        oldest = time.time() - self.ttl
+        entries = {}
+        edm_ids = list(edm_ids)
+        # stay below the SQLite host parameter limit
+        for start in range(0, len(edm_ids), 500):
+            chunk = edm_ids[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT edm_id, title FROM titles WHERE retrieved >= ? "
+                f"AND edm_id IN ({', '.join('?' * len(chunk))})", [oldest, *chunk])
+            for edm_id, title in rows:
+                entries[edm_id] = title
+        return entries
+
+    def put_many(self, titles):
+        now = time.time()
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany('INSERT OR REPLACE INTO titles (edm_id, title, retrieved) VALUES (?, ?, ?)',
+                                        [(edm_id, title, now) for edm_id, title in titles.items()])
+
+    def purge(self, which='expired'):
+        if which == 'all':
+            condition, parameters = '', []
+        elif which == 'negative':
+            condition, parameters = ' WHERE title IS NULL', []
+        else:
+            condition, parameters = ' WHERE retrieved < ?', [time.time() - self.ttl]
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            count = self.connection.execute(f"DELETE FROM titles{condition}", parameters).rowcount
+        self.connection.execute('VACUUM')
+        return count
+
+    def stats(self):
+        oldest = time.time() - self.ttl
+        total, negative, expired = self.connection.execute(
+            'SELECT COUNT(*), COUNT(*) - COUNT(title), COALESCE(SUM(retrieved < ?), 0) FROM titles',
+            [oldest]).fetchone()
+        return {'entries': total, 'negative': negative, 'expired': expired}
+
+    def entries(self, edm_ids=None):
+        if edm_ids:
+            return self.connection.execute(
+                f"SELECT edm_id, title, retrieved FROM titles WHERE edm_id IN ({', '.join('?' * len(edm_ids))})",
+                list(edm_ids)).fetchall()
+        return self.connection.execute('SELECT edm_id, title, retrieved FROM titles ORDER BY edm_id').fetchall()
+
+
+def main():
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+
+    if len(sys.argv) < 3 or sys.argv[2] not in ['inspect', 'purge']:
+        print_usage()
+        exit(1)
+
+    path, command, arguments = sys.argv[1], sys.argv[2], sys.argv[3:]
+    ttl_days = float(get_optional_env_var('TITLE_CACHE_TTL_DAYS', str(DEFAULT_TTL_DAYS)))
+
+    with TitleCache(path, ttl_days) as cache:
+        if command == 'inspect':
+            stats = cache.stats()
+            print(f"{path}: {stats['entries']} entries, {stats['negative']} negative, "
+                  f"{stats['expired']} expired (TTL {ttl_days} days)")
+            if arguments:
+                for edm_id, title, retrieved in cache.entries(arguments if arguments != ['all'] else None):
+                    retrieved_string = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(retrieved))
+                    print(f"{edm_id}\t{title if title is not None else '<no title>'}\t{retrieved_string}")
+        else:
+            which = arguments[0] if arguments else 'expired'
+            if which not in ['expired', 'negative', 'all']:
+                print_usage()
+                exit(1)
+            print(f"Purged {cache.purge(which)} {which} entries from {path}")
+
+
+def print_usage():
+    print(f"""
+    Usage:
+        {sys.executable} {__file__} <cache file> inspect [all|<edm id>..]
+        {sys.executable} {__file__} <cache file> purge [expired|negative|all]
+
+    """)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import logging
+import metrics
+import re
+
+from contextlib import nullcontext
+from glom import glom, PathAccessError
+from multiprocessing.pool import ThreadPool
+from requests import RequestException
+from urllib.parse import urlencode
+
+from http_client import get_json_from_http
+from env import RECORD_API_URL, RECORD_API_KEY, TITLE_RESOLUTION_THREAD_POOL_SIZE
+from env import TITLE_CACHE_FILE, TITLE_CACHE_TTL_DAYS
+from env import TITLE_RESOLVER, SEARCH_API_URL, TITLE_SEARCH_BATCH_SIZE
+from title_cache import TitleCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+EDM_ID_PATTERN = re.compile(r'^[A-z]+://data.europeana.eu/item/([^/]+/[^/]+)$')
+
+
+def resolve_titles(part_of_refs):
+    # each distinct (dcterms:isPartOf) reference is looked up at most once
+    refs = list(dict.fromkeys(ref for ref in part_of_refs if ref is not None))
+    ref_ids = {ref: get_edm_id(ref) for ref in refs}
+    edm_ids = list(dict.fromkeys(edm_id for edm_id in ref_ids.values() if edm_id is not None))
+    logger.info(f"Resolving titles for {len(refs)} distinct parent records")
+
+    with open_title_cache() as cache:
+        titles = cache.get_many(edm_ids) if cache else {}
+        missing = [edm_id for edm_id in edm_ids if edm_id not in titles]
+        logger.info(f"{len(titles)} cached lookups, {len(missing)} titles to retrieve")
+        metrics.inc('titles_total', len(titles), source='cache')
+
+        if len(missing) > 0:
+            retrieved, request_count = retrieve_titles(missing)
+            resolved_count = sum(1 for title in retrieved.values() if title is not None)
+            logger.info(f"{request_count} API requests for {len(missing)} titles, {resolved_count} resolved "
+                        f"({request_count / max(1, resolved_count):.2f} requests per resolved title, "
+                        f"{TITLE_RESOLVER} resolver)")
+            metrics.inc('titles_total', len(retrieved), source='api')
+            metrics.inc('title_api_requests_total', request_count)
+            titles.update(retrieved)
+            if cache:
+                cache.put_many(retrieved)
+
+    title_map = {ref: titles[edm_id] for ref, edm_id in ref_ids.items() if titles.get(edm_id) is not None}
+    logger.info(f"Resolved {len(title_map)} of {len(refs)} titles")
+    return title_map
+
+
+def open_title_cache():
+    if TITLE_CACHE_FILE:
+        return TitleCache(TITLE_CACHE_FILE, TITLE_CACHE_TTL_DAYS)
+    return nullcontext()
+
+
+def get_edm_id(ref):
+    match = EDM_ID_PATTERN.match(ref)
+    if match:
+        return match.group(1)
+
+
+def retrieve_titles(edm_ids):
+    # only actual answers from the API (including 'no title') are returned, not failed requests
+    titles = {}
+    request_count = 0
+    if TITLE_RESOLVER == 'search':
+        batches = [edm_ids[start:start + TITLE_SEARCH_BATCH_SIZE]
+                   for start in range(0, len(edm_ids), TITLE_SEARCH_BATCH_SIZE)]
+        with ThreadPool(min(TITLE_RESOLUTION_THREAD_POOL_SIZE, len(batches))) as p:
+            for found in p.map(search_titles, batches):
+                titles.update(found)
+        request_count += len(batches)
+        # fall back to record lookups for ids not found by the search
+        edm_ids = [edm_id for edm_id in edm_ids if edm_id not in titles]
+        logger.info(f"{len(titles)} titles found by search, {len(edm_ids)} left for record lookups")
+
+    if len(edm_ids) > 0:
+        with ThreadPool(min(TITLE_RESOLUTION_THREAD_POOL_SIZE, len(edm_ids))) as p:
+            for edm_id, title, answered in p.map(look_up_title, edm_ids):
+                if answered:
+                    titles[edm_id] = title
+        request_count += len(edm_ids)
+
+    return titles, request_count
+
+
+def search_titles(edm_ids):
+    # one search request for a batch of records, restricted to the fields needed
+    query = ' OR '.join(f'europeana_id:"/{edm_id}"' for edm_id in edm_ids)
+    parameters = urlencode({
+        'wskey': RECORD_API_KEY,
+        'query': query,
+        'rows': len(edm_ids),
+        'profile': 'minimal',
+        'fl': 'id,title,dcTitleLangAware'
+    })
+    url = f"{SEARCH_API_URL}?{parameters}"
+    logger.debug(f"Searching {len(edm_ids)} collection records at {url}")
+    json_doc = get_json(url)
+    found = {}
+    if json_doc is not None:
+        for item in glom(json_doc, 'items', default=None, skip_exc=PathAccessError) or []:
+            edm_id = item.get('id', '').lstrip('/')
+            title = get_title_from_search_item(item)
+            if edm_id in edm_ids and title is not None:
+                found[edm_id] = title
+    return found
+
+
+def get_title_from_search_item(item):
+    titles = glom(item, 'dcTitleLangAware.def', default=None, skip_exc=PathAccessError) or item.get('title', None)
+    if titles and len(titles) > 0:
+        return titles[0]
+
+
+def look_up_title(edm_id):
+    # retrieve title from API
+    url = f"{RECORD_API_URL}/{edm_id}.json?wskey={RECORD_API_KEY}"
+    logger.debug(f"Getting collection record from {url}")
+    json_doc = get_json(url)
+    if json_doc is None:
+        return edm_id, None, False
+    return edm_id, get_title_from_record(json_doc), True
+
+
+def get_json(url):
+    # None if the request failed (after the retries of the HTTP client): the title is left unresolved, and not cached
+    try:
+        return get_json_from_http(url)
+    except RequestException as e:
+        logger.error(f"Request to {url} failed: {e}")
+        return None
+
+
+def get_title_from_record(json_doc):
+    proxies = glom(json_doc, 'object.proxies', default=None, skip_exc=PathAccessError)
+    if proxies:
+        for proxy in proxies:
+            titles = glom(proxy, 'dcTitle.def', default=None, skip_exc=PathAccessError)
+            if titles and len(titles) > 0:
+                return titles[0]
@@ -0,0 +1,189 @@
+import io
+import logging
+import metrics
+import struct
+import time
+import zlib
+
+from zipfile import ZipFile
+
+logger = logging.getLogger(__name__)
+
+# ZIP archive written from members that were compressed elsewhere (ex. in pool workers): the process writing the
+# archive only appends bytes. The zipfile module can read the result, but cannot write members compressed beforehand.
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_OF_CENTRAL_DIRECTORY = struct.Struct('<IHHHHIIH')
+ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct('<IQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+ZIP64_OFFSET_EXTRA = struct.Struct('<HHQ')
+
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06054b50
+ZIP64_END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06064b50
+ZIP64_LOCATOR_SIGNATURE = 0x07064b50
+
+DEFLATED = 8
+UTF8_NAMES = 0x0800
+VERSION = 20
+ZIP64_VERSION = 45
+MADE_BY_UNIX = 3 << 8
+FILE_ATTRIBUTES = (0o100644 << 16)
+MAX_16 = 0xFFFF
+MAX_32 = 0xFFFFFFFF
+COMPRESSION_LEVEL = 6
+
+
+def list_members(archive_path):
+    with ZipFile(archive_path) as archive:
+        return set(archive.namelist())
+
+
+def to_dos_time(date_time):
+    # (year, month, day, hour, minute, second) in the two 16 bit fields of the ZIP headers
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((max(year, 1980) - 1980) << 9) | (month << 5) | day
+
+
+class RecordOutput:
+    # where (pool workers) put generated records: files in a directory, compressed members for the archive written by
+    # the parent process, or both
+
+    def __init__(self, output_dir=None, to_archive=False):
+        self.output_dir = output_dir
+        self.to_archive = to_archive
+
+    def write(self, file_name, write_record):
+        # write_record(file) writes the record to a binary file; returns the compressed member for the archive, if any
+        with metrics.stage('write'):
+            if not self.to_archive:
+                with open(f"{self.output_dir}/{file_name}", 'wb') as file:
+                    write_record(file)
+                    metrics.inc('cmdi_bytes_written_total', file.tell())
+                return None
+
+            loose_file = open(f"{self.output_dir}/{file_name}", 'wb') if self.output_dir else None
+            try:
+                writer = CompressingWriter(loose_file)
+                write_record(writer)
+            finally:
+                if loose_file:
+                    loose_file.close()
+            metrics.inc('cmdi_bytes_written_total', writer.size)
+        with metrics.stage('compress'):
+            return writer.finish(file_name)
+
+
+class CompressingWriter(io.RawIOBase):
+    # binary file compressing what is written to it as it comes in (so that a record is never held uncompressed as a
+    # whole), for a member of the archive; also writes it to a (loose) file, if given
+
+    def __init__(self, file=None, compression_level=COMPRESSION_LEVEL):
+        self.file = file
+        self.compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.compressed = []
+        self.crc = 0
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.compressed += [self.compressor.compress(data)]
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.file:
+            self.file.write(data)
+        return len(data)
+
+    def finish(self, name):
+        # (name, dos time, dos date, crc, uncompressed size, compressed data), to be added with ZipOutput.add
+        self.compressed += [self.compressor.flush()]
+        dos_time, dos_date = to_dos_time(time.localtime()[:6])
+        return name, dos_time, dos_date, self.crc, self.size, b''.join(self.compressed)
+
+
+class ZipOutput:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.entries = []
+        self.names = set()
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, member):
+        name, dos_time, dos_date, crc, size, compressed = member
+        if name in self.names:
+            logger.warning(f"Not adding duplicate member {name} to {self.path}")
+            return
+        encoded_name = name.encode('utf-8')
+        self.file.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIGNATURE, VERSION, UTF8_NAMES, DEFLATED, dos_time, dos_date,
+                                          crc, len(compressed), size, len(encoded_name), 0))
+        self.file.write(encoded_name)
+        self.file.write(compressed)
+        self.entries += [(encoded_name, dos_time, dos_date, crc, len(compressed), size, self.offset)]
+        self.names.add(name)
+        self.offset += LOCAL_HEADER.size + len(encoded_name) + len(compressed)
+
+    def copy(self, archive_path, names):
+        # copies deflated members of another archive without decompressing them, returns the names copied
+        copied = set()
+        with ZipFile(archive_path) as archive, open(archive_path, 'rb') as file:
+            for name in names:
+                try:
+                    info = archive.getinfo(name)
+                except KeyError:
+                    continue
+                if info.compress_type != DEFLATED:
+                    continue
+                file.seek(info.header_offset)
+                header = LOCAL_HEADER.unpack(file.read(LOCAL_HEADER.size))
+                file.seek(header[9] + header[10], 1)
+                compressed = file.read(info.compress_size)
+                dos_time, dos_date = to_dos_time(info.date_time)
+                self.add((name, dos_time, dos_date, info.CRC, info.file_size, compressed))
+                copied.add(name)
+        return copied
+
+    def close(self):
+        if self.file.closed:
+            return
+        central_directory_offset = self.offset
+        for encoded_name, dos_time, dos_date, crc, compressed_size, size, offset in self.entries:
+            extra = b''
+            version = VERSION
+            if offset > MAX_32:
+                extra = ZIP64_OFFSET_EXTRA.pack(1, 8, offset)
+                offset = MAX_32
+                version = ZIP64_VERSION
+            self.file.write(CENTRAL_HEADER.pack(CENTRAL_HEADER_SIGNATURE, MADE_BY_UNIX | version, version, UTF8_NAMES,
+                                                DEFLATED, dos_time, dos_date, crc, compressed_size, size,
+                                                len(encoded_name), len(extra), 0, 0, 0, FILE_ATTRIBUTES, offset))
+            self.file.write(encoded_name)
+            self.file.write(extra)
+            self.offset += CENTRAL_HEADER.size + len(encoded_name) + len(extra)
+        central_directory_size = self.offset - central_directory_offset
+
+        count = len(self.entries)
+        if count >= MAX_16 or central_directory_offset > MAX_32 or central_directory_size > MAX_32:
+            self.file.write(ZIP64_END_OF_CENTRAL_DIRECTORY.pack(
+                ZIP64_END_OF_CENTRAL_DIRECTORY_SIGNATURE, ZIP64_END_OF_CENTRAL_DIRECTORY.size - 12,
+                MADE_BY_UNIX | ZIP64_VERSION, ZIP64_VERSION, 0, 0, count, count,
+                central_directory_size, central_directory_offset))
+            self.file.write(ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, self.offset, 1))
+            count = min(count, MAX_16)
+            central_directory_offset = min(central_directory_offset, MAX_32)
+            central_directory_size = min(central_directory_size, MAX_32)
+        self.file.write(END_OF_CENTRAL_DIRECTORY.pack(END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, count, count,
+                                                      central_directory_size, central_directory_offset, 0))
+        self.file.close()
+        logger.info(f"Wrote {len(self.entries)} records to {self.path}")
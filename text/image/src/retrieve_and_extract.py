@@ -1,7 +1,7 @@
 import logging
+import metrics
 import os
 import re
-import time
 import threading
 import json
 
@@ -19,6 +19,8 @@ ENV_QUEUE_SIZE_LIMIT = os.environ.get('QUEUE_SIZE_LIMIT', default='1024')
 ZIP_BASE_PATH = os.environ.get('DUMP_BASE_PATH')
 ZIP_BASE_FTP_URL = os.environ.get('DUMP_FTP_BASE_URL')
 MAP_FILE_NAME = os.environ.get('MAP_FILE_NAME', default='id_file_map.json')
+METRICS_JSON_FILE = os.environ.get('METRICS_JSON_FILE')
+METRICS_PROMETHEUS_FILE = os.environ.get('METRICS_PROMETHEUS_FILE')
 
 xml_parser = etree.XMLParser(resolve_entities=False, huge_tree=True, remove_pis=True)
 
@@ -38,9 +40,19 @@ def main(collection_id, output_dir):
     else:
         logger.setLevel(logging.INFO)
 
-    start_time = time.perf_counter()
     logger.info(f'Retrieving and extracting fulltext from dump for collection {collection_id}')
 
+    try:
+        with metrics.stage('total'):
+            extract_collection(collection_id, output_dir)
+        time_elapsed = metrics.REGISTRY.get_stage_seconds('total')
+        logger.info(f'Completed processing of {collection_id} in {time_elapsed/60:0.0f}m{(time_elapsed%60):02.0f}s')
+    finally:
+        # also for a failed run
+        metrics.write_reports(METRICS_JSON_FILE, METRICS_PROMETHEUS_FILE, prefix='europeana_fulltext_extraction')
+
+
+def extract_collection(collection_id, output_dir):
     id_file_map = {}
 
     chunks_generator = create_dump_chunk_generator(collection_id)
@@ -50,20 +62,25 @@ def main(collection_id, output_dir):
         full_output_path = f'{output_dir}/{output_file}'
 
         logger.info(f'Reading file from zip: {file_name}')
-        xml = read_file_from_zip(file_name, unzipped_chunks)
+        waited = metrics.REGISTRY.get_stage_seconds('download_wait')
+        with metrics.stage('unzip'):
+            xml = read_file_from_zip(file_name, unzipped_chunks)
+        # the file is unzipped as the download comes in: the waits for it within 'unzip' only count as 'download_wait'
+        metrics.REGISTRY.add_stage('unzip', waited - metrics.REGISTRY.get_stage_seconds('download_wait'), 0.0, calls=0)
         logger.debug('Extracting text')
-        text = process_xml(BytesIO(xml), id_file_map, os.path.basename(output_file))
+        with metrics.stage('parse'):
+            text = process_xml(BytesIO(xml), id_file_map, os.path.basename(output_file))
         logger.debug('Writing text to file')
-        write_to_file(text, full_output_path)
+        with metrics.stage('write'):
+            write_to_file(text, full_output_path)
+        metrics.inc('fulltext_files_total')
+        metrics.inc('xml_bytes_read_total', len(xml))
 
     map_file = f'{os.path.realpath(output_dir)}/{collection_id}/{MAP_FILE_NAME}'
     logger.info(f'Writing id -> file name map to {map_file}')
     with open(map_file, 'w') as f:
         json.dump(id_file_map, f)
 
-    time_elapsed = time.perf_counter() - start_time
-    logger.info(f'Completed processing of {collection_id} in {time_elapsed/60:0.0f}m{(time_elapsed%60):02.0f}s')
-
 
 def create_dump_chunk_generator(collection_id):
     if ZIP_BASE_FTP_URL:
@@ -103,7 +120,7 @@ def write_to_file(text, output_file):
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     with open(output_file, 'w') as f:
         logger.info(f'Writing text to {os.path.realpath(output_file)}')
-        f.write(text)
+        metrics.inc('text_characters_written_total', f.write(text))
 
 
 def zipped_chunks_ftp(collection_id):
@@ -114,15 +131,22 @@ def zipped_chunks_ftp(collection_id):
     if parsed_url.scheme != 'ftp':
         logger.warning(f'Configured base URL is "{parsed_url.scheme}", expecting "ftp"')
 
-    ftp = FTP(parsed_url.hostname)
+    ftp = FTP()
+    ftp.connect(parsed_url.hostname, parsed_url.port or 21)
     ftp.login()
     ftp.cwd(parsed_url.path)
 
     queue = Queue(queue_size_limit)
 
     def ftp_thread_target():
-        ftp.retrbinary(f'RETR {file}', callback=queue.put, blocksize=block_size)
-        queue.put(None)
+        try:
+            ftp.retrbinary(f'RETR {file}', callback=queue.put, blocksize=block_size)
+            queue.put(None)
+        except Exception as e:
+            # raised in the reading thread, which would otherwise wait for more chunks forever
+            queue.put(e)
+        finally:
+            ftp.close()
 
     logger.info(f'Starting retrieval from {ftp.host}')
     ftp_thread = threading.Thread(target=ftp_thread_target)
@@ -130,8 +154,14 @@ def zipped_chunks_ftp(collection_id):
 
     count = 0
     while True:
-        chunk = queue.get()
+        # an empty queue means waiting for the download
+        metrics.set_gauge('ftp_queue_depth', queue.qsize())
+        with metrics.stage('download_wait'):
+            chunk = queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
         if chunk:
+            metrics.inc('dump_bytes_total', len(chunk))
             if logger.level == logging.DEBUG:
                 count += 1
                 if (count % 100) == 0:
@@ -148,6 +178,7 @@ def zipped_chunks_local(collection_id):
         while True:
             data = f.read(block_size)
             if data:
+                metrics.inc('dump_bytes_total', len(data))
                 yield data
             else:
                 break